@@ -253,22 +253,22 @@ class MQRepl:
 
     # Helpers
 
-    # _send_stream repeatedly calls read() on the stream until EOF and publishes the data it gets
-    # to the specified topic. Each packet has the std 2-byte header.
+    # _send_stream repeatedly calls readinto() on the stream until EOF and publishes the data it
+    # gets to the specified topic. Each packet has the std 2-byte header. The data is read straight
+    # into a publish buffer from the MQTT client, so nothing gets allocated or copied.
     async def _send_stream(self, topic, stream):
-        buf = bytearray(BUFLEN + 2)
-        buf[2:] = stream.read(BUFLEN)
         seq = 0
-        last = 0
         while True:
-            last = len(buf) == 2
-            struct.pack_into("!H", buf, 0, last << 15 | seq)
-            log.debug("pub {} -> {}".format(len(buf), topic))
-            await self.mqclient.publish(topic, buf, qos=1, sync=last)
+            pb = self.mqclient.get_buf(BUFLEN + 2)
+            n = stream.readinto(pb.data[2 : BUFLEN + 2]) or 0
+            last = n == 0
+            struct.pack_into("!H", pb.data, 0, last << 15 | seq)
+            pb.len = n + 2
+            log.debug("pub {} -> {}".format(pb.len, topic))
+            await self.mqclient.publish_buf(topic, pb, qos=1, sync=last)
             if last:
                 stream.close()
                 return None
-            buf[2:] = stream.read(BUFLEN)
             seq += 1
 
     # Callback handlers
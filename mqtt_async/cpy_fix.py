@@ -17,19 +17,184 @@ def is_awaitable(f): return inspect.isawaitable(f)
 async def async_sleep_ms(ms): await asyncio.sleep(ms/1000)
 asyncio.sleep_ms = async_sleep_ms
 
+# MicroPython's logging has Logger.exc(e, msg) to log an exception with its traceback
+import logging
+logging.Logger.exc = lambda self, e, msg, *args: self.error(msg, *args, exc_info=e)
+
+# _own returns data that may be handed to an asyncio transport: the transports may hang on to what
+# they are given until the socket accepts it, which can be after drain returns, so a memoryview
+# into a buffer that gets reused (a PubBuf, the buffer of publish_stream) has to be copied.
+# MicroPython's streams copy the data on write.
+def _own(b): return bytes(b) if isinstance(b, memoryview) else b
+
 class StreamReadWriter:
     def __init__(self, sr, sw):
         self.sr = sr
         self.sw = sw
     async def read(self, n): return await self.sr.read(n)
-    def write(self, b): self.sw.write(b)
+    async def readinto(self, buf):
+        b = await self.sr.read(len(buf))
+        buf[:len(b)] = b
+        return len(b)
+    def write(self, b): self.sw.write(_own(b))
     async def drain(self): await self.sw.drain()
     def close(self): self.sw.close()
     async def wait_closed(self): await self.sw.wait_closed()
+    def get_extra_info(self, name): return self.sw.get_extra_info(name)
+
+# ProtocolStream is an asyncio.Protocol providing the same interface as StreamReadWriter without
+# going through StreamReader and StreamWriter: data_received copies incoming data straight into
+# the buffer passed to a pending readinto (MQTTProto's receive buffer) and only holds on to data
+# that arrives while nobody is reading, write goes straight to transport.write (see _own), and
+# drain only waits while the transport has paused writing. Reading is paused while more than _HIGH
+# bytes are held.
+class ProtocolStream(asyncio.Protocol):
+    _HIGH = 65536
+
+    def __init__(self):
+        self._transport = None
+        self._data = bytearray()  # data received while no readinto was pending
+        self._buf = None          # buffer of the pending readinto
+        self._rwait = None        # future of the pending readinto, result: bytes read
+        self._wwait = None        # future of the pending drain
+        self._wpaused = False
+        self._rpaused = False
+        self._eof = False
+        self._exc = None          # exception that closed the connection
+        self._closed = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport): self._transport = transport
+
+    def data_received(self, data):
+        if self._rwait is not None and not self._rwait.done():
+            n = min(len(data), len(self._buf))
+            self._buf[:n] = data if n == len(data) else memoryview(data)[:n]
+            self._rwait.set_result(n)
+            if n == len(data):
+                return
+            data = memoryview(data)[n:]
+        self._data += data
+        if len(self._data) > self._HIGH and not self._rpaused:
+            self._rpaused = True
+            self._transport.pause_reading()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake(self._rwait, 0)
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._exc = exc
+        self._wake(self._rwait, 0)
+        self._wake(self._wwait, None)
+        self._wake(self._closed, None)
+
+    def pause_writing(self): self._wpaused = True
+
+    def resume_writing(self):
+        self._wpaused = False
+        self._wake(self._wwait, None)
+
+    def _wake(self, fut, res):
+        if fut is not None and not fut.done():
+            if self._exc is not None and fut is not self._closed:
+                fut.set_exception(self._exc)
+            else:
+                fut.set_result(res)
+
+    async def readinto(self, buf):
+        n = len(self._data)
+        if n == 0:
+            if self._eof:
+                if self._exc is not None:
+                    raise self._exc
+                return 0
+            self._buf = buf
+            self._rwait = asyncio.get_event_loop().create_future()
+            try:
+                return await self._rwait
+            finally:
+                self._buf = self._rwait = None
+        n = min(n, len(buf))
+        with memoryview(self._data) as mv:
+            buf[:n] = mv[:n]
+        del self._data[:n]
+        if self._rpaused and len(self._data) < self._HIGH // 2:
+            self._rpaused = False
+            self._transport.resume_reading()
+        return n
+
+    def write(self, b):
+        if self._exc is not None:
+            raise self._exc
+        self._transport.write(_own(b))
+
+    async def drain(self):
+        if self._exc is not None:
+            raise self._exc
+        if self._transport.is_closing():
+            await asyncio.sleep(0)  # let connection_lost run, as StreamWriter.drain does
+        if self._wpaused and not self._closed.done():
+            self._wwait = asyncio.get_event_loop().create_future()
+            try:
+                await self._wwait
+            finally:
+                self._wwait = None
+        if self._closed.done():
+            raise self._exc or ConnectionResetError("Connection lost")
+
+    def close(self): self._transport.close()
+    async def wait_closed(self): await self._closed
+    def get_extra_info(self, name): return self._transport.get_extra_info(name)
+
+import ssl as _ssl
+
+# _SessionContext wraps an SSLContext in order to resume a TLS session: asyncio doesn't provide a
+# way to pass the session through to SSLContext.wrap_bio.
+class _SessionContext:
+    def __init__(self, ctx, session):
+        self._ctx = ctx
+        self._session = session
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None):
+        return self._ctx.wrap_bio(incoming, outgoing, server_side, server_hostname,
+                session=self._session)
+    def __getattr__(self, name):
+        return getattr(self._ctx, name)
+
+# TRANSPORT selects how open_connection connects: "protocol" returns a ProtocolStream, "stream"
+# returns a StreamReadWriter on top of asyncio's streams.
+TRANSPORT = "protocol"
+
+# open_connection opens a TCP or TLS connection. ssl may be True, an SSLContext, or a dict in MP
+# style with an optional server_hostname. session must be a session returned by get_tls_session,
+# it carries the SSLContext to use because a session can only be resumed by the same context.
+async def open_connection(addr, ssl, session=None):
+    hostname = None
+    if ssl:
+        if isinstance(ssl, dict):
+            hostname = ssl.get("server_hostname")
+        if session is not None:
+            ssl = _SessionContext(*session)
+        elif not isinstance(ssl, _ssl.SSLContext):
+            ssl = _ssl.create_default_context()
+    if TRANSPORT == "stream":
+        (sr, sw) = await asyncio.open_connection(addr[0], addr[1], ssl=ssl or None,
+                server_hostname=hostname)
+        return StreamReadWriter(sr, sw)
+    _, ps = await asyncio.get_event_loop().create_connection(ProtocolStream, addr[0], addr[1],
+            ssl=ssl or None, server_hostname=hostname)
+    return ps
+
+# get_tls_session returns a (session, resumed) tuple for a connection made by open_connection
+def get_tls_session(stream):
+    so = stream.get_extra_info("ssl_object")
+    if so is None:
+        return None, None
+    session = (so.context, so.session) if so.session is not None else None
+    return session, so.session_reused
 
-async def open_connection(addr, ssl):
-    (sr, sw) = await asyncio.open_connection(addr[0], addr[1], ssl=ssl)
-    return StreamReadWriter(sr, sw)
+async def getaddrinfo(host, port):
+    return await asyncio.get_event_loop().getaddrinfo(host, port)
 
 class __interface:
     def __init__(self): self.connected = False
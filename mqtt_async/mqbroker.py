@@ -0,0 +1,521 @@
+# MQTT 3.1.1 broker stand-in for testing and benchmarking mqtt_async
+# Copyright © 2020 by Thorsten von Eicken.
+# MQTTBroker is a small asyncio broker for CPython that supports QoS 0 and 1, retained messages,
+# wildcard subscriptions, persistent sessions, and last will messages, which is enough to run the
+# mqtt_async tests and benchmarks without a real broker. It can also degrade the connection to each
+# client by adding latency, capping the bandwidth, dropping packets, and resetting connections.
+# QoS 2 is not supported: subscriptions are granted QoS 1 and QoS 2 publishes close the connection.
+# Run it standalone using: python3 mqbroker.py [--port N] [--latency MS] [--bandwidth B/S] ...
+
+import asyncio, os, random, threading
+from collections import deque
+import logging
+
+log = logging.getLogger(__name__)
+
+_QUEUE_MAX = 1000  # max QoS 1 messages queued for a disconnected persistent session
+
+# match returns whether the topic matches the subscription filter, both are lists of levels.
+def match(filt, topic):
+    if topic[0][:1] == "$" and filt[0] in ("+", "#"):
+        return False  # wildcards don't match $SYS and the like
+    for i, f in enumerate(filt):
+        if f == "#":
+            return True
+        if i >= len(topic) or (f != "+" and f != topic[i]):
+            return False
+    return len(filt) == len(topic)
+
+
+# valid_filter returns whether a subscription filter is well-formed.
+def valid_filter(filt):
+    levels = filt.split("/")
+    for i, f in enumerate(levels):
+        if ("#" in f and (f != "#" or i != len(levels) - 1)) or ("+" in f and f != "+"):
+            return False
+    return filt != ""
+
+
+# publish_pkt returns the wire format of a PUBLISH packet.
+def publish_pkt(topic, msg, qos, retain, pid=0, dup=False):
+    var = len(topic).to_bytes(2, "big") + topic
+    if qos:
+        var += pid.to_bytes(2, "big")
+    return packet(0x30 | dup << 3 | qos << 1 | retain, var + msg)
+
+
+# packet returns the wire format of a packet given its first byte and its body.
+def packet(op, body):
+    hdr = bytearray([op])
+    n = len(body)
+    while True:
+        hdr.append((n & 0x7F) | (0x80 if n > 0x7F else 0))
+        n >>= 7
+        if not n:
+            return bytes(hdr) + body
+
+
+# Session holds the state of a client that persists across connections unless the client connects
+# with clean set: its subscriptions and the QoS 1 messages that are queued or not yet acked.
+class Session:
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.subs = {}  # filter str -> (list of levels, granted qos)
+        self.queue = deque()  # (topic, msg, qos, retain) to send once connected
+        self.inflight = {}  # pid -> (topic, msg, retain) sent and waiting for the PUBACK
+        self.pid = 0
+        self.conn = None
+
+    def next_pid(self):
+        while True:
+            self.pid = self.pid % 0xFFFF + 1
+            if self.pid not in self.inflight:
+                return self.pid
+
+
+# Link delivers packets in one direction of a connection after the latency and at the bandwidth
+# found in the knobs object (the broker, or the proxy in mqproxy.py), it calls deliver in order for
+# each packet once it is due.
+class Link:
+    def __init__(self, knobs, deliver):
+        self.knobs = knobs
+        self.deliver = deliver
+        self.q = deque()  # (due time, packet)
+        self.busy = 0  # loop time until which the link is busy transmitting earlier packets
+        self.ev = asyncio.Event()
+        self.task = None
+        self.stopped = False
+
+    def put(self, pkt):
+        if self.stopped:
+            return
+        b = self.knobs
+        if not b.latency and not b.bandwidth and not self.q:
+            self.deliver(pkt)
+            return
+        now = asyncio.get_event_loop().time()
+        if b.bandwidth:
+            self.busy = max(now, self.busy) + len(pkt) / b.bandwidth
+            now = self.busy
+        self.q.append((now + b.latency / 1000, pkt))
+        self.ev.set()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.q:
+                self.ev.clear()
+                await self.ev.wait()
+                continue
+            due, pkt = self.q[0]
+            dt = due - loop.time()
+            if dt > 0:
+                await asyncio.sleep(dt)
+                continue
+            self.q.popleft()
+            self.deliver(pkt)
+
+    def stop(self):
+        self.stopped = True
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# Conn handles one client connection.
+class Conn:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.session = None
+        self.will = None  # (topic, msg, qos, retain)
+        self.keepalive = 0
+        self.closed = False
+        self.out = Link(broker, self._write)
+        self.inp = Link(broker, self._handle)
+
+    def _write(self, pkt):
+        if not self.closed:
+            self.writer.write(pkt)
+
+    # send queues a packet to the client, subject to drops.
+    def send(self, pkt):
+        b = self.broker
+        if b.drop and pkt[0] != 0x20 and b.rand.random() < b.drop:
+            b.stats["dropped"] += 1
+            return
+        b.stats["pkts_out"] += 1
+        self.out.put(pkt)
+
+    # close closes the connection, publishing the last will unless the client disconnected cleanly,
+    # with abort the TCP connection is reset rather than closed gracefully.
+    def close(self, abort=False):
+        if self.closed:
+            return
+        self.closed = True
+        self.out.stop()
+        self.inp.stop()
+        if abort:
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+        s = self.session
+        if s is not None and s.conn is self:
+            s.conn = None
+            if s.clean:
+                self.broker.sessions.pop(s.client_id, None)
+        if self.will is not None:
+            self.broker.publish(*self.will)
+            self.will = None
+
+    async def run(self):
+        b = self.broker
+        try:
+            while not self.closed:
+                if self.keepalive:
+                    pkt = await asyncio.wait_for(self._read(), self.keepalive * 1.5)
+                else:
+                    pkt = await self._read()
+                if b.reset and b.rand.random() < b.reset:
+                    b.stats["resets"] += 1
+                    self.close(abort=True)
+                    break
+                if b.drop and pkt[0] not in (0x10, 0xE0) and b.rand.random() < b.drop:
+                    b.stats["dropped"] += 1
+                    continue
+                b.stats["pkts_in"] += 1
+                self.inp.put(pkt)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            log.exception("broker: %s", e)
+        self.close()
+
+    async def _read(self):
+        op = (await self.reader.readexactly(1))[0]
+        n = sh = 0
+        while True:
+            c = (await self.reader.readexactly(1))[0]
+            n |= (c & 0x7F) << sh
+            sh += 7
+            if not c & 0x80:
+                break
+            if sh > 21:
+                raise ValueError("bad remaining length")
+        return bytes([op]) + await self.reader.readexactly(n)
+
+    # _handle processes one packet from the client, the first byte is the packet type and flags.
+    def _handle(self, pkt):
+        if self.closed:
+            return
+        op, body = pkt[0], memoryview(pkt)[1:]
+        typ = op >> 4
+        if self.session is None:
+            if typ != 1:
+                return self.close()
+            return self._connect(body)
+        if typ == 3:
+            self._publish(op, body)
+        elif typ == 4:
+            self.session.inflight.pop(body[0] << 8 | body[1], None)
+        elif typ == 8:
+            self._subscribe(body)
+        elif typ == 10:
+            i = 2
+            while i < len(body):
+                tl = body[i] << 8 | body[i + 1]
+                self.session.subs.pop(str(body[i + 2 : i + 2 + tl], "utf-8"), None)
+                i += 2 + tl
+            self.send(packet(0xB0, bytes(body[:2])))
+        elif typ == 12:
+            self.send(b"\xd0\0")
+        elif typ == 14:
+            self.will = None
+            self.close()
+        else:
+            self.close()  # QoS 2 flow, duplicate CONNECT, or garbage
+
+    def _connect(self, body):
+        b = self.broker
+        i = 2 + (body[0] << 8 | body[1])
+        proto, level, flags = bytes(body[2:i]), body[i], body[i + 1]
+        self.keepalive = body[i + 2] << 8 | body[i + 3]
+        i += 4
+        if (proto, level) not in ((b"MQTT", 4), (b"MQIsdp", 3)):
+            self._write(b"\x20\x02\0\x01")  # unacceptable protocol version
+            return self.close()
+
+        def field():
+            nonlocal i
+            n = body[i] << 8 | body[i + 1]
+            i += 2 + n
+            return bytes(body[i - n : i])
+
+        client_id = str(field(), "utf-8")
+        clean = bool(flags & 2)
+        will = None
+        if flags & 4:
+            wt = field()
+            will = (wt, field(), (flags >> 3) & 3, bool(flags & 0x20))
+        user = str(field(), "utf-8") if flags & 0x80 else None
+        pwd = field() if flags & 0x40 else None
+        if client_id == "":
+            if not clean:
+                self._write(b"\x20\x02\0\x02")  # identifier rejected
+                return self.close()
+            b.anon += 1
+            client_id = "mqbroker-anon-{}".format(b.anon)
+        if b.users is not None:
+            if user is None or user not in b.users:
+                self._write(b"\x20\x02\0\x05")  # not authorized
+                return self.close()
+            pw = b.users[user]
+            if (pw.encode() if isinstance(pw, str) else pw) != (pwd or b""):
+                self._write(b"\x20\x02\0\x04")  # bad user name or password
+                return self.close()
+        b.stats["connects"] += 1
+        old = b.sessions.get(client_id)
+        if old is not None and old.conn is not None:
+            old.conn.close()  # take-over, publishes the will of the old connection
+            old = b.sessions.get(client_id)
+        present = old is not None and not clean
+        if not present:
+            old = Session(client_id, clean)
+            b.sessions[client_id] = old
+        old.clean = clean
+        old.conn = self
+        self.session = old
+        self.will = will
+        self._write(bytes([0x20, 2, present, 0]))
+        # resend unacked messages and then the ones queued while disconnected
+        for pid, (topic, msg, retain) in old.inflight.items():
+            self.send(publish_pkt(topic, msg, 1, retain, pid, dup=True))
+        while old.queue:
+            self.deliver(old, *old.queue.popleft())
+
+    def _publish(self, op, body):
+        qos, retain = (op >> 1) & 3, op & 1
+        tl = body[0] << 8 | body[1]
+        topic = bytes(body[2 : 2 + tl])
+        i = 2 + tl
+        if qos > 1 or b"+" in topic or b"#" in topic:
+            return self.close()
+        if qos:
+            self.send(bytes([0x40, 2, body[i], body[i + 1]]))
+            i += 2
+        self.broker.publish(topic, bytes(body[i:]), qos, retain)
+
+    def _subscribe(self, body):
+        b = self.broker
+        s = self.session
+        i, codes, new = 2, bytearray(), []
+        while i < len(body):
+            tl = body[i] << 8 | body[i + 1]
+            filt = str(body[i + 2 : i + 2 + tl], "utf-8")
+            qos = body[i + 2 + tl]
+            i += 3 + tl
+            if not valid_filter(filt) or qos > 2:
+                codes.append(0x80)
+                continue
+            qos = min(qos, 1)
+            levels = filt.split("/")
+            s.subs[filt] = (levels, qos)
+            codes.append(qos)
+            new.append((levels, qos))
+        self.send(packet(0x90, bytes(body[:2]) + codes))
+        for topic, (msg, rqos) in b.retained.items():
+            levels = str(topic, "utf-8").split("/")
+            q = max((q for f, q in new if match(f, levels)), default=-1)
+            if q >= 0:
+                self.deliver(s, topic, msg, min(q, rqos), True)
+
+    # deliver sends a message to the client of a session, or queues it if the client isn't connected.
+    def deliver(self, s, topic, msg, qos, retain):
+        if qos:
+            pid = s.next_pid()
+            s.inflight[pid] = (topic, msg, retain)
+            self.send(publish_pkt(topic, msg, 1, retain, pid))
+        else:
+            self.send(publish_pkt(topic, msg, 0, retain))
+
+
+# MQTTBroker is the broker, the knobs to degrade connections may be changed at any time:
+# latency: in milliseconds, added to each packet in each direction,
+# bandwidth: in bytes per second, max rate of each direction of each connection, 0: unlimited,
+# drop: fraction of packets silently discarded in each direction (except CONNECT and CONNACK),
+# reset: fraction of the packets received that make the broker reset the connection instead.
+# users: if not None, a dict of user name to password that clients must authenticate with.
+class MQTTBroker:
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0, bandwidth=0, drop=0, reset=0, users=None, seed=None
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop = drop
+        self.reset = reset
+        self.users = users
+        self.rand = random.Random(seed)
+        self.sessions = {}  # client_id -> Session
+        self.retained = {}  # topic -> (msg, qos)
+        self.conns = {}  # Conn -> task running it
+        self.anon = 0
+        self.stats = dict.fromkeys(
+            ("connects", "pkts_in", "pkts_out", "published", "dropped", "resets"), 0
+        )
+        self.addr = None
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    # start starts the broker in the running event loop and returns its (host, port) address.
+    async def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.addr = self._server.sockets[0].getsockname()[:2]
+        return self.addr
+
+    async def stop(self):
+        self._server.close()
+        tasks = list(self.conns.values())
+        for c in list(self.conns):
+            c.close(abort=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _accept(self, reader, writer):
+        c = Conn(self, reader, writer)
+        self.conns[c] = asyncio.current_task()
+        try:
+            await c.run()
+        finally:
+            del self.conns[c]
+
+    # publish routes a message to the subscribed sessions and handles the retained flag.
+    def publish(self, topic, msg, qos, retain):
+        self.stats["published"] += 1
+        if retain:
+            if msg:
+                self.retained[topic] = (msg, qos)
+            else:
+                self.retained.pop(topic, None)
+        levels = str(topic, "utf-8").split("/")
+        for s in list(self.sessions.values()):
+            q = max((q for f, q in s.subs.values() if match(f, levels)), default=-1)
+            if q < 0:
+                continue
+            q = min(q, qos)
+            if s.conn is not None:
+                s.conn.deliver(s, topic, msg, q, False)
+            elif q:
+                if len(s.queue) >= _QUEUE_MAX:
+                    s.queue.popleft()
+                s.queue.append((topic, msg, q, False))
+
+    # kick resets the connection of a client, or of all clients if client_id is None, it may be
+    # called from any thread.
+    def kick(self, client_id=None):
+        def k():
+            for c in list(self.conns):
+                if client_id is None or (c.session and c.session.client_id == client_id):
+                    self.stats["resets"] += 1
+                    c.close(abort=True)
+
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._loop.call_soon_threadsafe(k)
+        else:
+            k()
+
+    # start_thread runs the broker in an event loop in a new thread, so it's independent of the event
+    # loops of the tests using it, and returns its (host, port) address.
+    def start_thread(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop())
+            tasks = asyncio.all_tasks(self._loop)
+            for t in tasks:
+                t.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.addr
+
+    def stop_thread(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+
+_shared = None
+
+# shared_broker returns the address of the broker for tests and benchmarks: the one in the
+# MQTT_BROKER environment variable (host or host:port) if set, else a broker running in a
+# background thread of this process.
+def shared_broker():
+    global _shared
+    env = os.environ.get("MQTT_BROKER")
+    if env:
+        host, _, port = env.partition(":")
+        return (host, int(port or 1883))
+    if _shared is None:
+        _shared = MQTTBroker()
+        _shared.start_thread()
+    return _shared.addr
+
+
+# spawn_broker runs a broker with the given knobs in a child process, so it doesn't compete for the
+# GIL with the process being measured, and returns the process and the broker's address.
+def spawn_broker(**knobs):
+    import multiprocessing
+
+    rd, wr = multiprocessing.Pipe(False)
+    proc = multiprocessing.Process(target=_serve, args=(wr, knobs), daemon=True)
+    proc.start()
+    return proc, rd.recv()
+
+
+def _serve(pipe, knobs):
+    broker = MQTTBroker(**knobs)
+
+    async def main():
+        pipe.send(await broker.start())
+        await broker._server.serve_forever()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="MQTT 3.1.1 broker stand-in")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=1883)
+    ap.add_argument("--latency", type=float, default=0, help="ms added to each packet")
+    ap.add_argument("--bandwidth", type=float, default=0, help="bytes/s per direction")
+    ap.add_argument("--drop", type=float, default=0, help="fraction of packets dropped")
+    ap.add_argument("--reset", type=float, default=0, help="fraction of packets causing a reset")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    broker = MQTTBroker(**vars(args))
+
+    async def main():
+        log.info("mqbroker listening on %s:%d", *await broker.start())
+        await broker._server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+# Fault-injecting TCP proxy for testing and benchmarking the recovery of mqtt_async
+# Copyright © 2020 by Thorsten von Eicken.
+# FaultProxy forwards TCP connections to a target, such as a broker, and can be told at any point
+# to break the connections going through it in the ways real networks do:
+# reset: both ends get a TCP RST,
+# half_close: the client gets a FIN but the connection stays open otherwise,
+# stall: nothing is forwarded anymore but the connection stays open, as when a NAT entry is lost,
+# blackhole: everything is discarded, including new connections, as when the uplink is down,
+# latency: each chunk of data is delayed by the given number of milliseconds.
+# reset, half_close, and stall only affect the connections open at the time, new connections work
+# normally. blackhole and latency last until heal is called.
+# Runs under CPython only.
+
+import asyncio, logging
+from mqbroker import Link
+
+log = logging.getLogger(__name__)
+
+FAULTS = ("reset", "half_close", "stall", "blackhole", "latency")
+
+# Pipe is one proxied connection, it forwards data in each direction through a Link so latency
+# can be added.
+class Pipe:
+    def __init__(self, proxy, reader, writer):
+        self.proxy = proxy
+        self.cr, self.cw = reader, writer  # client side
+        self.br = self.bw = None  # broker side
+        self.mode = None  # fault applied to this connection, None: forwarding normally
+        self.resume = asyncio.Event()  # set while not stalled or once closed
+        self.closed = False
+
+    async def run(self):
+        try:
+            self.br, self.bw = await asyncio.open_connection(*self.proxy.target)
+        except OSError as e:
+            log.info("proxy: cannot connect to %s: %s", self.proxy.target, e)
+            self.cw.transport.abort()
+            return
+        self.resume.set()
+        up = Link(self.proxy, self.bw.write)
+        down = Link(self.proxy, self._down)
+        try:
+            await asyncio.gather(self._pump(self.cr, self.bw, up), self._pump(self.br, self.cw, down))
+        finally:
+            up.stop()
+            down.stop()
+            self.close()
+
+    def _down(self, data):
+        if self.mode != "half_close":
+            self.cw.write(data)
+
+    async def _pump(self, reader, writer, link):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if self.mode == "stall":
+                    await self.resume.wait()  # hold on to the data, the connection is dead
+                if self.closed:
+                    return
+                if not data:
+                    if self.mode is None and not self.proxy.blackhole:
+                        writer.write_eof()
+                    return
+                if self.mode == "blackhole" or self.proxy.blackhole:
+                    continue
+                link.put(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            self.close(abort=True)
+
+    # fault applies a fault to the connection.
+    def fault(self, kind):
+        if kind == "reset":
+            self.close(abort=True)
+        elif kind == "half_close":
+            self.mode = kind
+            self.cw.write_eof()
+        elif kind in ("stall", "blackhole"):
+            self.mode = kind
+            self.resume.clear()
+
+    def close(self, abort=False):
+        self.closed = True
+        self.resume.set()
+        for w in (self.cw, self.bw):
+            if w is not None and not w.transport.is_closing():
+                if abort:
+                    w.transport.abort()
+                else:
+                    w.close()
+
+
+# FaultProxy listens on a local port and forwards each connection to the target (host, port).
+class FaultProxy:
+    def __init__(self, target, host="127.0.0.1", port=0):
+        self.target = target
+        self.host = host
+        self.port = port
+        self.latency = 0  # ms, for Link
+        self.bandwidth = 0  # for Link, unused
+        self.blackhole = False
+        self.pipes = {}  # Pipe -> task running it
+        self.stats = dict.fromkeys(("accepts",) + FAULTS, 0)
+        self.addr = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.addr = self._server.sockets[0].getsockname()[:2]
+        return self.addr
+
+    async def stop(self):
+        self._server.close()
+        tasks = list(self.pipes.values())
+        for p in list(self.pipes):
+            p.close(abort=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _accept(self, reader, writer):
+        self.stats["accepts"] += 1
+        p = Pipe(self, reader, writer)
+        self.pipes[p] = asyncio.current_task()
+        try:
+            if self.blackhole:
+                p.mode = "blackhole"  # swallow the CONNECT, the client has to time out
+                while not reader.at_eof():
+                    await reader.read(65536)
+            else:
+                await p.run()
+        finally:
+            del self.pipes[p]
+
+    # fault injects a fault, latency is in milliseconds for the latency fault.
+    def fault(self, kind, latency=0):
+        if kind not in FAULTS:
+            raise ValueError("unknown fault: " + kind)
+        self.stats[kind] += 1
+        if kind == "latency":
+            self.latency = latency
+        elif kind == "blackhole":
+            self.blackhole = True
+        for p in list(self.pipes):
+            p.fault(kind)
+
+    # heal ends the blackhole and latency faults, connections that were reset, half-closed,
+    # stalled, or blackholed stay broken.
+    def heal(self):
+        self.blackhole = False
+        self.latency = 0
+
+    # script runs a list of (seconds, kind) steps, sleeping the seconds before injecting the fault
+    # kind, which may also be "heal" or ("latency", ms).
+    async def script(self, steps):
+        for delay, kind in steps:
+            await asyncio.sleep(delay)
+            if kind == "heal":
+                self.heal()
+            elif isinstance(kind, tuple):
+                self.fault(*kind)
+            else:
+                self.fault(kind)
@@ -11,12 +11,18 @@
 # The imports below are a little tricky in order to support operation under Micropython as well as
 # Linux CPython. The latter is used for tests.
 
+import os
 import socket
 import struct
 import sys
 from binascii import hexlify
 from errno import EINPROGRESS
 
+try:
+    from random import getrandbits
+except ImportError:
+    from urandom import getrandbits
+
 try:
     # imports used with Micropython
     # on Unix might need to set MICROPYPATH env var to locate extmod
@@ -24,9 +30,18 @@ try:
     from time import ticks_ms, ticks_diff
     import uasyncio as asyncio
 
-    async def open_connection(addr, ssl):
+    # MP's ssl module doesn't support session resumption, the session parameter is ignored and
+    # get_tls_session returns no session
+    async def open_connection(addr, ssl, session=None):
         return (await asyncio.open_connection(addr[0], addr[1], ssl=ssl))[0]
 
+    def get_tls_session(stream):
+        return None, None
+
+    # there is no non-blocking getaddrinfo in MP, DNSCache minimizes how often this gets called
+    async def getaddrinfo(host, port):
+        return socket.getaddrinfo(host, port)
+
     try:
         from machine import unique_id
 
@@ -66,11 +81,15 @@ except ImportError:
 # Timing parameters and constants
 
 # Response time of the broker to requests, such as pings, before MQTTClient deems the connection
-# to be broken and tries to reconnect. MQTTClient issues an explicit ping if there is no
-# outstanding request to the broker for half the response time. This means that if the connection
-# breaks and there is no outstanding request it could take up to 1.5x the response time until
-# MQTTClient notices.
+# to be broken and tries to reconnect.
 # Specified in MQTTConfig.response_time, suggested to be in the range of 60s to a few minutes.
+# The time MQTTClient actually waits for a response adapts to the measured round-trip time, like
+# TCP's retransmission timeout, it is bounded by MQTTConfig.min_response_time and response_time.
+# MQTTClient issues an explicit ping if nothing has been received from the broker for twice that
+# timeout (at most response_time). This means that if the connection breaks and there is no
+# outstanding request it takes up to 3x the timeout until MQTTClient notices.
+# _RTT_GRANULARITY_MS is the minimum margin added to the smoothed RTT.
+_RTT_GRANULARITY_MS = const(50)
 
 # Connection time-out when establishing an MQTT connection to the broker:
 # Specified in MQTTConfig.conn_timeout in seconds
@@ -80,14 +99,48 @@ except ImportError:
 # greater than 2x the response time.
 # Specified in MQTTConfig.keepalive
 
-# Default long delay in seconds when waiting for a connection to be re-established.
+# Default long delay in seconds between attempts to re-establish a connection. (Tasks waiting for
+# the connection are woken up as soon as it is up.)
 # Can be overridden in tests to make things go faster
 _CONN_DELAY = const(1)
 
+# Size of the receive buffer allocated by each MQTTProto. Packets that fit are parsed in-place,
+# larger payloads get a buffer of their own.
+_RBUF_LEN = const(1536)
+
+# Size of the buffer used to copy data from an MQTTStream to the socket.
+_STREAM_BUF_LEN = const(1024)
+
+# Size of the write buffer in which MQTTProto gathers small outgoing packets (PUBACKs, pings, small
+# publishes) so they go out in a single TCP segment / TLS record. It matches the MSS used by
+# publish. Packets that don't need to go out immediately sit in the buffer for at most _WFLUSH_MS.
+_WBUF_LEN = const(1440)
+_WFLUSH_MS = const(5)
+_PUB_HEADROOM = const(128)  # default space reserved in a PubBuf for the header
+
+# MQTT 5 property identifiers by type of value, properties not listed are strings or binary data,
+# except for user properties (0x26), which are string pairs.
+_PROP_BYTE = b"\x01\x17\x19\x24\x25\x28\x29\x2a"
+_PROP_U16 = b"\x13\x21\x22\x23"
+_PROP_U32 = b"\x02\x11\x18\x27"
+_PROP_VARINT = b"\x0b"
+
+# Priorities of messages queued by MQTTClient.publish while there is no connection, when the queue
+# is full droppable messages are dropped first, then normal ones, and critical ones last.
+PUB_DROPPABLE = const(0)
+PUB_NORMAL = const(1)
+PUB_CRITICAL = const(2)
+
+# ACK_LATER can be returned by the subs_cb passed to MQTTProto (or by the coroutine it returns) to
+# hold back the PUBACK of a QoS 1 message, which then has to be sent using MQTTProto.puback.
+ACK_LATER = object()
+
 # Error strings used with OSError(-1, ...) for internally raised errors.
 CONN_CLOSED = "Connection closed"
 CONN_TIMEOUT = "Connection timed out"
 PROTO_ERROR = "Protocol error"
+DNS_FAILED = "DNS lookup failed"
+CONN_REFUSED = "CONNECT refused"
 CONN_ERRS = ["inv proto vers", "client_id rejected", "srv down", "user/pass malformed", "not auth"]
 
 # config holds the default values for all configuration items.
@@ -95,19 +148,35 @@ config = {
     "client_id": hexlify(unique_id()),
     "server": None,
     "port": 0,
+    "servers": None,  # failover list of brokers: hostnames or (hostname, port) tuples
+    "failover": 2,  # consecutive failed connection attempts after which a broker is deemed down
+    "holddown": 300,  # in seconds, how long a broker that is down is avoided
+    "standby": 0,  # in seconds, >0: keep a connection open to the next broker, reopen at interval
     "user": None,
     "password": b"",
-    "response_time": 10,  # in seconds
+    "response_time": 10,  # in seconds, max time to wait for a response from the broker
+    "min_response_time": 2,  # in seconds, min time to wait for a response from the broker
     "keepalive": 600,  # in seconds, only sent if self.will != None
     "ssl_params": None,
     "interface": STA_IF,
     "clean": True,
     "will": None,  # last will message, must be MQTTMessage
     "subs_cb": lambda *_: None,  # callback when message arrives for a subscription
+    "inbound": 0,  # number of tasks running the handlers of incoming messages, 0: run by reader
+    "inbound_size": 8192,  # bytes of incoming messages queued for the inbound tasks
+    "ack_early": False,  # inbound tasks: PUBACK messages when queued rather than when handled
     "wifi_coro": None,  # notification when MQTT connects/disconnects
     "connect_coro": None,  # notification when MQTT first becomes ready
     "ssid": None,
     "wifi_pw": None,
+    "max_inflight": 1,  # max number of unacked QoS 1 publishes when publish(sync=False) returns
+    "dns_ttl": 3600,  # in seconds, how long the broker's address is cached
+    "backoff": None,  # reconnection scheduler, None to use a Backoff with default policies
+    "buf_pool": 4,  # max number of idle PubBufs kept by get_buf for reuse
+    "outbox": None,  # Outbox persisting unacked QoS 1 publishes across resets
+    "queue_size": 0,  # bytes of messages publish queues while disconnected, 0: publish blocks
+    "mqtt5": False,  # use MQTT 5.0 instead of 3.1.1
+    "session_expiry": 0xFFFFFFFF,  # MQTT 5 only: in seconds, how long the broker keeps the session
     # The following are not currently supported:
     # "sock_cb"         : None,            # callback for esp32 socket to allow bg operation
     # "listen_interval" : 0,               # Wifi listen interval for power save
@@ -130,6 +199,95 @@ def _qos_check(qos):
         raise ValueError("unsupported qos")
 
 
+# _TopicTrie holds handlers for subscription topic filters in a tree with one level per topic
+# level, so matching a topic costs O(topic depth) rather than O(number of filters). Each node is a
+# list [children, handlers, chunk_cb] where children is a dict mapping a topic level (bytes, incl.
+# the b"+" and b"#" wildcards) to a node. Filters and topics are bytes and are never decoded.
+class _TopicTrie:
+    def __init__(self):
+        self._root = [{}, [], None]
+
+    # add registers a handler and/or a chunk callback for the topic filter, a handler that is already
+    # registered for the filter is not added again
+    def add(self, filt, cb=None, chunk_cb=None):
+        node = self._root
+        for lvl in filt.split(b"/"):
+            nxt = node[0].get(lvl)
+            if nxt is None:
+                nxt = node[0][lvl] = [{}, [], None]
+            node = nxt
+        if cb is not None and cb not in node[1]:
+            node[1].append(cb)
+        if chunk_cb is not None:
+            node[2] = chunk_cb
+
+    # remove drops all handlers and the chunk callback for the topic filter and prunes the tree
+    def remove(self, filt):
+        path = []
+        node = self._root
+        for lvl in filt.split(b"/"):
+            path.append((node, lvl))
+            node = node[0].get(lvl)
+            if node is None:
+                return
+        node[1] = []
+        node[2] = None
+        while path and not node[0] and not node[1] and node[2] is None:
+            parent, lvl = path.pop()
+            del parent[0][lvl]
+            node = parent
+
+    # _nodes returns the list of nodes whose filter matches the topic
+    def _nodes(self, topic):
+        res = []
+        nodes = [self._root]
+        wild = topic[:1] != b"$"  # wildcards don't match $SYS & co at the 1st level [MQTT-4.7.2-1]
+        for lvl in topic.split(b"/"):
+            nxt = []
+            for n in nodes:
+                ch = n[0]
+                if wild:
+                    c = ch.get(b"#")
+                    if c is not None:
+                        res.append(c)
+                    c = ch.get(b"+")
+                    if c is not None:
+                        nxt.append(c)
+                c = ch.get(lvl)
+                if c is not None:
+                    nxt.append(c)
+            nodes = nxt
+            if not nodes:
+                return res
+            wild = True
+        for n in nodes:
+            res.append(n)
+            c = n[0].get(b"#")  # "a/#" also matches "a"
+            if c is not None:
+                res.append(c)
+        return res
+
+    # match returns the list of handlers for the topic
+    def match(self, topic):
+        if not self._root[0]:
+            return ()
+        res = []
+        for n in self._nodes(topic):
+            res.extend(n[1])
+        return res
+
+    # chunk_cb returns the chunk callback for the topic or None. If multiple filters with chunk
+    # callbacks match, the most specific one wins (_nodes returns deeper nodes and exact matches
+    # last).
+    def chunk_cb(self, topic):
+        if not self._root[0]:
+            return None
+        for n in reversed(self._nodes(topic)):
+            if n[2] is not None:
+                return n[2]
+        return None
+
+
 class MQTTMessage:
     def __init__(self, topic, message, retain=False, qos=0, pid=None):
         # if qos and pid is None:
@@ -146,6 +304,538 @@ class MQTTMessage:
         self.pid = pid
 
 
+# MQTTStream wraps a data source of known length so it can be published without holding the
+# entire message in memory. The source can be an object with a readinto method, such as a file
+# or io.BytesIO (readinto may also return an awaitable, as in uasyncio.Stream), or an async
+# iterator that produces the data in chunks.
+# QoS 1 messages may have to be retransmitted, which requires a seekable source: the position at
+# the time the MQTTStream is created is recorded and rewind() seeks back to it.
+class MQTTStream:
+    def __init__(self, src, length):
+        self.src = src
+        self.length = length
+        self._pos = src.tell() if hasattr(src, "seek") and hasattr(src, "tell") else None
+
+    def __len__(self):
+        return self.length
+
+    def seekable(self):
+        return self._pos is not None
+
+    # rewind seeks the source back to the start of the message, it's a no-op if not seekable
+    def rewind(self):
+        if self._pos is not None:
+            self.src.seek(self._pos)
+
+
+# PubBuf is a publish buffer with headroom in front of the payload into which MQTTProto writes the
+# MQTT header, so the packet can be sent without copying the payload. The caller fills the payload
+# into `data`, a memoryview of the space after the headroom, and sets `len` to its length. The
+# headroom must fit the fixed header (up to 5 bytes), the topic, the pid, and MQTT 5 properties.
+# PubBufs are normally obtained from MQTTClient.get_buf, which recycles them.
+class PubBuf:
+    def __init__(self, size, headroom=_PUB_HEADROOM):
+        self.buf = bytearray(headroom + size)
+        self.mv = memoryview(self.buf)
+        self.data = self.mv[headroom:]
+        self.head = headroom
+        self.len = 0
+
+    def __len__(self):
+        return self.len
+
+    # payload returns a memoryview of the payload
+    def payload(self):
+        return self.data[: self.len]
+
+
+# DNSCache resolves a hostname and caches the result for ttl seconds. When the entry has expired
+# the stale address is returned right away and a fresh lookup is started in the background, and if
+# a lookup fails the last good address continues to be used. An IP address is never looked up.
+# Note that in MicroPython getaddrinfo is blocking, so a "background" lookup still stalls the
+# event loop, but at least it happens rarely and not when a connection is needed urgently.
+class DNSCache:
+    def __init__(self, host, port, ttl):
+        self.host = host
+        self.port = port
+        self.ttl_ms = ttl * 1000
+        self.addr = None  # last good address
+        self._when = 0  # ticks_ms() of last successful lookup
+        self._task = None  # background lookup in progress
+        # counters
+        self.lookups = 0  # number of getaddrinfo calls
+        self.failures = 0  # number of failed getaddrinfo calls
+        self.hits = 0  # number of resolve() calls answered from cache
+        self.stale = 0  # number of resolve() calls answered with an expired or fallback address
+        self.last_ms = 0  # duration of last getaddrinfo
+        self.max_ms = 0  # max duration of getaddrinfo
+        self.total_ms = 0  # total duration of all getaddrinfo calls
+        self._literal = (host.count(".") == 3 and host.replace(".", "").isdigit()) or ":" in host
+        if self._literal:
+            self.addr = (host, port)
+
+    # _lookup calls getaddrinfo and updates the cache, it returns whether that succeeded
+    async def _lookup(self):
+        self.lookups += 1
+        t0 = ticks_ms()
+        try:
+            addr = (await getaddrinfo(self.host, self.port))[0][-1]
+        except (OSError, IndexError) as e:
+            self.failures += 1
+            log.warning("DNS lookup of %s failed: %s", self.host, e)
+            return False
+        finally:
+            dt = ticks_diff(ticks_ms(), t0)
+            self.last_ms = dt
+            self.total_ms += dt
+            if dt > self.max_ms:
+                self.max_ms = dt
+        log.debug("DNS %s->%s in %dms", self.host, addr, dt)
+        self.addr = addr
+        self._when = ticks_ms()
+        return True
+
+    async def _bg_lookup(self):
+        try:
+            await self._lookup()
+        finally:
+            self._task = None
+
+    # refresh starts a background lookup unless one is already in progress
+    def refresh(self):
+        if self._task is None and not self._literal:
+            self._task = asyncio.get_event_loop().create_task(self._bg_lookup())
+
+    # resolve returns the address of the host. It only waits for a lookup if there is no address
+    # at all, and raises an OSError if that lookup fails.
+    async def resolve(self):
+        if self._literal:
+            self.hits += 1
+            return self.addr
+        if self.addr is None:
+            if not await self._lookup():
+                raise OSError(-1, DNS_FAILED)
+        elif ticks_diff(ticks_ms(), self._when) < self.ttl_ms:
+            self.hits += 1
+        else:
+            self.stale += 1
+            self.refresh()
+        return self.addr
+
+    # stats returns the counters as a dict
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "failures": self.failures,
+            "hits": self.hits,
+            "stale": self.stale,
+            "last_ms": self.last_ms,
+            "max_ms": self.max_ms,
+            "avg_ms": self.total_ms // self.lookups if self.lookups else 0,
+        }
+
+
+# Broker holds what MQTTClient tracks about each broker of its failover list: the address cache,
+# the TLS session to resume, the smoothed time it takes to open a connection, and its health. A
+# broker is down after `failover` consecutive failed connection attempts and becomes eligible
+# again after the hold-down time has passed.
+class Broker:
+    def __init__(self, host, port, dns_ttl):
+        self.host = host
+        self.port = port
+        self.dns = DNSCache(host, port, dns_ttl)
+        self.tls_session = None  # TLS session to resume when reconnecting
+        self.latency_ms = None  # smoothed time to open a TCP (and TLS) connection
+        self.fails = 0  # consecutive failed connection attempts
+        self.down = None  # ticks_ms() when the broker was deemed down, None if healthy
+        self.connects = 0  # number of successful connections
+        self.failures = 0  # number of failed connection attempts
+
+    # sample records the time it took to open a connection, smoothed with a gain of 1/4
+    def sample(self, ms):
+        ms = int(ms)  # the cpy_fix ticks are floats
+        self.latency_ms = ms if self.latency_ms is None else (3 * self.latency_ms + ms) >> 2
+
+    def connected(self):
+        self.connects += 1
+        self.fails = 0
+        self.down = None
+
+    # failed records a failed connection attempt and returns True if that made the broker go down
+    def failed(self, failover):
+        self.failures += 1
+        self.fails += 1
+        if self.down is None and self.fails >= failover:
+            self.down = ticks_ms()
+            return True
+        return False
+
+    # healthy returns whether the broker is up, ending the hold-down if it has expired
+    def healthy(self, holddown_ms):
+        if self.down is not None and ticks_diff(ticks_ms(), self.down) >= holddown_ms:
+            self.down = None
+            self.fails = 0
+        return self.down is None
+
+    def stats(self):
+        return {
+            "host": self.host,
+            "port": self.port,
+            "latency_ms": self.latency_ms,
+            "connects": self.connects,
+            "failures": self.failures,
+            "down": self.down is not None,
+        }
+
+
+# BACKOFF holds the default reconnection back-off policies: for each cause of a failed connection
+# attempt the initial and the maximum delay before the next attempt in units of _CONN_DELAY.
+# The delay doubles with each consecutive failure and is randomized using "full jitter", i.e.,
+# uniformly distributed between zero and the nominal delay, so a fleet of clients that lost their
+# broker at the same time does not hammer it in lock-step when it comes back.
+BACKOFF = {
+    "wifi": (1, 60),  # Wifi association failed
+    "dns": (1, 60),  # no address for the broker
+    "tcp": (1, 60),  # TCP connection failed or timed out
+    "tls": (2, 120),  # TLS handshake failed
+    "connack": (5, 300),  # broker refused the connection, retrying soon is pointless
+}
+
+# Number of consecutive failed broker connection attempts after which Wifi gets reset.
+_ESCALATE = const(3)
+
+# Recovery steps taken by MQTTClient to reconnect, from least to most drastic.
+_STEPS = ("reconnect", "dns", "tls", "failover", "wifi")
+
+# Connect latencies within this many milliseconds are considered equal when picking a broker, the
+# one listed first is preferred.
+_LAT_SLACK_MS = const(10)
+
+
+# _max_step returns the more drastic of two recovery steps, step may be None if there has not been
+# a connection yet, in which case there is nothing to recover.
+def _max_step(step, new):
+    if step is None or _STEPS.index(new) <= _STEPS.index(step):
+        return step
+    return new
+
+
+# _fail_cause classifies an OSError raised by MQTTClient.connect into one of the BACKOFF causes
+# (wifi failures are raised elsewhere). TLS errors are recognized by the SSLError class in CPython
+# and by the negative mbedtls/axtls error codes in MicroPython.
+def _fail_cause(e, tls):
+    err = e.args[0] if e.args else 0
+    msg = e.args[1] if len(e.args) > 1 and isinstance(e.args[1], str) else ""
+    if err == -1 and msg == DNS_FAILED:
+        return "dns"
+    if err == -1 and msg.startswith(CONN_REFUSED):
+        return "connack"
+    if tls and (e.__class__.__name__.startswith("SSL") or (isinstance(err, int) and err < -1)):
+        return "tls"
+    return "tcp"
+
+
+# Backoff schedules reconnection attempts and keeps track of which recovery steps work.
+# MQTTClient calls failed(cause) after each failed attempt, which returns the number of consecutive
+# failures, then sleeps for delay_ms(cause), and calls succeeded(step) once reconnected, where
+# step is the most drastic recovery step that was taken: "reconnect" (just connect again), "dns"
+# (refreshed the broker's address), "tls" (dropped the TLS session), "failover" (switched to
+# another broker), or "wifi" (reset Wifi).
+# An object with the same methods can be passed in config["backoff"] to change the strategy.
+class Backoff:
+    def __init__(self, policies=BACKOFF, unit_ms=None):
+        self.policies = policies
+        self.unit_ms = unit_ms if unit_ms is not None else int(_CONN_DELAY * 1000)
+        self.streak = 0  # consecutive failures since the last success
+        self._attempts = {}  # consecutive failures by cause
+        self.failures = {}  # total failures by cause
+        self.recovered = {}  # successful reconnections by recovery step
+
+    def failed(self, cause):
+        self._attempts[cause] = self._attempts.get(cause, 0) + 1
+        self.failures[cause] = self.failures.get(cause, 0) + 1
+        self.streak += 1
+        return self.streak
+
+    def succeeded(self, step):
+        self._attempts.clear()
+        self.streak = 0
+        self.recovered[step] = self.recovered.get(step, 0) + 1
+
+    # delay_ms returns the randomized delay before the next attempt after a failure due to cause
+    def delay_ms(self, cause):
+        base, cap = self.policies[cause]
+        n = min(self._attempts.get(cause, 1), 16) - 1
+        return self._jitter(min(base << n, cap) * self.unit_ms)
+
+    # _jitter returns a random number between 0 and d (a short int even on 32-bit MicroPython)
+    def _jitter(self, d):
+        return getrandbits(10) * d >> 10
+
+    def stats(self):
+        return {"failures": dict(self.failures), "recovered": dict(self.recovered)}
+
+
+# Outbox persists unacked QoS 1 publishes in a log-structured file so they survive a reset and can
+# be retransmitted after the next boot. Each publish appends a record with the message, each PUBACK
+# appends a 5-byte ack record with the id of the message, so a publish costs two small appends and
+# nothing is ever rewritten in place. When all records are acked and the file has grown to half of
+# max_size it is truncated, which costs no copying. Only if the file would exceed max_size while
+# messages are unacked are the live records copied into a fresh file, the oldest ones being dropped
+# if they don't fit. Wear levelling within the file is left to the filesystem (littlefs on esp32).
+# The file is compacted once when it is loaded at boot, which also gets rid of a torn record at the
+# end.
+_OB_MSG = const(0xA5)  # record: type, retain, u16 topic len, u32 message len, u32 id, topic, msg
+_OB_ACK = const(0x5A)  # record: type, u32 id of the acked message
+_OB_HDR = "<BBHII"
+_OB_HDR_LEN = const(12)
+
+
+class Outbox:
+    def __init__(self, path, max_size=16384):
+        self.path = path
+        self.max_size = max_size
+        self._live = {}  # unacked messages: id -> MQTTMessage
+        self._id = 0  # id of the last message added
+        self._size = 0  # file size
+        self._f = None
+        self.compactions = 0  # number of times live records had to be copied
+        self.resets = 0  # number of times the file was truncated
+        self.dropped = 0  # number of unacked messages dropped because the outbox was full
+
+    # load reads the unacked messages from the file and returns them as list of (id, MQTTMessage)
+    # in their original order. The file is only compacted if it contains acks or a torn record,
+    # or no longer fits, so booting doesn't cause a flash write.
+    def load(self):
+        live = {}
+        acks = False
+        try:
+            with open(self.path, "rb") as f:
+                buf = f.read()
+        except OSError:
+            buf = b""
+        off = 0
+        while off + 5 <= len(buf):
+            if buf[off] == _OB_ACK:
+                live.pop(struct.unpack_from("<I", buf, off + 1)[0], None)
+                off += 5
+                acks = True
+                continue
+            if buf[off] != _OB_MSG or off + _OB_HDR_LEN > len(buf):
+                break  # torn or corrupt record: ignore the rest
+            _, retain, tlen, mlen, id = struct.unpack_from(_OB_HDR, buf, off)
+            off += _OB_HDR_LEN
+            if off + tlen + mlen > len(buf):
+                break
+            topic = buf[off : off + tlen]
+            off += tlen
+            live[id] = MQTTMessage(topic, buf[off : off + mlen], retain, 1)
+            off += mlen
+            self._id = max(self._id, id)
+        if acks or off != len(buf) or off > self.max_size:
+            self._compact(sorted(live.items()))
+        else:
+            self._live = live
+            self._size = off
+        return sorted(self._live.items())
+
+    # add appends a message and returns its id, which is needed to ack it.
+    def add(self, msg):
+        n = _OB_HDR_LEN + len(msg.topic) + len(msg.message)
+        if self._size + n + 5 > self.max_size:
+            self._compact(sorted(self._live.items()), n + 5)
+        self._id += 1
+        self._write(self._file(), self._id, msg)
+        self._f.flush()
+        self._size += n
+        self._live[self._id] = msg
+        return self._id
+
+    # ack appends an ack record for the message with the given id, or truncates the file if that
+    # was the last unacked message and the file has grown large enough for it to be worthwhile.
+    def ack(self, id):
+        if self._live.pop(id, None) is None:
+            return
+        if not self._live and self._size >= self.max_size >> 1:
+            self._compact([])
+            return
+        self._file().write(struct.pack("<BI", _OB_ACK, id))
+        self._f.flush()
+        self._size += 5
+
+    # _file returns the file opened for appending, it is kept open between appends.
+    def _file(self):
+        if self._f is None:
+            self._f = open(self.path, "ab")
+        return self._f
+
+    def _write(self, f, id, msg):
+        f.write(struct.pack(_OB_HDR, _OB_MSG, msg.retain, len(msg.topic), len(msg.message), id))
+        f.write(msg.topic)
+        f.write(msg.message)
+
+    # _compact writes the messages in live, a list of (id, MQTTMessage), to a fresh file, leaving
+    # room for `room` bytes. If there isn't enough space the oldest messages are dropped.
+    def _compact(self, live, room=0):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        size = sum(_OB_HDR_LEN + len(m.topic) + len(m.message) for _, m in live)
+        while live and size + room > self.max_size:
+            m = live.pop(0)[1]
+            log.warning("outbox full, dropping msg for %s", m.topic)
+            size -= _OB_HDR_LEN + len(m.topic) + len(m.message)
+            self.dropped += 1
+        self._live = {}
+        self._size = size
+        if not live:
+            self.resets += 1
+            open(self.path, "wb").close()
+            return
+        self.compactions += 1
+        tmp = self.path + ".new"
+        with open(tmp, "wb") as f:
+            for id, m in live:
+                self._write(f, id, m)
+                self._live[id] = m
+        os.rename(tmp, self.path)
+
+    def stats(self):
+        return {
+            "pending": len(self._live),
+            "size": self._size,
+            "compactions": self.compactions,
+            "resets": self.resets,
+            "dropped": self.dropped,
+        }
+
+
+# Names of the MQTT packet types, indexed by the type field (high nibble of the first byte).
+PKT_TYPES = (
+    "reserved connect connack publish puback pubrec pubrel pubcomp "
+    "subscribe suback unsubscribe unsuback pingreq pingresp disconnect auth"
+).split()
+
+# Upper bounds in milliseconds of the buckets of the RTT histograms, the last bucket is open-ended.
+RTT_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+# RTTStat accumulates round-trip time samples in milliseconds.
+class RTTStat:
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.hist = [0] * (len(RTT_BUCKETS) + 1)
+
+    def add(self, ms):
+        if self.n == 0 or ms < self.min:
+            self.min = ms
+        if ms > self.max:
+            self.max = ms
+        self.n += 1
+        self.total += ms
+        i = 0
+        while i < len(RTT_BUCKETS) and ms > RTT_BUCKETS[i]:
+            i += 1
+        self.hist[i] += 1
+
+    def get(self):
+        return {
+            "n": self.n,
+            "min": self.min,
+            "avg": self.total // self.n if self.n else 0,
+            "max": self.max,
+            "hist": list(self.hist),
+        }
+
+
+# MQTTStats holds the connection and traffic counters of an MQTTClient, it is shared by the
+# successive MQTTProto instances. All counters are preallocated so updating them doesn't allocate
+# and the stats can be left on in production, get() assembles them into a dict.
+class MQTTStats:
+    def __init__(self):
+        self.pkts_in = [0] * 16  # packets received by packet type
+        self.bytes_in = [0] * 16  # bytes received by packet type
+        self.pkts_out = [0] * 16  # packets sent by packet type
+        self.bytes_out = [0] * 16  # bytes sent by packet type
+        self.puback_rtt = RTTStat()  # publish to PUBACK time (not sampled for retransmissions)
+        self.ping_rtt = RTTStat()  # ping to PINGRESP time
+        self.reconnects = {}  # number of reconnections by cause (the operation that failed)
+        self.pub_refused = 0  # number of QoS 1 publishes refused by the broker (MQTT 5)
+        self.queue_dropped = 0  # number of queued publishes dropped because the queue was full
+        self.lock_waits = 0  # number of times a send had to wait for the socket lock
+        self.lock_ms = 0  # total time spent waiting for the socket lock
+        self.handler_ms = RTTStat()  # inbound tasks: time spent in the handlers of a message
+        self.inbound_ms = RTTStat()  # inbound tasks: time from receipt to handled
+        self.inbound_max = 0  # max number of messages in the inbound queue
+        self.inbound_stalls = 0  # number of times reading had to wait for room in the queue
+
+    def rx(self, op, n):
+        self.pkts_in[op >> 4] += 1
+        self.bytes_in[op >> 4] += n
+
+    def tx(self, op, n):
+        self.pkts_out[op >> 4] += 1
+        self.bytes_out[op >> 4] += n
+
+    def get(self):
+        return {
+            "pkts_in": self._by_type(self.pkts_in),
+            "bytes_in": self._by_type(self.bytes_in),
+            "pkts_out": self._by_type(self.pkts_out),
+            "bytes_out": self._by_type(self.bytes_out),
+            "puback_rtt": self.puback_rtt.get(),
+            "ping_rtt": self.ping_rtt.get(),
+            "reconnects": dict(self.reconnects),
+            "pub_refused": self.pub_refused,
+            "queue_dropped": self.queue_dropped,
+            "lock_waits": self.lock_waits,
+            "lock_ms": self.lock_ms,
+            "handler_ms": self.handler_ms.get(),
+            "inbound_ms": self.inbound_ms.get(),
+            "inbound_max": self.inbound_max,
+            "inbound_stalls": self.inbound_stalls,
+        }
+
+    def _by_type(self, counts):
+        return {PKT_TYPES[i]: c for i, c in enumerate(counts) if c}
+
+
+# _TimedLock is an asyncio.Lock that accounts for the time spent waiting to acquire it in stats.
+# If on_release is provided it is awaited before the lock is released.
+class _TimedLock:
+    def __init__(self, stats, on_release=None):
+        self._lock = asyncio.Lock()
+        self._stats = stats
+        self._on_release = on_release
+
+    def locked(self):
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        if not self._lock.locked():
+            await self._lock.acquire()
+            return
+        t0 = ticks_ms()
+        await self._lock.acquire()
+        self._stats.lock_waits += 1
+        self._stats.lock_ms += ticks_diff(ticks_ms(), t0)
+
+    async def __aexit__(self, *args):
+        try:
+            if self._on_release is not None:
+                await self._on_release()
+        finally:
+            self._lock.release()
+
+
+# _varint_len returns the number of bytes of the MQTT varint encoding of n.
+def _varint_len(n):
+    return 1 if n < 0x80 else 2 if n < 0x4000 else 3 if n < 0x200000 else 4
+
+
 # MQTTproto implements the MQTT protocol on the basis of a good connection on a single connection.
 # A new class instance is required for each new connection.
 # Connection failures and EOF cause an OSError exception to be raised.
@@ -156,48 +846,115 @@ class MQTTProto:
     # __init__ creates a new connection based on the config.
     # The list of init params is lengthy but it clearly spells out the dependencies/inputs.
     # The _cb parameters are for publish, puback, and suback packets.
-    def __init__(self, subs_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None):
+    # The optional chunk_sel is called with the topic of each incoming publish packet and may
+    # return a callback to which the payload is then handed in chunks, see _read_chunks.
+    # While subs_cb is called rx_pid holds the pid of the message, None for QoS 0.
+    # Traffic is counted in stats, which is an MQTTStats that may be shared across connections.
+    def __init__(
+        self, subs_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None, chunk_sel=None, stats=None
+    ):
         # Store init params
         self._subs_cb = subs_cb
+        self._chunk_sel = chunk_sel
         self._puback_cb = puback_cb
         self._suback_cb = suback_cb
         self._pingresp_cb = pingresp_cb
         self._sock_cb = sock_cb
         # Init key instance vars
         self._sock = None
-        self._lock = asyncio.Lock()
+        self.stats = stats if stats is not None else MQTTStats()
+        self._lock = _TimedLock(self.stats, self._flush_ctl)
+        self._ctl = bytearray()  # control packets set aside by _queue_ctl while _lock was held
         self.last_ack = 0  # last ACK received from broker
-        self._read_buf = b""
+        self.tls_session = None  # TLS session to resume on the next connection, if supported
+        self.tls_resumed = None  # True/False if TLS session was resumed, None if not TLS
+        self.session_present = False  # broker had a session for the client, from the CONNACK
+        self.rx_pid = None  # pid of the publish being passed to subs_cb
+        self.open_ms = 0  # time it took to open the TCP (and TLS) connection
+        # MQTT 5: flow control and topic aliases as announced by the broker in the CONNACK
+        self._v5 = False
+        self.receive_max = 65535  # max number of unacked QoS 1 publishes
+        self.topic_alias_max = 0  # max number of topic aliases
+        self.max_packet_size = 0  # max size of a packet, 0 if unlimited
+        self.connack_props = {}  # all CONNACK properties by property identifier
+        self._aliases = {}  # topic aliases assigned to outgoing publishes: topic -> alias
+        # receive buffer: bytes in _rbuf[_rpos:_rend] have been read from the socket but not yet
+        # consumed, _as_fill tops it up using readinto so steady-state reads don't allocate
+        self._rbuf = bytearray(_RBUF_LEN)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rend = 0
+        # write buffer: _wbuf[:_wlen] holds packets that have not been written to the socket yet,
+        # _wtimer is True while a deferred flush is scheduled
+        self._wbuf = bytearray(_WBUF_LEN)
+        self._wmv = memoryview(self._wbuf)
+        self._wlen = 0
+        self._wtimer = False
+        self.writes = 0  # number of socket writes, i.e., segments or TLS records sent
 
     # connect initiates a connection to the broker at addr.
     # Addr should be the result of a gethostbyname (typ. an ip-address and port tuple).
     # The clean parameter corresponds to the MQTT clean connection attribute.
+    # If tls_session is the tls_session of a previous connection TLS tries to resume that session,
+    # which avoids the expensive full handshake. If sock is provided it must be a connection opened
+    # to addr using open_connection, which is then used instead of opening a new one.
+    # Version selects MQTT 3.1.1 (4) or 5.0 (5), with 5 session_expiry is the number of seconds
+    # the broker keeps the session after the connection is closed, and the properties of the
+    # CONNACK are stored in connack_props with the important ones pulled out into receive_max,
+    # topic_alias_max, and max_packet_size.
     # Connect waits for the connection to get established and for the broker to ACK the connect
     # packet.  It raises an OSError if the connection cannot be made.
     # Reusing an MQTTProto for a second connection is not recommended.
     async def connect(
-        self, addr, client_id, clean, user=None, pwd=None, ssl=None, keepalive=0, lw=None
+        self,
+        addr,
+        client_id,
+        clean,
+        user=None,
+        pwd=None,
+        ssl=None,
+        keepalive=0,
+        lw=None,
+        tls_session=None,
+        version=4,
+        session_expiry=0,
+        sock=None,
     ):
         if lw is None:
             keepalive = 0
         log.info("Connecting to %s id=%s clean=%d", addr, client_id, clean)
         log.debug("user=%s passwd-len=%s ssl=%s", user, pwd and len(pwd), ssl)
-        try:
-            # in principle, open_connection returns a (reader,writer) stream tuple, but in MP it
-            # really returns a bidirectional stream twice, so we cheat and use only one of the
-            # tuple values for everything.
-            self._sock = await open_connection(addr, ssl)
-        except OSError as e:
-            if e.args[0] != EINPROGRESS:
-                log.info("OSError in open_connection: %s", e)
-                raise
+        if sock is not None:
+            self._sock = sock  # opened ahead of time
+        else:
+            t0 = ticks_ms()
+            try:
+                # in principle, open_connection returns a (reader,writer) stream tuple, but in MP
+                # it really returns a bidirectional stream twice, so we cheat and use only one of
+                # the tuple values for everything.
+                self._sock = await open_connection(addr, ssl, tls_session)
+            except OSError as e:
+                if e.args[0] != EINPROGRESS:
+                    log.info("OSError in open_connection: %s", e)
+                    raise
+            self.open_ms = ticks_diff(ticks_ms(), t0)
         await asyncio.sleep_ms(10)  # sure sure this is needed...
         # Construct connect packet
         premsg = bytearray(b"\x10\0\0\0\0")  # Connect message header
-        msg = bytearray(b"\0\x04MQTT\x04\0\0\0")  # Protocol 3.1.1
+        msg = bytearray(b"\0\x04MQTT\x04\0\0\0\x05\x11\0\0\0\0")  # Protocol, MQTT5 properties
+        mlen = 10
+        self._v5 = version == 5
+        if self._v5:
+            msg[6] = 5
+            if session_expiry:
+                struct.pack_into("!I", msg, 12, session_expiry)
+                mlen = 16
+            else:
+                msg[10] = 0
+                mlen = 11
         if isinstance(client_id, str):
             client_id = client_id.encode()
-        sz = 10 + 2 + len(client_id)
+        sz = mlen + 2 + len(client_id)
         msg[7] = (clean & 1) << 1
         if user is not None:
             if isinstance(user, str):
@@ -210,18 +967,21 @@ class MQTTProto:
             msg[8] |= (keepalive >> 8) & 0x00FF
             msg[9] |= keepalive & 0x00FF
         if lw is not None:
-            sz += 2 + len(lw.topic) + 2 + len(lw.message)
+            sz += 2 + len(lw.topic) + 2 + len(lw.message) + self._v5  # MQTT5: will properties
             msg[7] |= 0x4 | (lw.qos & 0x1) << 3 | (lw.qos & 0x2) << 3
             msg[7] |= lw.retain << 5
         i = self._write_varint(premsg, 1, sz)
+        self.stats.tx(0x10, i + sz)
         # Write connect packet to socket
         try:
             if self._sock is None:
                 await asyncio.sleep_ms(100)  # esp32 glitch
             await self._as_write(premsg[:i], drain=False)
-            await self._as_write(msg, drain=False)
+            await self._as_write(msg[:mlen], drain=False)
             await self._send_str(client_id, drain=False)
             if lw is not None:
+                if self._v5:
+                    await self._as_write(b"\0", drain=False)  # no will properties
                 await self._send_str(lw.topic)  # let it drain in case message is long
                 await self._send_str(lw.message)
             if user is not None:
@@ -235,57 +995,208 @@ class MQTTProto:
             # Await CONNACK
             # read causes ECONNABORTED if broker is out
             try:
-                resp = await self._as_read(4)
+                await self._as_fill(2)
+                op = self._get_byte()
+                sz = self._get_varint()
+                if sz is None:
+                    sz = await self._read_varint()
+                if op != 0x20 or sz < 2 or (sz != 2 and not self._v5) or sz > _RBUF_LEN:
+                    raise OSError(-1, CONN_REFUSED + ": bad CONNACK")
+                if self._rend - self._rpos < sz:
+                    await self._as_fill(sz)
             except OSError as e:
                 log.info("OSError in read: %s", e)
                 raise
-            if resp[0] != 0x20 or resp[1] != 0x02:
-                raise OSError(-1, "Bad CONNACK")
-            if resp[3] != 0:
-                if resp[3] < 6:
-                    raise OSError(-1, "CONNECT refused: " + CONN_ERRS[resp[3] - 1])
+            self.stats.rx(op, 1 + _varint_len(sz) + sz)
+            self.session_present = bool(self._get_byte() & 1)  # connect acknowledge flags
+            rc = self._get_byte()
+            if sz > 2:
+                self.connack_props = self._get_props(self._get_varint())
+                self.receive_max = self.connack_props.get(0x21, 65535)
+                self.topic_alias_max = self.connack_props.get(0x22, 0)
+                self.max_packet_size = self.connack_props.get(0x27, 0)
+            if rc != 0:
+                if self._v5:
+                    # MQTT5 reason code, the reason string property may have details
+                    why = self.connack_props.get(0x1F, b"").decode()
+                    raise OSError(-1, CONN_REFUSED + ": reason 0x%02x %s" % (rc, why))
+                elif rc < 6:
+                    raise OSError(-1, CONN_REFUSED + ": " + CONN_ERRS[rc - 1])
                 else:
-                    raise OSError(-1, "CONNECT refused")
+                    raise OSError(-1, CONN_REFUSED)
         except Exception:
             self._sock.close()
             await self._sock.wait_closed()
             raise
         self.last_ack = ticks_ms()
+        if ssl:
+            # the session is fetched after receiving data because TLS1.3 sends the ticket late
+            self.tls_session, self.tls_resumed = get_tls_session(self._sock)
+            log.info("TLS session %s", "resumed" if self.tls_resumed else "full handshake")
         # gc.collect()
         log.debug("Connected")  # Got CONNACK
 
     # ===== Helpers
 
-    # _as_read reads n bytes from the socket in a blocking manner using asyncio and returns them as
-    # bytes. On error *and on EOF* it raises an OSError.
-    # There is no time-out, instead, as_read relies on the socket being closed by a watchdog.
-    # _as_read buffers a bunch of bytes because calling self.sock._read takes 4-5ms minimum and
-    # _read_msg does a good number of very short reads.
+    # _as_fill reads from the socket until at least n bytes are buffered in _rbuf, n must not
+    # exceed _RBUF_LEN. On error *and on EOF* it raises an OSError.
+    # There is no time-out, instead, _as_fill relies on the socket being closed by a watchdog.
+    # Reading is done in chunks as large as the buffer permits because calling self._sock.readinto
+    # takes 4-5ms minimum and read_msg does a good number of very short reads.
+    async def _as_fill(self, n):
+        if self._rpos == self._rend:
+            self._rpos = self._rend = 0  # empty: start over at the front
+        elif self._rpos + n > _RBUF_LEN:
+            # not enough room at the end: move the unconsumed bytes to the front of the buffer,
+            # memoryview slice assignment handles the overlap (it's a memmove)
+            avail = self._rend - self._rpos
+            self._rmv[:avail] = self._rmv[self._rpos : self._rend]
+            self._rpos = 0
+            self._rend = avail
+        # Note: uasyncio.Stream.readinto returns short reads
+        while self._rend - self._rpos < n:
+            if self._sock is None:
+                raise OSError(-1, CONN_CLOSED)
+            got = await self._sock.readinto(self._rmv[self._rend :])
+            if got is None:
+                continue
+            if got == 0:
+                raise OSError(-1, CONN_CLOSED)
+            self._rend += got
+
+    # _as_read reads n bytes from the socket in a blocking manner using asyncio. If n fits into the
+    # receive buffer it returns a memoryview into the buffer, which is only valid until the next
+    # read, else it returns a freshly allocated bytearray. On error *and on EOF* it raises an
+    # OSError.
     async def _as_read(self, n):
-        # Note: uasyncio.Stream.read returns short reads
-        while self._sock:
-            # read missing amt
-            missing = n - len(self._read_buf)
-            if missing > 0:
-                if missing < 128:
-                    missing = 128
-                got = await self._sock.read(missing)
-                if got is None:
+        if n > _RBUF_LEN:
+            # too big for the buffer: hand over what's buffered and read the rest directly
+            res = bytearray(n)
+            mv = memoryview(res)
+            got = self._rend - self._rpos
+            mv[:got] = self._rmv[self._rpos : self._rend]
+            self._rpos = self._rend = 0
+            while got < n:
+                if self._sock is None:
+                    raise OSError(-1, CONN_CLOSED)
+                r = await self._sock.readinto(mv[got:])
+                if r is None:
                     continue
-                if len(got) == 0:
+                if r == 0:
                     raise OSError(-1, CONN_CLOSED)
-                self._read_buf += got
-                missing = n - len(self._read_buf)
-            # got enough?
-            if missing == 0:
-                res = self._read_buf
-                self._read_buf = b""
-                return res
-            if missing < 0:
-                res = self._read_buf[:n]
-                self._read_buf = self._read_buf[n:]
-                return res
-        raise OSError(-1, CONN_CLOSED)
+                got += r
+            return res
+        if self._rend - self._rpos < n:
+            await self._as_fill(n)
+        p = self._rpos
+        self._rpos = p + n
+        return self._rmv[p : p + n]
+
+    # _read_chunks hands the sz bytes of payload of a publish packet to cb in chunks as they
+    # arrive. Each call gets topic, sz, offset, chunk, and last, where the chunk is a memoryview into
+    # the receive buffer that is only valid until the callback returns. If cb raises, the rest of
+    # the payload is skipped.
+    async def _read_chunks(self, cb, topic, sz):
+        off = 0
+        while True:
+            if self._rend == self._rpos and off < sz:
+                await self._as_fill(1)
+            n = self._rend - self._rpos
+            if n > sz - off:
+                n = sz - off
+            p = self._rpos
+            self._rpos = p + n
+            last = off + n == sz
+            if cb is not None:
+                try:
+                    r = cb(topic, sz, off, self._rmv[p : p + n], last)
+                    if is_awaitable(r):
+                        await r
+                except Exception as e:
+                    log.exc(e, "exception in chunk handler")
+                    cb = None
+            if last:
+                return
+            off += n
+
+    # _get_varint consumes a buffered varint as used for lengths in MQTT and returns its value.
+    # If the buffer doesn't hold the complete varint it consumes nothing and returns None. A varint
+    # longer than 4 bytes raises an OSError.
+    def _get_varint(self):
+        n = 0
+        sh = 0
+        p = self._rpos
+        while p < self._rend:
+            if sh == 28:  # varints are at most 4 bytes long
+                raise OSError(-1, PROTO_ERROR, "varint")
+            b = self._rbuf[p]
+            p += 1
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                self._rpos = p
+                return n
+            sh += 7
+        return None
+
+    # _read_varint returns the value of the next varint, reading from the socket if necessary
+    async def _read_varint(self):
+        while True:
+            n = self._get_varint()
+            if n is not None:
+                return n
+            await self._as_fill(self._rend - self._rpos + 1)
+
+    # _get_byte consumes one buffered byte and returns it, the caller must ensure it's there
+    def _get_byte(self):
+        b = self._rbuf[self._rpos]
+        self._rpos += 1
+        return b
+
+    # _get_u16 consumes two buffered bytes and returns them as big-endian int
+    def _get_u16(self):
+        p = self._rpos
+        self._rpos = p + 2
+        return self._rbuf[p] << 8 | self._rbuf[p + 1]
+
+    # _get_bin consumes a buffered string or binary data prefixed by a 16-bit length and returns a
+    # copy of it.
+    def _get_bin(self):
+        n = self._get_u16()
+        p = self._rpos
+        self._rpos = p + n
+        return bytes(self._rmv[p : p + n])
+
+    # _get_props consumes n bytes of buffered MQTT5 properties and returns them as a dict keyed by
+    # property identifier, only the last of repeated properties (user properties) is retained.
+    def _get_props(self, n):
+        props = {}
+        end = self._rpos + n
+        while self._rpos < end:
+            prop = self._get_byte()
+            if prop in _PROP_BYTE:
+                props[prop] = self._get_byte()
+            elif prop in _PROP_U16:
+                props[prop] = self._get_u16()
+            elif prop in _PROP_U32:
+                props[prop] = self._get_u16() << 16 | self._get_u16()
+            elif prop in _PROP_VARINT:
+                props[prop] = self._get_varint()
+            elif prop == 0x26:
+                props[prop] = (self._get_bin(), self._get_bin())
+            else:
+                props[prop] = self._get_bin()
+        if self._rpos != end:
+            raise OSError(-1, PROTO_ERROR, "props")
+        return props
+
+    # _skip consumes n bytes, which may not all be buffered yet.
+    async def _skip(self, n):
+        while n > 0:
+            if self._rend == self._rpos:
+                await self._as_fill(1)
+            k = min(n, self._rend - self._rpos)
+            self._rpos += k
+            n -= k
 
     # _as_write writes n bytes to the socket in a blocking manner using asyncio. On error or EOF
     # it raises an OSError.
@@ -295,27 +1206,106 @@ class MQTTProto:
             raise OSError(-1, CONN_CLOSED)
         if bytes_wr != b"":
             self._sock.write(bytes_wr)
+            self.writes += 1
         if drain:
             await self._sock.drain()
 
+    # _as_write_stream copies the data of an MQTTStream to the socket using a small buffer. If the
+    # source runs dry early or an async iterator produces too much data the packet on the wire is
+    # broken, so the socket is closed and a ValueError is raised.
+    async def _as_write_stream(self, stream):
+        stream.rewind()
+        src = stream.src
+        left = stream.length
+        if hasattr(src, "readinto"):
+            buf = memoryview(bytearray(min(left, _STREAM_BUF_LEN)))
+            while left > 0:
+                n = src.readinto(buf[: min(left, len(buf))])
+                if is_awaitable(n):
+                    n = await n
+                if not n:
+                    break
+                await self._as_write(buf[:n])
+                left -= n
+        else:
+            async for chunk in src:
+                if len(chunk) > left:
+                    break
+                await self._as_write(chunk)
+                left -= len(chunk)
+        if left != 0:
+            self._sock.close()
+            raise ValueError("stream length mismatch")
+
+    # _queue_write appends a small packet to the write buffer, the caller must hold _lock. The
+    # buffer is written to the socket when it is full, when flush is true, when read_msg is about
+    # to wait for data, or else _WFLUSH_MS later. Packets that don't fit the buffer are written
+    # straight through after the buffer has been flushed to preserve ordering.
+    async def _queue_write(self, pkt, flush=False, count=True):
+        n = len(pkt)
+        if count:
+            self.stats.tx(pkt[0], n)
+        if self._wlen + n > _WBUF_LEN:
+            await self._flush()
+        if n > _WBUF_LEN:
+            await self._as_write(pkt)
+            return
+        self._wmv[self._wlen : self._wlen + n] = pkt
+        self._wlen += n
+        if flush:
+            await self._flush()
+        elif not self._wtimer:
+            self._wtimer = True
+            asyncio.get_event_loop().create_task(self._flush_later())
+
+    # _flush writes the buffered packets to the socket, the caller must hold _lock. The write
+    # gets a copy of the buffer because the stream may hang on to it after drain returns.
+    async def _flush(self):
+        if self._wlen:
+            n = self._wlen
+            self._wlen = 0
+            await self._as_write(self._wbuf[:n])
+
+    # _queue_ctl sends a small control packet (PUBACK, PINGREQ) without waiting for a write in
+    # progress, such as a large publish, which would stall reading and delay acks. If _lock is held
+    # the packet is set aside and _flush_ctl writes it as soon as the current packet is complete,
+    # ahead of the other tasks waiting for the lock. MQTT packets cannot be interleaved, so that's
+    # the earliest point at which it can go out.
+    async def _queue_ctl(self, pkt, flush=False):
+        if self._lock.locked():
+            self.stats.tx(pkt[0], len(pkt))
+            self._ctl.extend(pkt)
+            return
+        async with self._lock:
+            await self._queue_write(pkt, flush)
+
+    # _flush_ctl writes the control packets set aside by _queue_ctl, it is called as _lock is
+    # released.
+    async def _flush_ctl(self):
+        while self._ctl:
+            ctl = self._ctl
+            self._ctl = bytearray()
+            await self._queue_write(ctl, True, False)
+
+    # _flush_later is the deferred flush started by _queue_write. If the write fails the socket is
+    # closed so read_msg errors out and the connection gets restarted.
+    async def _flush_later(self):
+        await asyncio.sleep_ms(_WFLUSH_MS)
+        self._wtimer = False
+        try:
+            async with self._lock:
+                await self._flush()
+        except OSError as e:
+            log.info("OSError in flush: %s", e)
+            if self._sock is not None:
+                self._sock.close()
+
     # _send_str writes a variable-length string to the socket, prefixing the chars by a 16-bit
     # length
     async def _send_str(self, s, drain=True):
         await self._as_write(struct.pack("!H", len(s)), drain=False)
         await self._as_write(s, drain)
 
-    # _read_varint reads a varint used for lengths in MQTT
-    async def _read_varint(self):
-        n = 0
-        sh = 0
-        while 1:
-            res = await self._as_read(1)
-            b = res[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
-
     # _write_varint writes 'value' into 'array' starting at offset 'index'. It returns the index
     # after the last byte placed into the array. Only positive values are handled.
     def _write_varint(self, array, index, value):
@@ -328,10 +1318,15 @@ class MQTTProto:
 
     # ===== Public functions
 
-    # ping sends a ping packet
+    # flush writes any buffered packets to the socket.
+    async def flush(self):
+        if self._wlen:
+            async with self._lock:
+                await self._flush()
+
+    # ping sends a ping packet, it is flushed immediately because the response is timed
     async def ping(self):
-        async with self._lock:
-            await self._as_write(b"\xc0\0")
+        await self._queue_ctl(b"\xc0\0", True)
 
     # disconnect tries to send a disconnect packet and then closes the socket
     # Trying to send a disconnect as opposed to just closing the socket is important because the
@@ -341,7 +1336,9 @@ class MQTTProto:
             async with self._lock:
                 if self._sock is None:
                     return
-                self._sock.write(b"\xe0\0")
+                self._sock.write(self._wbuf[: self._wlen] + b"\xe0\0")
+                self._wlen = 0
+                self.stats.tx(0xE0, 2)
                 await asyncio.wait_for(
                     self._sock.drain(), 0.2
                 )  # 200ms to make sure ipoll gets a chance
@@ -353,139 +1350,404 @@ class MQTTProto:
         self._sock = None
 
     def isconnected(self):
-        self._sock is not None
+        return self._sock is not None
 
     # publish writes a publish message onto the current socket. It raises an OSError on failure.
     # If qos==1 then a pid must be provided.
-    # msg.topic and msg.message must be byte arrays, or equiv.
-    async def publish(self, msg, dup=0):
+    # msg.topic and msg.message must be byte arrays, or equiv, msg.message may also be an
+    # MQTTStream, in which case the data is copied from the stream to the socket in chunks.
+    # With flush=False a small message may be held in the write buffer for a few milliseconds so
+    # it can share a segment with subsequent packets.
+    # With MQTT 5 a topic alias is assigned to each topic as long as the broker permits more
+    # aliases, subsequent publishes to the topic then send the alias instead of the topic string.
+    # The alias is only recorded once the packet has passed all checks, else the next publish would
+    # use an alias the broker never learned.
+    async def publish(self, msg, dup=0, flush=True):
+        topic = msg.topic
+        alias = 0
+        new_alias = False
+        if self.topic_alias_max:
+            alias = self._aliases.get(topic, 0)
+            if alias:
+                topic = b""
+            elif len(self._aliases) < self.topic_alias_max:
+                alias = len(self._aliases) + 1
+                new_alias = True
         # calculate message length
         mlen = len(msg.message)
-        sz = 2 + len(msg.topic) + mlen
+        sz = 2 + len(topic) + mlen
         if msg.qos > 0:
             sz += 2  # account for pid
-        if sz >= 2097152:
+        if self._v5:
+            sz += 4 if alias else 1  # properties
+        if sz >= 2097152 or (self.max_packet_size and sz + 5 > self.max_packet_size):
             raise ValueError("message too long")
+        pb = isinstance(msg.message, PubBuf)
+        if pb:
+            start = msg.message.head - (1 + _varint_len(sz) + sz - mlen)
+            if start < 0:
+                raise ValueError("topic too long for headroom")
+        if new_alias:
+            self._aliases[topic] = alias
+        if pb:
+            return await self._publish_buf(msg, dup, flush, topic, alias, sz, start)
         # construct packet: if possible, put everything into a single large bytearray so a single
         # socket send call can be made resulting in a single packet.
-        hdrlen = 4 + 2 + len(msg.topic) + 2
-        single = hdrlen + mlen <= 1440  # slightly conservative MSS
+        hdrlen = 4 + 2 + len(topic) + 2 + 4
+        stream = isinstance(msg.message, MQTTStream)
+        single = not stream and hdrlen + mlen <= 1440  # slightly conservative MSS
         if single:
             pkt = bytearray(hdrlen + mlen)
         else:
             pkt = bytearray(hdrlen)
         pkt[0] = 0x30 | msg.qos << 1 | msg.retain | dup << 3
         length = self._write_varint(pkt, 1, sz)
-        struct.pack_into("!H", pkt, length, len(msg.topic))
+        struct.pack_into("!H", pkt, length, len(topic))
         length += 2
-        pkt[length: length + len(msg.topic)] = msg.topic
-        length += len(msg.topic)
+        pkt[length : length + len(topic)] = topic
+        length += len(topic)
         if msg.qos > 0:
             struct.pack_into("!H", pkt, length, msg.pid)
             length += 2
+        if alias:
+            struct.pack_into("!BBH", pkt, length, 3, 0x23, alias)
+            length += 4
+        elif self._v5:
+            pkt[length] = 0  # no properties
+            length += 1
         # send header and body
         async with self._lock:
             if single:
                 pkt[length:] = msg.message
-                await self._as_write(pkt)
+                await self._queue_write(pkt, flush)
+                return
+            await self._flush()
+            self.stats.tx(pkt[0], length + mlen)
+            if stream:
+                await self._as_write(memoryview(pkt)[:length], drain=False)
+                await self._as_write_stream(msg.message)
             else:
-                await self._as_write(pkt[:length])
+                await self._as_write(memoryview(pkt)[:length])
                 await self._as_write(msg.message)
 
-    # subscribe sends a subscription message.
+    # _publish_buf sends a message whose payload is in a PubBuf by writing the header into the
+    # headroom right in front of the payload, the packet is then written to the socket in one piece
+    # without being copied. Small packets that need not be flushed are still coalesced in the write
+    # buffer, which is a copy but doesn't allocate. The header starts at offset start of the
+    # buffer, publish has checked that it fits into the headroom.
+    async def _publish_buf(self, msg, dup, flush, topic, alias, sz, start):
+        pb = msg.message
+        b = pb.buf
+        b[start] = 0x30 | msg.qos << 1 | msg.retain | dup << 3
+        i = self._write_varint(b, start + 1, sz)
+        struct.pack_into("!H", b, i, len(topic))
+        i += 2
+        b[i : i + len(topic)] = topic
+        i += len(topic)
+        if msg.qos > 0:
+            struct.pack_into("!H", b, i, msg.pid)
+            i += 2
+        if alias:
+            struct.pack_into("!BBH", b, i, 3, 0x23, alias)
+        elif self._v5:
+            b[i] = 0  # no properties
+        pkt = pb.mv[start : pb.head + pb.len]
+        async with self._lock:
+            if not flush and len(pkt) <= _WBUF_LEN:
+                await self._queue_write(pkt)
+                return
+            await self._flush()
+            self.stats.tx(b[start], len(pkt))
+            await self._as_write(pkt)
+
+    # subscribe sends a subscription message for a single topic filter.
     async def subscribe(self, topic, qos, pid):
-        if (qos & 1) != qos:
-            raise ValueError("invalid qos")
-        pkt = bytearray(b"\x82\0\0\0")
-        if isinstance(topic, str):
-            topic = topic.encode()
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, pid)
+        await self.subscribe_many([(topic, qos)], pid)
+
+    # subscribe_many sends one subscription message for a list of (topic, qos) tuples. The broker
+    # responds with a single SUBACK containing the return codes in the same order.
+    async def subscribe_many(self, topics, pid):
+        for _, qos in topics:
+            if (qos & 1) != qos:
+                raise ValueError("invalid qos")
+        await self._send_topics(0x82, topics, pid)
+
+    # unsubscribe sends one unsubscription message for a list of topic filters.
+    async def unsubscribe(self, topics, pid):
+        await self._send_topics(0xA2, [(t, None) for t in topics], pid)
+
+    # _send_topics assembles a (un)subscribe packet with the (topic, qos) tuples into one buffer
+    # and sends it, qos is omitted if None.
+    async def _send_topics(self, op, topics, pid):
+        topics = [(t.encode() if isinstance(t, str) else t, q) for t, q in topics]
+        sz = 2 + self._v5  # pid and MQTT5 properties
+        for t, q in topics:
+            sz += 2 + len(t) + (q is not None)
+        pkt = bytearray(5 + sz)
+        pkt[0] = op
+        i = self._write_varint(pkt, 1, sz)
+        struct.pack_into("!H", pkt, i, pid)
+        i += 2
+        if self._v5:
+            pkt[i] = 0  # no properties
+            i += 1
+        for t, q in topics:
+            struct.pack_into("!H", pkt, i, len(t))
+            pkt[i + 2 : i + 2 + len(t)] = t
+            i += 2 + len(t)
+            if q is not None:
+                pkt[i] = q
+                i += 1
         async with self._lock:
-            await self._as_write(pkt, drain=False)
-            await self._send_str(topic, drain=False)
-            await self._as_write(qos.to_bytes(1, "little"))
-
-    #   # unsubscribe sends an unsubscription message.
-    #   async def unsubscribe(self, topic, pid):
-    #       pkt = bytearray(b"\xA2\0\0\0")
-    #       if isinstance(topic, str):
-    #           topic = topic.encode()
-    #       struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic), pid)
-    #       async with self._lock:
-    #           await self._as_write(pkt, drain=False)
-    #           await self._send_str(topic)
+            await self._queue_write(pkt[:i], True)
 
     # Read a single MQTT message and process it.
     # Subscribed messages are delivered to a callback previously set by .setup() method.
     # Other (internal) MQTT messages processed internally.
-    # Called from ._handle_msg().
+    # The socket is only awaited when the packet isn't completely buffered yet, the packet itself
+    # is then handled by _decode without further awaits (except for coroutine callbacks), only
+    # publishes larger than the receive buffer are read piecemeal by _read_pub.
+    # Before waiting for more data read_msg flushes buffered writes, this way the PUBACKs for a
+    # burst of incoming messages are sent together once the burst has been processed.
     async def read_msg(self):
-        # t0 = ticks_ms()
-        res = await self._as_read(1)
-        # We got something, dispatch based on message type
-        op = res[0]
-        # log.debug("read_msg op=%x", op)
+        if self._rend - self._rpos < 2:
+            if self._wlen and not self._lock.locked():  # else _flush_later takes care of it
+                await self.flush()
+            await self._as_fill(2)
+        op = self._get_byte()
+        sz = self._get_varint()
+        if sz is None:
+            sz = await self._read_varint()
+        if sz > _RBUF_LEN:
+            if (op & 0xF0) != 0x30:
+                raise OSError(-1, PROTO_ERROR, "size", op)
+            await self._read_pub(op, sz)
+        else:
+            if self._rend - self._rpos < sz:
+                await self._as_fill(sz)
+            aw = self._decode(op, sz)
+            if aw is not None:
+                await aw
+        if self._ctl and not self._lock.locked():
+            async with self._lock:  # releasing the lock writes the set aside PUBACKs
+                pass
+        return op >> 4
+
+    # read_msgs handles all the packets that are completely buffered in one pass without awaiting
+    # anything but coroutine callbacks, if there is none it waits for one using read_msg. It
+    # returns the number of packets handled. This saves a coroutine call per packet compared to
+    # calling read_msg in a loop.
+    async def read_msgs(self):
+        n = 0
+        while True:
+            sz = self._buffered()
+            if sz < 0:
+                if n:
+                    break
+                await self.read_msg()
+                n = 1
+                continue
+            op = self._get_byte()
+            self._get_varint()
+            aw = self._decode(op, sz)
+            if aw is not None:
+                await aw
+            n += 1
+        if self._ctl and not self._lock.locked():
+            async with self._lock:
+                pass
+        return n
+
+    # _buffered returns the remaining length of the packet at the head of the receive buffer if it
+    # is completely buffered, else -1. It does not consume anything.
+    def _buffered(self):
+        p = self._rpos + 1
+        n = 0
+        sh = 0
+        while p < self._rend and sh < 28:
+            b = self._rbuf[p]
+            p += 1
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n if self._rend - p >= n else -1
+            sh += 7
+        return -1
+
+    # _decode handles a packet of type op whose remaining length sz is completely buffered (the
+    # fixed header having been consumed). It calls the callbacks and is not async, so a stream of
+    # small packets costs no coroutine round-trips. If the handling has to continue asynchronously,
+    # which is the case for coroutine callbacks and chunked subscriptions, it returns an awaitable.
+    def _decode(self, op, sz):
+        self.stats.rx(op, 1 + _varint_len(sz) + sz)
+        end = self._rpos + sz
         if op == 0xD0:  # PINGRESP
-            await self._as_read(1)
+            if sz != 0:
+                raise OSError(-1, PROTO_ERROR, "pingresp", sz)
             self.last_ack = ticks_ms()
             self._pingresp_cb()
         elif op == 0x40:  # PUBACK: remove pid from unacked_pids
-            sz = await self._as_read(1)
-            if sz != b"\x02":
+            if sz != 2 and not (self._v5 and sz > 2):
                 raise OSError(-1, PROTO_ERROR, "puback", sz)
-            rcv_pid = await self._as_read(2)
-            pid = rcv_pid[0] << 8 | rcv_pid[1]
+            pid = self._get_u16()
+            reason = self._get_byte() if sz > 2 else 0  # MQTT5 reason code, then properties
+            self._rpos = end
             self.last_ack = ticks_ms()
-            self._puback_cb(pid)
+            self._puback_cb(pid, reason)
         elif op == 0x90:  # SUBACK: flag pending subscribe to end
-            resp = await self._as_read(4)
-            pid = resp[2] | (resp[1] << 8)
-            # print("suback", resp[3])
+            if sz < 3:
+                raise OSError(-1, PROTO_ERROR, "suback", sz)
+            pid = self._get_u16()
+            if self._v5:
+                plen = self._get_varint()
+                self._rpos += plen  # skip properties
+            n = end - self._rpos  # number of return codes
+            if n < 1:
+                raise OSError(-1, PROTO_ERROR, "suback", sz)
+            if n == 1:
+                resp = self._get_byte()  # single topic: pass the return code
+            else:
+                resp = [self._get_byte() for _ in range(n)]  # list of return codes
+            self.last_ack = ticks_ms()
+            self._suback_cb(pid, resp)
+        elif op == 0xB0:  # UNSUBACK: flag pending unsubscribe to end
+            if sz != 2 and not (self._v5 and sz > 2):
+                raise OSError(-1, PROTO_ERROR, "unsuback")
+            pid = self._get_u16()
+            self._rpos = end  # MQTT5 properties and reason codes
             self.last_ack = ticks_ms()
-            self._suback_cb(pid, resp[3])
+            self._suback_cb(pid, None)
         elif (op & 0xF0) == 0x30:  # PUB: dispatch to user handler
-            sz = await self._read_varint()
-            topic_len = await self._as_read(2)
-            topic_len = (topic_len[0] << 8) | topic_len[1]
-            topic = await self._as_read(topic_len)
-            # log.debug("topic:%s", topic)
-            sz -= topic_len + 2
-            retained = op & 0x1
-            dup = op & 0x8
+            if sz < 2:
+                raise OSError(-1, PROTO_ERROR, "pub sz", sz)
+            p = self._rpos + 2
+            self._rpos = p + self._get_u16()
+            topic = bytes(self._rmv[p : self._rpos])
             qos = (op >> 1) & 3
             pid = None
             if qos:  # not QoS=0 -> got pid
-                pid = await self._as_read(2)
-                pid = pid[0] << 8 | pid[1]
-                sz -= 2
-            # log.debug("pid:%s sz=%d", pid, sz)
-            if sz < 0:
+                if qos == 2:
+                    raise OSError(-1, "QoS=2 not supported")
+                pid = self._get_u16()
+            if self._v5:
+                plen = self._get_varint()
+                self._rpos += plen  # skip properties
+            p = self._rpos
+            if p > end:
                 raise OSError(-1, PROTO_ERROR, "pub sz", sz)
-            else:
-                msg = await self._as_read(sz)
-            # Dispatch to user's callback handler
+            ccb = self._chunk_sel(topic) if self._chunk_sel is not None else None
+            if ccb is not None:
+                # streaming subscription: hand the payload over in chunks
+                log.debug("dispatch chunked pub %s pid=%s qos=%d", topic, pid, qos)
+                return self._chunks_ack(ccb, topic, end - p, pid)
+            # the callback may hang on to msg, can't hand it our buffer
+            msg = bytes(self._rmv[p:end])
+            self._rpos = end
             log.debug("dispatch pub %s pid=%s qos=%d", topic, pid, qos)
-            # t1 = ticks_ms()
+            self.rx_pid = pid
+            cb = None
             try:
-                cb = self._subs_cb(topic, msg, bool(retained), qos, dup)
+                cb = self._subs_cb(topic, msg, bool(op & 1), qos, op & 8)
                 if is_awaitable(cb):
-                    await cb  # handle _subs_cb being coro
+                    return self._await_ack(cb, pid)  # handle _subs_cb being coro
             except Exception as e:
                 log.exc(e, "exception in handler")
-            # t2 = ticks_ms()
-            # Send PUBACK for QoS 1 messages
-            if qos == 1:
-                pkt = bytearray(b"\x40\x02\0\0")
-                struct.pack_into("!H", pkt, 2, pid)
-                async with self._lock:
-                    await self._as_write(pkt)
-            elif qos == 2:
-                raise OSError(-1, "QoS=2 not supported")
-            # log.debug("read_msg: read:{} handle:{} ack:{}".format(ticks_diff(t1, t0),
-            #    ticks_diff(t2, t1), ticks_diff(ticks_ms(), t2)))
+            if pid is not None and cb is not ACK_LATER:
+                self._ack(pid)
+        elif op == 0xE0 and self._v5:  # DISCONNECT: the broker is closing the connection
+            rc = self._get_byte() if sz else 0
+            raise OSError(-1, "disconnected by broker: reason 0x%02x" % rc)
         else:
             raise OSError(-1, PROTO_ERROR, "bad op", op)
-        return op >> 4
+        if self._rpos != end:
+            raise OSError(-1, PROTO_ERROR, "size", op)
+
+    # _await_ack awaits a coroutine subs_cb and then sends the PUBACK, if pid is not None.
+    async def _await_ack(self, cb, pid):
+        try:
+            cb = await cb
+        except Exception as e:
+            log.exc(e, "exception in handler")
+        if pid is not None and cb is not ACK_LATER:
+            self._ack(pid)
+
+    # puback sends the PUBACK for a message whose subs_cb returned ACK_LATER.
+    def puback(self, pid):
+        if self._sock is not None:
+            self._ack(pid)
+
+    # _chunks_ack hands the payload to a chunked subscription and then sends the PUBACK, if pid is
+    # not None.
+    async def _chunks_ack(self, ccb, topic, sz, pid):
+        await self._read_chunks(ccb, topic, sz)
+        if pid is not None:
+            self._ack(pid)
+
+    # _ack queues a PUBACK without awaiting anything or allocating memory: it goes into the write
+    # buffer like other small packets, unless a write is in progress or the buffer is full, in
+    # which case it is set aside for _flush_ctl.
+    def _ack(self, pid):
+        self.stats.tx(0x40, 4)
+        if self._lock.locked() or self._wlen + 4 > _WBUF_LEN:
+            self._ctl.extend(b"\x40\x02")
+            self._ctl.append(pid >> 8)
+            self._ctl.append(pid & 0xFF)
+            return
+        w = self._wbuf
+        i = self._wlen
+        w[i] = 0x40
+        w[i + 1] = 2
+        w[i + 2] = pid >> 8
+        w[i + 3] = pid & 0xFF
+        self._wlen = i + 4
+        if not self._wtimer:
+            self._wtimer = True
+            asyncio.get_event_loop().create_task(self._flush_later())
+
+    # _read_pub reads a publish packet that is larger than the receive buffer and dispatches it,
+    # the fixed header having been consumed.
+    async def _read_pub(self, op, sz):
+        if self._rend - self._rpos < 2:
+            await self._as_fill(2)
+        topic_len = self._get_u16()
+        topic = bytes(await self._as_read(topic_len))
+        sz -= topic_len + 2
+        qos = (op >> 1) & 3
+        pid = None
+        if qos:  # not QoS=0 -> got pid
+            if qos == 2:
+                raise OSError(-1, "QoS=2 not supported")
+            if self._rend - self._rpos < 2:
+                await self._as_fill(2)
+            pid = self._get_u16()
+            sz -= 2
+        if self._v5:  # skip properties
+            plen = self._get_varint()
+            if plen is None:
+                plen = await self._read_varint()
+            await self._skip(plen)
+            sz -= _varint_len(plen) + plen
+        if sz < 0:
+            raise OSError(-1, PROTO_ERROR, "pub sz", sz)
+        ccb = self._chunk_sel(topic) if self._chunk_sel is not None else None
+        if ccb is not None:
+            # streaming subscription: hand the payload over as it arrives
+            log.debug("dispatch chunked pub %s pid=%s qos=%d", topic, pid, qos)
+            await self._chunks_ack(ccb, topic, sz, pid)
+            return
+        msg = await self._as_read(sz)
+        if sz <= _RBUF_LEN:
+            msg = bytes(msg)  # the callback may hang on to msg, can't hand it our buffer
+        log.debug("dispatch pub %s pid=%s qos=%d", topic, pid, qos)
+        self.rx_pid = pid
+        cb = None
+        try:
+            cb = self._subs_cb(topic, msg, bool(op & 1), qos, op & 8)
+            if is_awaitable(cb):
+                cb = await cb  # handle _subs_cb being coro
+        except Exception as e:
+            log.exc(e, "exception in handler")
+        if pid is not None and cb is not ACK_LATER:
+            self._ack(pid)
 
 
 # -----------------------------------------------------------------------------------------
@@ -511,18 +1773,59 @@ class MQTTClient:
         # config server and port
         if self._c["port"] == 0:
             self._c["port"] = 8883 if self._c["ssl_params"] else 1883
-        if self._c["server"] is None:
+        if self._c["server"] is None and not self._c["servers"]:
             raise ValueError("no server")
+        if self._c["max_inflight"] < 1:
+            raise ValueError("invalid max_inflight")
         # init instance vars
         self._proto = None
+        self._conn_up = asyncio.Event()  # set while _proto is not None
+        self._conn_down = asyncio.Event()  # set while _proto is None after a connection failed
         self._MQTTProto = MQTTProto  # reference to class, override for testing
         self._addr = None
+        self._tls_counts = [0, 0]  # number of full and of resumed TLS handshakes
+        self._brokers = []  # failover list, see Broker
+        for srv in self._c["servers"] or [self._c["server"]]:
+            host, port = (srv, self._c["port"]) if isinstance(srv, str) else srv
+            self._brokers.append(Broker(host, port, self._c["dns_ttl"]))
+        self._broker = self._brokers[0]  # broker of the current or last connection
+        self._standby = None  # (Broker, stream) connection opened ahead of a failover
+        self._backoff = self._c["backoff"] or Backoff()
+        self._stats = MQTTStats()
+        # response timeout estimation: smoothed RTT scaled by 8 and RTT variance scaled by 4 as in
+        # RFC 6298 (0 until there is a sample), and the current timeout in milliseconds
+        self._srtt = 0
+        self._rttvar = 0
+        self._rto_ms = self._c["response_time"] * 1000
         self._lastpid = 0
         self._unacked_pids = {}  # PUBACK and SUBACK pids awaiting ACK response
         self._state = 0  # 0=init, 1=has-connected, 2=disconnected=dead
         self._conn_keeper = None  # handle to persistent keep-connection coro
-        self._prev_pub = None  # MQTTMessage of as yet unacked async pub
-        self._prev_pub_proto = None  # self._proto used for as yet unacked async pub
+        self._inflight = []  # unacked QoS 1 MQTTMessages in the order they were sent
+        self._queue = []  # publishes queued while disconnected: (prio, topic, msg, retain, qos)
+        self._qlen = 0  # bytes of topics and messages in _queue
+        self._draining = False  # True while _drain is publishing the queue
+        self._bufs = []  # idle PubBufs, see get_buf
+        self._outbox = self._c["outbox"]
+        self._outbox_ids = {}  # pid -> Outbox id of unacked QoS 1 publishes
+        if self._outbox is not None:
+            # messages left unacked before the last reset get retransmitted by connect() as it does
+            # for messages left unacked when a connection fails
+            for id, msg in self._outbox.load():
+                msg.pid = self._newpid()
+                self._unacked_pids[msg.pid] = [asyncio.Event(), None, None]
+                self._inflight.append(msg)
+                self._outbox_ids[msg.pid] = id
+        self._subs = _TopicTrie()  # per-subscription handlers
+        self._sub_qos = {}  # QoS of all subscriptions by topic filter, to restore a lost session
+        # inbound queue: messages waiting for an inbound task, see _dispatch
+        self._inq = []  # (topic, msg, retained, qos, dup, ticks_ms, ack), ack: (proto, pid) or None
+        self._inlen = 0  # bytes of topics and messages in _inq
+        self._inbusy = []  # topics of the messages being handled
+        self._inq_ev = asyncio.Event()  # set when a message can be handled
+        self._inroom = asyncio.Event()  # set when _inq has room
+        self._workers = 0  # number of inbound tasks started
+        self._resub = False  # True while the subscriptions need to be restored
         # misc
         # if platform == "esp8266":
         #    import esp
@@ -577,11 +1880,139 @@ class MQTTClient:
             log.warning("Wifi failed to connect")
             raise OSError(-1, "Wifi failed to connect")
 
-    def _dns_lookup(self):
-        new_addr = socket.getaddrinfo(self._c["server"], self._c["port"])
-        if len(new_addr) > 0 and len(new_addr[0]) > 1:
-            self._addr = new_addr[0][-1]
-        log.debug("DNS %s->%s", self._c["server"], self._addr)
+    async def _dns_lookup(self):
+        self._addr = await self._broker.dns.resolve()
+        log.debug("DNS %s->%s", self._broker.host, self._addr)
+
+    # dns_stats returns the DNS lookup counters of the current broker, see DNSCache
+    def dns_stats(self):
+        return self._broker.dns.stats()
+
+    # ===== Broker failover
+    # With a list of brokers in config["servers"] the client probes how long it takes to open a
+    # connection to each one before connecting the first time and picks the fastest. It sticks to
+    # the broker it is connected to as long as that one is healthy, i.e., it hasn't failed
+    # `failover` connection attempts in a row, so the session isn't lost needlessly, and then fails
+    # over to the fastest healthy broker. If all brokers are down it tries the one that has been
+    # down the longest.
+
+    # _pick_broker returns the healthy broker with the lowest connect latency, not counting the
+    # exclude broker, or None if there is none.
+    def _pick_broker(self, exclude=None):
+        holddown_ms = self._c["holddown"] * 1000
+        best = None
+        for b in self._brokers:
+            if b is exclude or not b.healthy(holddown_ms):
+                continue
+            if best is None or (
+                b.latency_ms is not None
+                and (best.latency_ms is None or b.latency_ms + _LAT_SLACK_MS < best.latency_ms)
+            ):
+                best = b
+        return best
+
+    # _select_broker returns the broker to connect to next.
+    def _select_broker(self):
+        if len(self._brokers) == 1:
+            return self._broker
+        if self._state > 0 and self._broker.healthy(self._c["holddown"] * 1000):
+            return self._broker
+        b = self._pick_broker()
+        if b is None:
+            now = ticks_ms()
+            b = max(self._brokers, key=lambda b: ticks_diff(now, b.down))
+        return b
+
+    # _open opens a TCP (and TLS) connection to a broker without sending a CONNECT, it records
+    # the time that took as a latency sample and returns the stream.
+    async def _open(self, b, ssl):
+        addr = await b.dns.resolve()
+        t0 = ticks_ms()
+        sock = await asyncio.wait_for(
+            open_connection(addr, ssl, b.tls_session), self._c["response_time"]
+        )
+        b.sample(ticks_diff(ticks_ms(), t0))
+        return sock
+
+    # _probe measures the connect latency of all brokers, a broker that can't be reached counts
+    # as a failed connection attempt. With TLS the probes include the handshake so they are
+    # comparable to the latency measured when connecting.
+    async def _probe(self):
+        async def probe(b):
+            try:
+                sock = await self._open(b, self._c["ssl_params"])
+                sock.close()
+                await sock.wait_closed()
+            except (OSError, asyncio.TimeoutError) as e:
+                log.info("probing %s:%d failed: %s", b.host, b.port, e)
+                b.failed(self._c["failover"])
+
+        await asyncio.gather(*[probe(b) for b in self._brokers])
+        log.info("broker latencies: %s", [b.latency_ms for b in self._brokers])
+
+    # _keep_standby keeps a connection open to the broker the client would fail over to while
+    # proto is connected, so a failover only needs to send the CONNECT. Brokers close
+    # connections that don't send a CONNECT within some time, so it is reopened periodically.
+    async def _keep_standby(self, proto):
+        while self._proto is proto:
+            await self._close_standby()
+            b = self._pick_broker(exclude=self._broker)
+            if b is not None:
+                try:
+                    sock = await self._open(b, self._c["ssl_params"])
+                    if self._proto is proto:
+                        self._standby = (b, sock)
+                    else:
+                        sock.close()
+                except (OSError, asyncio.TimeoutError) as e:
+                    log.info("standby to %s:%d failed: %s", b.host, b.port, e)
+                    b.failed(self._c["failover"])
+            try:
+                await asyncio.wait_for(self._conn_down.wait(), self._c["standby"])
+            except asyncio.TimeoutError:
+                pass
+
+    async def _close_standby(self):
+        if self._standby is not None:
+            sock = self._standby[1]
+            self._standby = None
+            try:
+                sock.close()
+                await sock.wait_closed()
+            except OSError:
+                pass
+
+    # stats returns the connection and traffic statistics as a dict, see MQTTStats, together with
+    # the pids of the unacked QoS 1 publishes and the DNS, TLS, and reconnection stats.
+    def stats(self):
+        st = self._stats.get()
+        st["inflight"] = [m.pid for m in self._inflight]
+        st["queued"] = len(self._queue)
+        st["queued_bytes"] = self._qlen
+        st["inbound"] = len(self._inq)
+        st["inbound_bytes"] = self._inlen
+        if self._outbox is not None:
+            st["outbox"] = self._outbox.stats()
+        st["srtt_ms"] = self._srtt >> 3
+        st["rttvar_ms"] = self._rttvar >> 2
+        st["timeout_ms"] = int(self._rto_ms)
+        st["dns"] = self.dns_stats()
+        if len(self._brokers) > 1:
+            st["brokers"] = [b.stats() for b in self._brokers]
+            st["broker"] = self._brokers.index(self._broker)
+        st["tls"] = self.tls_stats()
+        st.update(self.reconnect_stats())
+        return st
+
+    # reconnect_stats returns the failed connection attempts by cause and the successful
+    # reconnections by recovery step, see Backoff
+    def reconnect_stats(self):
+        return self._backoff.stats()
+
+    # tls_stats returns the number of connections that used a full TLS handshake and that resumed
+    # a previous TLS session
+    def tls_stats(self):
+        return {"full": self._tls_counts[0], "resumed": self._tls_counts[1]}
 
     async def connect(self):
         if self._state > 1:
@@ -591,50 +2022,123 @@ class MQTTClient:
         if not self._c["interface"].isconnected():
             await self.wifi_connect()
         if self._state == 0:
-            self._dns_lookup()  # DNS is blocking, do it only the first time around
             clean = self._c["clean"]
-        # actually open a socket and connect
-        proto = self._MQTTProto(
-            self._c["subs_cb"], self._got_puback, self._got_suback, self._got_pingresp
-        )
-        # FIXME: need to use a timeout here!
-        await proto.connect(
-            self._addr,
-            self._c["client_id"],
-            clean,
-            user=self._c["user"],
-            pwd=self._c["password"],
-            ssl=self._c["ssl_params"],
-            keepalive=self._c["keepalive"],
-            lw=self._c["will"],
-        )  # raises on error
+            if len(self._brokers) > 1:
+                await self._probe()
+        b = self._broker = self._select_broker()
+        sock = None
+        if self._standby is not None and self._standby[0] is b:
+            sock = self._standby[1]
+            self._standby = None
+        try:
+            await self._dns_lookup()  # cached, only waits if there has never been a good address
+            # actually open a socket and connect
+            proto = self._MQTTProto(
+                self._dispatch,
+                self._got_puback,
+                self._got_suback,
+                self._got_pingresp,
+                chunk_sel=self._subs.chunk_cb,
+                stats=self._stats,
+            )
+            # a broker that is unreachable without a RST or FIN, e.g. because packets are dropped,
+            # would keep the connection attempt hanging forever
+            try:
+                await asyncio.wait_for(
+                    proto.connect(
+                        self._addr,
+                        self._c["client_id"],
+                        clean,
+                        user=self._c["user"],
+                        pwd=self._c["password"],
+                        ssl=self._c["ssl_params"],
+                        keepalive=self._c["keepalive"],
+                        lw=self._c["will"],
+                        tls_session=b.tls_session,
+                        version=5 if self._c["mqtt5"] else 4,
+                        session_expiry=self._c["session_expiry"],
+                        sock=sock,
+                    ),
+                    self._c["response_time"],
+                )  # raises on error
+            except asyncio.TimeoutError:
+                await proto.disconnect()
+                raise OSError(-1, CONN_TIMEOUT)
+        except OSError as e:
+            if sock is not None:
+                # the broker may have given up on the standby connection, open a fresh one
+                log.info("standby connection failed: %s", e)
+                return await self.connect()
+            if b.failed(self._c["failover"]) and len(self._brokers) > 1:
+                log.warning("broker %s:%d is down", b.host, b.port)
+            raise
+        b.connected()
+        if sock is None:
+            b.sample(proto.open_ms)
+            if self._srtt == 0:
+                # seed the RTT estimate using the handshake, as TCP does, so the first pings are
+                # already scheduled based on it
+                self._rtt_sample(proto.open_ms)
+        if proto.tls_resumed is not None:
+            self._tls_counts[1 if proto.tls_resumed else 0] += 1
+            if proto.tls_session is not None:
+                b.tls_session = proto.tls_session
         # update state
         if self._state == 0:
             self._state = 1
             # this is the first time we connect, if we asked for a clean session we need to
             # disconnect and reconnect with clean=False so the broker doesn't drop all the state
-            # when we get our first disconnect due to network issues
-            if clean:
+            # when we get our first disconnect due to network issues, MQTT 5 separates clean start
+            # from session expiry so this isn't necessary
+            if clean and not self._c["mqtt5"]:
                 await proto.disconnect()
                 return await self.connect()
         elif self._state > 1:
             await self.disconnect()  # whoops, someone called disconnect() while we were connecting
             raise OSError(-1, "disconnect while connecting")
-        # First thing, retransmit if there is an async packet outstanding and it has not been acked
-        m = self._prev_pub
-        if m is not None and m.pid in self._unacked_pids:
-            log.warning("repub->%s qos=%d pid=%s", m.topic, m.qos, m.pid)
-            self._prev_pub_proto = proto
-            await proto.publish(m, dup=1)
-        self._proto = proto
+        # First thing, retransmit all unacked QoS 1 packets in the order they were originally sent.
+        # No new packets can be added to _inflight while this is in progress because self._proto
+        # is None. If this fails the connection has to be closed here, it isn't self._proto yet.
+        try:
+            for m in self._inflight[:]:
+                log.warning("repub->%s qos=%d pid=%s", m.topic, m.qos, m.pid)
+                if m.pid in self._unacked_pids:
+                    self._unacked_pids[m.pid][2] = None  # the RTT sample would be ambiguous
+                try:
+                    await proto.publish(m, dup=1, flush=False)
+                except ValueError as e:
+                    # MQTTStream source changed since the first transmission: drop the message
+                    log.warning("dropping pid=%s: %s", m.pid, e)
+                    self._got_puback(m.pid)
+                    raise OSError(-1, "repub failed")
+            await proto.flush()
+        except OSError:
+            await proto.disconnect()
+            raise
+        self._set_proto(proto)
         # If we get here without error broker/LAN must be up.
         loop = asyncio.get_event_loop()
         # Start background coroutines that run until the user calls disconnect
         if self._conn_keeper is None:
             self._conn_keeper = loop.create_task(self._keep_connected())
+        while self._workers < self._c["inbound"]:
+            self._workers += 1
+            loop.create_task(self._worker())
         # Start background coroutines that quit on connection fail
         loop.create_task(self._handle_msgs(self._proto))
         loop.create_task(self._keep_alive(self._proto))
+        if self._c["standby"] and len(self._brokers) > 1:
+            loop.create_task(self._keep_standby(self._proto))
+        # A broker that has no session for us, e.g., after a failover or because it lost its state,
+        # doesn't know about our subscriptions, so they have to be restored. Unacked QoS 1 messages
+        # have already been retransmitted above and may get delivered twice as a result.
+        if not (proto.session_present or clean) and self._sub_qos:
+            self._resub = True
+        if self._resub:
+            loop.create_task(self._resubscribe(self._proto))
+        if self._queue and not self._draining:
+            self._draining = True
+            loop.create_task(self._drain())
         # Notify app that we're connected and ready to roll
         if self._c["connect_coro"] is not None:
             loop.create_task(self._c["connect_coro"](self))
@@ -648,7 +2152,46 @@ class MQTTClient:
         self._state = 2  # dead - do not reconnect
         if self._proto is not None:
             await self._proto.disconnect()  # should we do a create_task here?
-        self._proto = None
+        self._set_proto(None)  # wakes up _keep_connected so it exits
+        self._inq_ev.set()  # wake up the inbound tasks so they exit
+        self._inroom.set()
+        await self._close_standby()
+
+    # _resubscribe restores all subscriptions using a single SUBSCRIBE packet. If that fails it
+    # reconnects and connect tries again.
+    async def _resubscribe(self, proto):
+        topics = list(self._sub_qos.items())
+        log.info("restoring %d subscriptions", len(topics))
+        pid = self._newpid()
+        self._unacked_pids[pid] = [asyncio.Event(), None, None]
+        try:
+            await proto.subscribe_many(topics, pid)
+            resp = await self._await_pid(pid)
+            self._resub = False
+            if not isinstance(resp, list):
+                resp = [resp]
+            for (topic, _), qos in zip(topics, resp):
+                if qos >= 0x80:
+                    log.warning("resubscribing to %s refused: 0x%02x", topic, qos)
+        except OSError as e:
+            await self._reconnect(proto, "resub", e)
+
+    # _set_proto changes the current connection and signals the change to tasks waiting for a
+    # connection to come up (_await_proto) or to go down (_keep_connected).
+    def _set_proto(self, proto):
+        self._proto = proto
+        if proto is None:
+            self._conn_up.clear()
+            self._conn_down.set()
+        else:
+            self._conn_down.clear()
+            self._conn_up.set()
+
+    # _await_proto waits until there is a connection and returns its MQTTProto.
+    async def _await_proto(self):
+        while self._proto is None:
+            await self._conn_up.wait()
+        return self._proto
 
     # start the connection process without blocking
     def start(self):
@@ -660,7 +2203,8 @@ class MQTTClient:
     # ===== Manage PIDs and ACKs
     # self._unacked_pids is a hash that contains unacked pids. Each hash value is a list, the first
     # element of which is an asycio.Event that gets set when an ack comes in. The second element is
-    # the return qos value in the case of a subscribe and is None in the case of a publish.
+    # the return qos value in the case of a subscribe and is None in the case of a publish. The
+    # third element is the ticks_ms() when a publish or ping was sent, used to measure the RTT.
 
     def _newpid(self):
         self._lastpid += 1
@@ -668,11 +2212,138 @@ class MQTTClient:
             self._lastpid = 1
         return self._lastpid
 
-    # _got_puback handles a puback by removing the pid from those we're waiting for
-    def _got_puback(self, pid):
+    # _got_puback handles a puback by removing the pid from those we're waiting for and removing the
+    # message from the in-flight window. With MQTT 5 the broker may refuse the message using a
+    # reason code >= 0x80, it is logged and dropped as retransmitting it is pointless.
+    def _got_puback(self, pid, reason=0):
+        if reason >= 0x80:
+            log.warning("publish pid=%d refused: reason 0x%02x", pid, reason)
+            self._stats.pub_refused += 1
         if pid in self._unacked_pids:
-            self._unacked_pids[pid][0].set()
+            e = self._unacked_pids[pid]
+            e[0].set()
+            if e[2] is not None:
+                rtt = int(ticks_diff(ticks_ms(), e[2]))  # the cpy_fix ticks are floats
+                (self._stats.ping_rtt if pid == PING_PID else self._stats.puback_rtt).add(rtt)
+                self._rtt_sample(rtt)
             del self._unacked_pids[pid]
+        if pid in self._outbox_ids:
+            try:
+                self._outbox.ack(self._outbox_ids.pop(pid))
+            except OSError as e:
+                log.warning("outbox ack failed: %s", e)
+        for i in range(len(self._inflight)):
+            if self._inflight[i].pid == pid:
+                self._put_buf(self._inflight[i].message)
+                del self._inflight[i]
+                break
+
+    # ===== Inbound queue
+    # By default the handlers of incoming messages run in the task reading from the socket, which
+    # keeps reading until they're done, so a slow handler stalls everything received after it,
+    # including PUBACKs and PINGRESPs. With config["inbound"] set, _dispatch queues the messages
+    # instead and that many _worker tasks run the handlers. Messages for the same topic are handled
+    # one at a time in the order received, messages for different topics concurrently. The queue
+    # is bounded by inbound_size bytes, when it is full reading waits for room, which pushes back
+    # on the broker via TCP flow control. The PUBACK of a QoS 1 message is sent once it has been
+    # handled or, with ack_early, once it is queued, which lets the broker send more but loses the
+    # messages in the queue if the board resets.
+
+    # _dispatch delivers an incoming message, it is the subs_cb of MQTTProto.
+    def _dispatch(self, topic, msg, retained, qos, dup):
+        if not self._c["inbound"]:
+            return self._deliver(topic, msg, retained, qos, dup)
+        ack = None
+        if qos and not self._c["ack_early"] and self._proto is not None:
+            ack = (self._proto, self._proto.rx_pid)
+        item = (topic, msg, retained, qos, dup, ticks_ms(), ack)
+        sz = len(topic) + len(msg)
+        if self._inq and self._inlen + sz > self._c["inbound_size"]:
+            self._stats.inbound_stalls += 1
+            return self._enqueue_in(item, sz)
+        self._inq_add(item, sz)
+        return ACK_LATER if ack is not None else None
+
+    # _enqueue_in waits for room in the inbound queue and adds a message to it.
+    async def _enqueue_in(self, item, sz):
+        while self._inq and self._inlen + sz > self._c["inbound_size"]:
+            if self._state > 1:
+                return None
+            self._inroom.clear()
+            await self._inroom.wait()
+        self._inq_add(item, sz)
+        return ACK_LATER if item[6] is not None else None
+
+    def _inq_add(self, item, sz):
+        self._inq.append(item)
+        self._inlen += sz
+        if len(self._inq) > self._stats.inbound_max:
+            self._stats.inbound_max = len(self._inq)
+        self._inq_ev.set()
+
+    # _next_in removes and returns the oldest message in the inbound queue whose topic isn't being
+    # handled already, or None if there is none.
+    def _next_in(self):
+        for i in range(len(self._inq)):
+            if self._inq[i][0] not in self._inbusy:
+                item = self._inq.pop(i)
+                self._inlen -= len(item[0]) + len(item[1])
+                self._inroom.set()
+                return item
+        return None
+
+    # _worker is an inbound task, it runs the handlers of queued messages until disconnect().
+    async def _worker(self):
+        while self._state <= 1:
+            item = self._next_in()
+            if item is None:
+                self._inq_ev.clear()
+                await self._inq_ev.wait()
+                continue
+            topic = item[0]
+            self._inbusy.append(topic)
+            t0 = ticks_ms()
+            try:
+                aw = self._deliver(*item[:5])
+                if is_awaitable(aw):
+                    await aw
+            except Exception as e:
+                log.exc(e, "exception in handler")
+            self._inbusy.remove(topic)
+            t1 = ticks_ms()
+            self._stats.handler_ms.add(int(ticks_diff(t1, t0)))
+            self._stats.inbound_ms.add(int(ticks_diff(t1, item[5])))
+            ack = item[6]
+            if ack is not None and ack[0] is self._proto:
+                ack[0].puback(ack[1])  # else the broker sends the message again
+            self._inq_ev.set()  # a message for the same topic may be waiting
+
+    # _deliver delivers an incoming message to the handlers of all matching subscriptions or, if
+    # there are none, to the subs_cb from the config. If handlers are coroutines it returns a
+    # coroutine that awaits them.
+    def _deliver(self, topic, msg, retained, qos, dup):
+        handlers = self._subs.match(topic)
+        if not handlers:
+            return self._c["subs_cb"](topic, msg, retained, qos, dup)
+        aws = None
+        for cb in handlers:
+            try:
+                r = cb(topic, msg, retained, qos, dup)
+                if is_awaitable(r):
+                    if aws is None:
+                        aws = []
+                    aws.append(r)
+            except Exception as e:
+                log.exc(e, "exception in handler")
+        if aws is not None:
+            return self._await_all(aws)
+
+    async def _await_all(self, aws):
+        for a in aws:
+            try:
+                await a
+            except Exception as e:
+                log.exc(e, "exception in handler")
 
     def _got_pingresp(self):
         self._got_puback(PING_PID)
@@ -681,19 +2352,59 @@ class MQTTClient:
     # _await_pid will have to delete the item from the list
     def _got_suback(self, pid, actual_qos):
         if pid in self._unacked_pids:
-            self._unacked_pids[pid][1] = actual_qos
-            self._unacked_pids[pid][0].set()
+            e = self._unacked_pids[pid]
+            e[1] = actual_qos
+            e[0].set()
+            if e[2] is not None:
+                self._rtt_sample(ticks_diff(ticks_ms(), e[2]))
+                e[2] = None
+
+    # _rtt_sample updates the RTT estimates with a new sample in milliseconds and computes the
+    # timeout for responses from the broker, see RFC 6298 for the algorithm. Samples are only taken
+    # for packets that were not retransmitted (Karn's algorithm).
+    def _rtt_sample(self, rtt):
+        rtt = int(rtt)  # the cpy_fix ticks are floats
+        if self._srtt == 0:
+            self._srtt = rtt << 3
+            self._rttvar = rtt << 1
+        else:
+            delta = rtt - (self._srtt >> 3)
+            self._srtt += delta
+            if delta < 0:
+                delta = -delta
+            self._rttvar += delta - (self._rttvar >> 2)
+        rto = (self._srtt >> 3) + max(_RTT_GRANULARITY_MS, self._rttvar)
+        rto = max(rto, self._c["min_response_time"] * 1000)
+        self._rto_ms = min(rto, self._c["response_time"] * 1000)
+
+    # _ack_timeout returns the time in seconds to wait for a response from the broker.
+    def _ack_timeout(self):
+        return self._rto_ms / 1000
+
+    # _ping_interval_ms returns the idle time after which _keep_alive checks the connection using a
+    # ping: twice the response timeout, so a dead connection is noticed within three times the
+    # timeout, but at most response_time, which is also what it is until an RTT has been measured.
+    def _ping_interval_ms(self):
+        return min(self._rto_ms * 2, self._c["response_time"] * 1000)
+
+    # _ack_timed_out doubles the response timeout after a time-out, as TCP does, so a link that got
+    # slower doesn't cause a string of reconnections, the next RTT sample resets it.
+    def _ack_timed_out(self):
+        self._rto_ms = min(self._rto_ms * 2, self._c["response_time"] * 1000)
 
     # _await_pid waits until the broker ACKs a pub or sub message, or it times out.
     # If the element of the self._unacked_pids list still exists, it returns the second element.
     async def _await_pid(self, pid):
         if pid not in self._unacked_pids:
             return None
-        # wait for ACK to come in with a timeout # TODO: calculate timeout based on time sent
+        # wait for ACK to come in with a timeout, which starts now rather than when the packet was
+        # sent: the time it took to get the packet onto the socket, e.g. a large publish on a slow
+        # link, doesn't count against the broker
         try:
             if not self._unacked_pids[pid][0].is_set():
-                await asyncio.wait_for(self._unacked_pids[pid][0].wait(), self._c["response_time"])
+                await asyncio.wait_for(self._unacked_pids[pid][0].wait(), self._ack_timeout())
         except asyncio.TimeoutError:
+            self._ack_timed_out()
             raise OSError(-1, CONN_TIMEOUT)
         # return second list element -- this only happens for subscribe acks
         if pid in self._unacked_pids:
@@ -710,31 +2421,36 @@ class MQTTClient:
     async def _handle_msgs(self, proto):
         try:
             while True:
-                await proto.read_msg()
+                await proto.read_msgs()
         except OSError as e:
             await self._reconnect(proto, "read_msg", e)
 
-    # ping and wait for response, wrapped in a coroutine to be used in asyncio.wait_for()
+    # ping and wait for response, _await_pid times out and backs off the response timeout
     async def _ping_n_wait(self, proto):
         await proto.ping()
         await self._await_pid(PING_PID)
 
     # Keep connection alive MQTT spec 3.1.2.10 Keep Alive.
     # Runs until ping failure or no response in keepalive period.
+    # An idle connection is pinged after _ping_interval_ms, which adapts to the measured RTT.
     async def _keep_alive(self, proto):
-        rt_ms = self._c["response_time"] * 1000
         try:
             while proto.isconnected():
+                rt_ms = self._ping_interval_ms()
                 dt = ticks_diff(ticks_ms(), proto.last_ack)
                 if dt > rt_ms:
                     # it's time for another ping...
-                    self._unacked_pids[PING_PID] = [asyncio.Event(), None]
-                    await asyncio.wait_for(self._ping_n_wait(proto), self._c["response_time"])
+                    self._unacked_pids[PING_PID] = [asyncio.Event(), None, ticks_ms()]
+                    await self._ping_n_wait(proto)
                     dt = ticks_diff(ticks_ms(), proto.last_ack)
                 sleep_time = rt_ms - dt
                 if sleep_time < rt_ms / 4:  # avoid sending pings too frequently
                     sleep_time = rt_ms / 4
-                await asyncio.sleep_ms(sleep_time)
+                try:
+                    # sleep, but exit right away if the connection goes down
+                    await asyncio.wait_for(self._conn_down.wait(), sleep_time / 1000)
+                except asyncio.TimeoutError:
+                    pass
         except Exception:
             await self._reconnect(proto, "keepalive")
 
@@ -744,110 +2460,282 @@ class MQTTClient:
     async def _reconnect(self, proto, why, detail="n/a"):
         if self._state == 1 and self._proto == proto:
             log.info("dead socket: %s failed (%s)", why, detail)
-            await self._proto.disconnect()  # should this be in a create_task() ?
-            self._proto = None
+            self._stats.reconnects[why] = self._stats.reconnects.get(why, 0) + 1
+            # clear _proto first so the other tasks that notice the failure while the disconnect
+            # is in progress don't count it again
+            self._set_proto(None)
+            await proto.disconnect()  # should this be in a create_task() ?
             loop = asyncio.get_event_loop()
             if self._c["wifi_coro"] is not None:
                 loop.create_task(self._c["wifi_coro"](False))  # Notify application
 
     # _keep_connected runs until disconnect() and ensures that there's always a connection.
     # It's strategy is to wait for the current connection to die and then to first reconnect at the
-    # MQTT/TCP level. If that fails then it disconnects and reconnects wifi.
+    # MQTT/TCP level. Between failed attempts it backs off as directed by self._backoff. Depending
+    # on the cause of the failure it refreshes the broker's address (TCP), drops the TLS session
+    # (TLS), and after _ESCALATE consecutive failures it disconnects and reconnects Wifi. If the
+    # broker refuses the connection it just backs off.
     # TODO:
-    # - collect stats about which measures lead to success
     # - check whether first connection after wifi reconnect has to be delayed
-    # - as an additional step, try to re-resolve dns
     async def _keep_connected(self):
+        step = None  # most drastic recovery step taken since the connection failed
         while self._state <= 1:
             if self._proto is not None:
-                # We're connected, pause for 1 second
-                await asyncio.sleep(_CONN_DELAY)
+                # We're connected, wait for the connection to fail
+                await self._conn_down.wait()
+                step = "reconnect"
                 continue
             # we have a problem, need some form of reconnection
             if self._c["interface"].isconnected():
                 # wifi thinks it's connected, be optimistic and reconnect to broker
                 try:
                     await self.connect()
-                    log.debug("reconnect OK!")
+                    log.debug("reconnect OK (%s)", step)
+                    if step is not None:
+                        self._backoff.succeeded(step)
                     continue
                 except OSError as e:
-                    # Can get ECONNABORTED or -1. The latter signifies no or bad CONNACK received.
-                    # connecting to broker didn't work, disconnect Wifi
+                    cause = _fail_cause(e, self._c["ssl_params"])
+                    log.info("connect failed (%s): %s", cause, e)
+                    n = self._backoff.failed(cause)
+                    if cause == "tcp":
+                        # maybe the broker's address changed
+                        self._broker.dns.refresh()
+                        step = _max_step(step, "dns")
+                    elif cause == "tls":
+                        # maybe the broker doesn't like the session anymore
+                        self._broker.tls_session = None
+                        step = _max_step(step, "tls")
+                    if self._select_broker() is not self._broker:
+                        # the broker just went down, fail over right away
+                        step = _max_step(step, "failover")
+                        continue
                     if (
                         self._proto is not None
                     ):  # defensive coding -- not sure this can be triggered
                         await self._reconnect(self._proto, "reconnect failed", e)
-                self._c["interface"].disconnect()
-                await asyncio.sleep(_CONN_DELAY)
+                    if n >= _ESCALATE and cause != "connack":
+                        self._c["interface"].disconnect()
+                    await asyncio.sleep_ms(self._backoff.delay_ms(cause))
                 continue  # not falling through to force recheck of while condition
             # reconnect to Wifi
             try:
+                step = _max_step(step, "wifi")
                 await self.wifi_connect()
             except OSError as e:
                 log.warning("error in Wifi reconnect: {}.".format(e))
-                await asyncio.sleep(_CONN_DELAY)
+                self._backoff.failed("wifi")
+                await asyncio.sleep_ms(self._backoff.delay_ms("wifi"))
         # log.debug('Disconnected, exited _keep_connected')
         self._conn_keeper = None
 
-    async def subscribe(self, topic, qos=0):
+    # subscribe to a topic filter and wait for the SUBACK. If cb is provided, messages matching the
+    # filter are passed to cb instead of subs_cb. If chunk_cb is provided, messages matching the
+    # filter are handed to chunk_cb as they arrive in chunks bounded by the receive buffer size,
+    # see MQTTProto._read_chunks.
+    async def subscribe(self, topic, qos=0, cb=None, chunk_cb=None):
         _qos_check(qos)
+        t = topic.encode() if isinstance(topic, str) else topic
+        if cb is not None or chunk_cb is not None:
+            self._subs.add(t, cb, chunk_cb)
+        actual_qos = (await self.subscribe_many([(topic, qos)]))[0]
+        if actual_qos >= 0x80 or actual_qos != qos:
+            self._subs.remove(t)  # else a retry would register the handlers twice
+            if actual_qos >= 0x80:  # MQTT 5 has a variety of reason codes for refusals
+                raise OSError(-1, "subscribe failed: refused 0x%02x" % actual_qos)
+            raise OSError(-1, "subscribe failed: qos mismatch")
+
+    # subscribe_many subscribes to a list of (topic, qos) tuples using a single SUBSCRIBE packet and
+    # returns the list of QoS levels granted by the broker, >=0x80 signalling a refusal. This saves
+    # round-trips compared to subscribing to one topic after the other.
+    async def subscribe_many(self, topics):
+        for _, qos in topics:
+            _qos_check(qos)
+        resp = await self._sub_unsub(topics, True)
+        if not isinstance(resp, list):
+            resp = [resp]
+        if len(resp) != len(topics):
+            raise OSError(-1, "subscribe failed: bad suback")
+        for (topic, _), qos in zip(topics, resp):
+            if qos < 0x80:
+                self._sub_qos[topic.encode() if isinstance(topic, str) else topic] = qos
+        return resp
+
+    # unsubscribe from a topic filter and wait for the UNSUBACK, handlers registered with subscribe
+    # are removed
+    async def unsubscribe(self, topic):
+        await self.unsubscribe_many([topic])
+
+    # unsubscribe_many unsubscribes from a list of topic filters using a single UNSUBSCRIBE packet
+    async def unsubscribe_many(self, topics):
+        for t in topics:
+            t = t.encode() if isinstance(t, str) else t
+            self._subs.remove(t)
+            self._sub_qos.pop(t, None)
+        await self._sub_unsub(topics, False)
+
+    # _sub_unsub sends a (un)subscribe packet and waits for the ACK, retrying on a fresh connection
+    # if that fails. It returns what the ACK carried.
+    async def _sub_unsub(self, topics, sub):
         pid = self._newpid()
-        self._unacked_pids[pid] = [asyncio.Event(), None]
+        self._unacked_pids[pid] = [asyncio.Event(), None, None]
+        first = True
         while True:
-            while self._proto is None:
-                await asyncio.sleep(_CONN_DELAY)
+            proto = await self._await_proto()
+            # only sample the RTT of the first attempt, a later ACK might be for an earlier one
+            self._unacked_pids[pid][2] = ticks_ms() if first else None
+            first = False
             try:
-                proto = self._proto
-                await self._proto.subscribe(topic, qos, pid)
-                actual_qos = await self._await_pid(pid)
-                if actual_qos == qos:
-                    return
-                elif actual_qos == 0x80:
-                    raise OSError(-2, "refused")
+                if sub:
+                    await proto.subscribe_many(topics, pid)
                 else:
-                    raise OSError(-2, "qos mismatch")
+                    await proto.unsubscribe(topics, pid)
+                return await self._await_pid(pid)
             except OSError as e:
-                if e.args[0] == -2:
-                    raise OSError(-1, "subscribe failed: " + e.args[1])
-                await self._reconnect(proto, "sub", e)
+                await self._reconnect(proto, "sub" if sub else "unsub", e)
+
+    # _await_window waits until there is a connection and no more than max_inflight QoS 1
+    # publishes are unacked. It awaits the ACK of the oldest one, as ACKs arrive in order, and
+    # reconnects if that times out, which retransmits everything in the window.
+    async def _await_window(self):
+        while True:
+            proto = await self._await_proto()
+            # MQTT 5: the broker limits the number of unacked publishes using Receive Maximum
+            if len(self._inflight) <= min(self._c["max_inflight"], proto.receive_max - 1):
+                return
+            try:
+                await proto.flush()  # the window is full, no point holding back the publishes
+                await self._await_pid(self._inflight[0].pid)
+            except OSError as e:
+                await self._reconnect(proto, "pub", e)
 
     # publish with support for async. For QoS=0 this means publish and done. For QoS=1&sync=True
     # this means publish and wait for ack. For QoS=1&sync=False this means publish, then wait
-    # for the _prev_pub slot to be available, e.g. by waiting for an ack.
-    async def publish(self, topic, msg, retain=False, qos=0, sync=True):
-        dup = 0
+    # for space in the in-flight window, i.e., until at most max_inflight publishes are unacked.
+    # All unacked QoS=1 messages are kept in _inflight and retransmitted by connect() when a new
+    # connection is made, so there is no retransmission here.
+    # If config queue_size is set and there is no connection, the message is queued with the given
+    # priority and publish returns immediately, see _enqueue. Messages keep being queued until
+    # _drain has published the queue after the reconnection, so they go out in order.
+    async def publish(self, topic, msg, retain=False, qos=0, sync=True, prio=PUB_NORMAL):
+        if self._c["queue_size"] and (self._proto is None or self._draining):
+            _qos_check(qos)
+            self._enqueue(prio, topic, msg, retain, qos)
+            return
+        await self._publish(topic, msg, retain, qos, sync)
+
+    # _enqueue adds a message to the queue of publishes waiting for a connection and trims the
+    # queue to queue_size bytes, like MQTTLog.resize does for log messages, except that messages
+    # are dropped by priority: the oldest droppable ones first, then normal ones, then critical.
+    def _enqueue(self, prio, topic, msg, retain, qos):
+        q = self._queue
+        q.append((prio, topic, msg, retain, qos))
+        self._qlen += len(topic) + len(msg)
+        max_len = self._c["queue_size"]
+        prio = PUB_DROPPABLE
+        while self._qlen > max_len:
+            i = 0
+            while self._qlen > max_len and i < len(q):
+                if q[i][0] <= prio:
+                    log.warning("queue full, dropping msg for %s", q[i][1])
+                    self._qlen -= len(q[i][1]) + len(q[i][2])
+                    self._stats.queue_dropped += 1
+                    self._put_buf(q[i][2])
+                    del q[i]
+                else:
+                    i += 1
+            prio += 1
+
+    # _drain publishes the queued messages in order once there is a connection, using sync=False
+    # so the in-flight window is filled. It keeps going across reconnections and stops when the
+    # queue is empty or the client is disconnected.
+    async def _drain(self):
+        try:
+            while self._queue and self._state < 2:
+                prio, topic, msg, retain, qos = self._queue.pop(0)
+                self._qlen -= len(topic) + len(msg)
+                try:
+                    await self._publish(topic, msg, retain, qos, False)
+                except Exception as e:
+                    log.warning("dropping queued msg for %s: %s", topic, e)
+                    self._put_buf(msg)
+        finally:
+            self._draining = False
+
+    async def _publish(self, topic, msg, retain, qos, sync):
         pid = self._newpid() if qos else None
         message = MQTTMessage(topic, msg, retain, qos, pid)
-        while True:
-            # print("pub begin for pid=%s" % pid)
-            # first we need a connection
-            while self._proto is None:
-                await asyncio.sleep(_CONN_DELAY)
-            proto = self._proto
-            try:
-                # now publish the new packet on the same connection
-                # print("pub->%s qos=%d pid=%s" % (message.topic, message.qos, message.pid))
-                await proto.publish(message, dup)
-                if qos == 0:
+        if qos == 0:
+            while True:
+                # first we need a connection
+                proto = await self._await_proto()
+                try:
+                    await proto.publish(message, flush=sync)
+                    self._put_buf(msg)
                     return
-                # the following is atomic with the above publish
-                self._unacked_pids[pid] = [asyncio.Event(), None]
-                if not sync:
-                    # async packet, need to wait 'til self._prev_pub becomes available
-                    while self._prev_pub is not None:  # only False on the first async pub...
-                        ppid = self._prev_pub.pid
-                        if ppid is not None:
-                            # print("pub pid=%d awaiting prev_pid=%d" % (pid, ppid))
-                            await self._await_pid(ppid)
-                        if self._prev_pub.pid == ppid:
-                            # no-one has snatched the slot yet: our turn!
-                            # print("pub pid=%d is now prev" % pid)
-                            break
-                    self._prev_pub = message
-                    self._prev_pub_proto = proto
-                else:
-                    # sync packet
-                    await self._await_pid(message.pid)
-                return
+                except OSError as e:
+                    await self._reconnect(proto, "pub", e)
+        # QoS=1: wait for a connection and room in the window (concurrent publishers may have
+        # filled it), then add the message to the window and send it, all without yielding
+        await self._await_window()
+        proto = self._proto
+        self._unacked_pids[pid] = [asyncio.Event(), None, ticks_ms()]
+        self._inflight.append(message)
+        if self._outbox is not None and not isinstance(msg, MQTTStream):
+            m = message
+            if isinstance(msg, PubBuf):  # the outbox hangs on to the message, it needs a copy
+                m = MQTTMessage(topic, bytes(msg.payload()), retain, qos, pid)
+            try:
+                self._outbox_ids[pid] = self._outbox.add(m)
+            except OSError as e:
+                log.warning("outbox add failed: %s", e)  # publish anyway, just not persistently
+        try:
+            # print("pub->%s qos=%d pid=%s" % (message.topic, message.qos, message.pid))
+            await proto.publish(message, flush=sync)
+        except OSError as e:
+            await self._reconnect(proto, "pub", e)
+        except ValueError:
+            # the message can't be sent (bad MQTTStream), don't retransmit it either
+            self._got_puback(pid)
+            raise
+        if not sync:
+            await self._await_window()
+            return
+        # sync packet: wait for the ACK, reconnecting (which retransmits) if it doesn't come
+        while pid in self._unacked_pids:
+            proto = await self._await_proto()
+            try:
+                await self._await_pid(pid)
             except OSError as e:
                 await self._reconnect(proto, "pub", e)
+
+    # get_buf returns a PubBuf with room for a payload of at least size bytes, reusing one that has
+    # been recycled if possible. The caller fills in the payload and passes it to publish_buf.
+    def get_buf(self, size=1400):
+        for i in range(len(self._bufs)):
+            if len(self._bufs[i].data) >= size:
+                return self._bufs.pop(i)
+        return PubBuf(size)
+
+    # _put_buf recycles a PubBuf that has been sent (QoS 0), acked (QoS 1), or dropped, anything
+    # else is ignored, as is a PubBuf that is already in the pool.
+    def _put_buf(self, pb):
+        if isinstance(pb, PubBuf) and len(self._bufs) < self._c["buf_pool"] and pb not in self._bufs:
+            pb.len = 0
+            self._bufs.append(pb)
+
+    # publish_buf publishes the payload in a PubBuf obtained from get_buf without copying it, see
+    # publish for the parameters. The PubBuf must not be touched afterwards, it is recycled once
+    # the message has been sent or, for QoS 1, acked.
+    async def publish_buf(self, topic, pb, retain=False, qos=0, sync=True):
+        await self.publish(topic, pb, retain, qos, sync)
+
+    # publish_stream publishes a message of the given length whose data is read from src while it
+    # is being sent, see MQTTStream for the types of sources supported. This allows large
+    # messages to be sent using a small fixed-size buffer. For QoS=1 the source must be seekable
+    # so the message can be retransmitted, and it must not be modified until it is acked.
+    async def publish_stream(self, topic, src, length, retain=False, qos=0, sync=True):
+        stream = MQTTStream(src, length)
+        if qos and not stream.seekable():
+            raise ValueError("QoS 1 requires seekable stream")
+        await self._publish(topic, stream, retain, qos, sync)  # the source can't be queued
@@ -0,0 +1,108 @@
+# Allocation benchmark for the MQTTProto receive path in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Feeds a stream of small packets (PUBACK, PINGRESP, SUBACK, small PUBLISH) to MQTTProto.read_msg
+# through a fake socket and reports the heap bytes allocated per packet in steady state.
+# Run this using micropython (unix port or `pyboard test-alloc.py`) to get allocation counts via
+# gc.mem_alloc(). CPython frees eagerly and has no allocation counter, so there the benchmark only
+# reports the net heap growth over the whole run, which doesn't grow with the number of packets: it
+# is the few hundred bytes of objects that happen to be alive at the end, such as the memoryviews
+# of the last buffer fill and the arguments of the last callback. Packets that were parsed without
+# allocating cannot be told apart from ones whose allocations were freed right away.
+
+import sys, gc
+from mqtt_async import MQTTProto, MQTTMessage
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+NUM = 200  # packets of each kind
+
+# FakeSock returns the bytes in `data` in chunks of at most `chunk` bytes.
+class FakeSock:
+    def __init__(self, data, chunk=1400):
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.out = bytearray()
+    async def readinto(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+    def write(self, b):
+        pass
+    async def drain(self):
+        pass
+    def close(self):
+        pass
+    async def wait_closed(self):
+        pass
+
+def nop_cb(*args):
+    pass
+
+if sys.implementation.name == "micropython":
+    def alloc_start():
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+    def alloc_end(a0):
+        a = gc.mem_alloc() - a0
+        gc.enable()
+        return a
+else:
+    import tracemalloc
+    def alloc_start():
+        gc.collect()
+        tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+    def alloc_end(a0):
+        a = tracemalloc.get_traced_memory()[0] - a0
+        tracemalloc.stop()
+        return a
+
+async def nop():
+    pass
+
+# bench_calls measures the cost of calling and awaiting a coroutine, which read_msg incurs
+# irrespective of what it does.
+async def bench_calls():
+    a0 = alloc_start()
+    for _ in range(NUM):
+        await nop()
+    return alloc_end(a0)
+
+async def bench(name, pkt):
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = FakeSock(pkt * NUM * 2)
+    # warm up: first fill of the buffer etc.
+    for _ in range(NUM):
+        await mqc.read_msg()
+    a0 = alloc_start()
+    for _ in range(NUM):
+        await mqc.read_msg()
+    a = alloc_end(a0)
+    if sys.implementation.name == "micropython":
+        print("{:10s}: {:6.1f} bytes/packet".format(name, a / NUM))
+    else:
+        print("{:10s}: {:6d} bytes net growth over {} packets".format(name, a, NUM))
+
+async def main():
+    call = await bench_calls()
+    if sys.implementation.name == "micropython":
+        print("coroutine call: {:6.1f} bytes/call".format(call / NUM))
+    else:
+        print("coroutine call: {:6d} bytes net growth over {} calls".format(call, NUM))
+    await bench("PINGRESP", b"\xd0\0")
+    await bench("PUBACK", b"\x40\x02\0\x05")
+    await bench("SUBACK", b"\x90\x03\0\x06\x01")
+    # publish packets necessarily allocate topic and message for the callback
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = FakeSock(b"")
+    mqc._sock.write = lambda b: mqc._sock.out.extend(b)
+    await mqc.publish(MQTTMessage("bench/topic", b"0123456789"))
+    await bench("PUB-qos0", bytes(mqc._sock.out))
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
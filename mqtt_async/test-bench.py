@@ -13,6 +13,13 @@ except:
 
 from mqtt_async import MQTTClient, MQTTMessage, config
 
+# under CPython the benchmark uses a local broker stand-in, or the broker in $MQTT_BROKER
+if sys.implementation.name == 'cpython':
+    from mqbroker import shared_broker
+    broker = shared_broker()
+    config["ssid"] = "linux" # the CPython interface stub just needs one
+else:
+    broker = ('192.168.0.14', 1883)
 cli_id = 'esp32/test-bench'
 prefix = 'test/esp32-bench'
 
@@ -30,11 +37,9 @@ except:
 # callbacks
 
 msg_q = []
-def subs_cb(msg):
+def subs_cb(topic, msg, retained, qos, dup):
     global msg_q
-    #print("got pub", msg.pid)
-    msg.message = msg.message[:10]
-    msg_q.append(msg)
+    msg_q.append(MQTTMessage(topic, msg[:10], retained, qos))
 
 wifi_status = None
 async def wifi_coro(status):
@@ -58,6 +63,8 @@ cli_num = random.randrange(100000000) # add number to client id so each test
 def fresh_config():
     global cli_num, conn_calls, conn_fail
     conf = config.copy()
+    conf["server"] = broker[0]
+    conf["port"] = broker[1]
     conf["client_id"] = "{}-{}".format(cli_id, cli_num)
     cli_num += 1
     conf["wifi_coro"] = wifi_coro
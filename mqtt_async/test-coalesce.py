@@ -0,0 +1,84 @@
+# Write coalescing benchmark for MQTTProto in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Counts the socket writes per message, each of which results in at least one TCP segment (and one
+# TLS record if TLS is used), for a burst of incoming QoS 1 messages that need to be PUBACKed and
+# for a stream of small outgoing publishes. The "before" numbers are produced by writing each
+# packet straight to the socket as MQTTProto did prior to coalescing writes.
+# Run this using micropython (unix port or `pyboard test-coalesce.py`) or cpython.
+
+from mqtt_async import MQTTProto, MQTTMessage
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+NUM = 100  # messages per burst
+
+# FakeSock returns the bytes in `data` in chunks of at most `chunk` bytes and counts writes.
+class FakeSock:
+    def __init__(self, data=b"", chunk=1400):
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.writes = 0
+    async def readinto(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+    def write(self, b):
+        self.writes += 1
+    async def drain(self):
+        pass
+    def close(self):
+        pass
+    async def wait_closed(self):
+        pass
+
+def nop_cb(*args):
+    pass
+
+# new_proto returns an MQTTProto, with coalesce=False it writes each packet like it used to.
+def new_proto(sock, coalesce):
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = sock
+    if not coalesce:
+        mqc._queue_write = lambda pkt, flush=False, count=True: mqc._as_write(pkt)
+        mqc._ack = lambda pid: sock.write(bytes([0x40, 2, pid >> 8, pid & 0xFF]))
+    return mqc
+
+# bench_puback reads a burst of QoS 1 messages arriving in chunks of `chunk` bytes.
+async def bench_puback(coalesce, chunk):
+    pkt = MQTTMessage("bench/topic", b"0123456789", qos=1, pid=1)
+    mqc = new_proto(FakeSock(), True)
+    mqc._sock.out = bytearray()
+    mqc._sock.write = lambda b: mqc._sock.out.extend(b)
+    await mqc.publish(pkt)
+    mqc = new_proto(FakeSock(bytes(mqc._sock.out) * NUM, chunk), coalesce)
+    try:
+        while True:
+            await mqc.read_msg()
+    except OSError:
+        pass  # EOF
+    return mqc._sock.writes / NUM
+
+# bench_pub publishes small messages without waiting for the flush.
+async def bench_pub(coalesce):
+    mqc = new_proto(FakeSock(), coalesce)
+    for i in range(NUM):
+        await mqc.publish(MQTTMessage("bench/topic", b"0123456789", qos=1, pid=i + 1), flush=False)
+    await asyncio.sleep_ms(50)
+    return mqc._sock.writes / NUM
+
+async def main():
+    print("segments per message: before after")
+    for chunk in (1400, 100):
+        b = await bench_puback(False, chunk)
+        a = await bench_puback(True, chunk)
+        print("PUBACK burst, {:4d}-byte reads: {:5.2f}  {:5.2f}".format(chunk, b, a))
+    b = await bench_pub(False)
+    a = await bench_pub(True)
+    print("small publishes (sync=False):  {:5.2f}  {:5.2f}".format(b, a))
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
@@ -0,0 +1,112 @@
+# PUBACK latency benchmark for MQTTProto in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Measures the time from the arrival of an incoming QoS 1 message to the write of its PUBACK while
+# another task publishes large messages over a slow link. The "before" numbers are produced by
+# sending the PUBACKs through the socket lock like MQTTProto did prior to the control packet lane,
+# which makes them wait for the large publish in progress and for the ones queued behind it: _ack
+# (and _queue_ctl for pings) are patched and the read loop waits for each PUBACK to be written
+# before reading the next message, as read_msg used to.
+# Run this using micropython (unix port or `pyboard test-ctl.py`) or cpython.
+
+from mqtt_async import MQTTProto, MQTTMessage, ticks_ms, ticks_diff
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+NUM = 50  # incoming messages
+INTERVAL = 7  # ms between incoming messages
+BIG = 8000  # bytes per large publish
+KB_MS = 2  # link speed: ms per KB written
+
+# SlowSock delivers one packet from `pkts` every INTERVAL ms, drains writes at KB_MS per KB, and
+# records the time at which each PUBACK is written.
+class SlowSock:
+    def __init__(self, pkts):
+        self.pkts = pkts
+        self.arrived = {}
+        self.acked = {}
+        self.pending = 0
+    async def readinto(self, buf):
+        if not self.pkts:
+            await asyncio.sleep_ms(10)
+            return 0  # EOF
+        await asyncio.sleep_ms(INTERVAL)
+        pid, pkt = self.pkts.pop(0)
+        self.arrived[pid] = ticks_ms()
+        buf[: len(pkt)] = pkt
+        return len(pkt)
+    def write(self, b):
+        i = 0
+        while i + 4 <= len(b) and b[i] == 0x40:
+            self.acked[b[i + 2] << 8 | b[i + 3]] = ticks_ms()
+            i += 4
+        self.pending += len(b)
+    async def drain(self):
+        n = self.pending
+        self.pending = 0
+        await asyncio.sleep_ms(n * KB_MS // 1024)
+    def close(self):
+        pass
+    async def wait_closed(self):
+        pass
+
+def nop_cb(*args):
+    pass
+
+# wire returns the wire format of a message as produced by MQTTProto.
+async def wire(msg):
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = SlowSock([])
+    out = bytearray()
+    mqc._sock.write = lambda b: out.extend(b)
+    await mqc.publish(msg)
+    return bytes(out)
+
+async def bench(lane):
+    pkts = []
+    for pid in range(1, NUM + 1):
+        pkts.append((pid, await wire(MQTTMessage("bench/in", b"0123456789", qos=1, pid=pid))))
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = SlowSock(pkts)
+    acks = []  # pids of PUBACKs to send through the lock
+    if not lane:
+        async def queue_ctl(pkt, flush=False):
+            async with mqc._lock:
+                await mqc._queue_write(pkt, flush)
+        mqc._queue_ctl = queue_ctl
+        mqc._ack = acks.append
+    done = False
+
+    async def publisher():
+        while not done:
+            await mqc.publish(MQTTMessage("bench/out", bytes(BIG)))
+
+    loop = asyncio.get_event_loop()
+    pubs = [loop.create_task(publisher()) for _ in range(2)]
+    try:
+        while True:
+            await mqc.read_msg()
+            while acks:
+                pid = acks.pop(0)
+                await mqc._queue_ctl(bytes([0x40, 2, pid >> 8, pid & 0xFF]))
+    except OSError:
+        pass  # EOF
+    done = True
+    for t in pubs:
+        await t
+    await mqc.flush()
+    sock = mqc._sock
+    lat = sorted(ticks_diff(sock.acked[pid], sock.arrived[pid]) for pid in sock.acked)
+    return len(lat), lat[len(lat) // 2], lat[-1]
+
+async def main():
+    print("PUBACK latency with concurrent {}-byte publishes".format(BIG))
+    for lane in (False, True):
+        n, med, mx = await bench(lane)
+        print("{:6s}: {:2d} acks, median {:5.1f}ms, max {:5.1f}ms".format(
+            "after" if lane else "before", n, med, mx))
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
@@ -0,0 +1,87 @@
+# Receive rate benchmark for MQTTProto in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Feeds a stream of small QoS 0 and QoS 1 publish packets to MQTTProto through a fake socket that
+# returns them in 1400-byte reads, like TCP segments, and reports the messages per second handled
+# by calling read_msg once per packet and by calling read_msgs, which decodes all the buffered
+# packets in one pass.
+# Run this using micropython (unix port or `pyboard test-decode.py`) or cpython. To get a baseline,
+# pass the directory of another version of mqtt_async.py, e.g. one prior to the synchronous decode:
+#     mkdir /tmp/old; git show adc2af3^:mqtt_async/mqtt_async.py >/tmp/old/mqtt_async.py
+#     python3 test-decode.py /tmp/old
+# versions without read_msgs only report read_msg.
+
+import sys
+
+if len(sys.argv) > 1:
+    sys.path.insert(0, sys.argv[1])
+from mqtt_async import MQTTProto, MQTTMessage, ticks_ms, ticks_diff
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+NUM = 20000  # messages per run
+REPS = 5  # runs per case, the best one is reported as it is much more repeatable than a single one
+
+# FakeSock returns the bytes in `data` in chunks of at most `chunk` bytes.
+class FakeSock:
+    def __init__(self, data, chunk=1400):
+        self.data = memoryview(data)
+        self.chunk = chunk
+    async def readinto(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+    def write(self, b):
+        pass
+    async def drain(self):
+        pass
+    def close(self):
+        pass
+    async def wait_closed(self):
+        pass
+
+def nop_cb(*args):
+    pass
+
+async def wire(msg):
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    out = bytearray()
+    mqc._sock = FakeSock(b"")
+    mqc._sock.write = lambda b: out.extend(b)
+    await mqc.publish(msg)
+    return bytes(out)
+
+async def best(qos, batch):
+    return max([await bench(qos, batch) for _ in range(REPS)])
+
+async def bench(qos, batch):
+    pkt = await wire(MQTTMessage("sensors/node1/temp", b"21.5", qos=qos, pid=qos and 1))
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    mqc._sock = FakeSock(pkt * NUM)
+    n = 0
+    t0 = ticks_ms()
+    if batch:
+        while n < NUM:
+            n += await mqc.read_msgs()
+    else:
+        while n < NUM:
+            await mqc.read_msg()
+            n += 1
+    dt = ticks_diff(ticks_ms(), t0)
+    await asyncio.sleep_ms(10)  # let the deferred flush run
+    return NUM * 1000 / dt
+
+async def main():
+    batch = hasattr(MQTTProto, "read_msgs")
+    print("messages per second: read_msg read_msgs")
+    for qos in (0, 1):
+        a = await best(qos, False)
+        b = "{:8.0f}".format(await best(qos, True)) if batch else "       -"
+        print("QoS {} {:3d}-byte packets: {:8.0f} {}".format(
+            qos, len(await wire(MQTTMessage("sensors/node1/temp", b"21.5", qos=qos, pid=1))), a, b))
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
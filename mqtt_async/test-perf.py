@@ -0,0 +1,292 @@
+# Throughput and latency benchmark suite for MQTTClient in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Sweeps the payload size, the QoS, sync vs. async publishing, publish-only vs. publish-subscribe
+# round trips, and the number of tasks publishing concurrently, and reports for each case the
+# messages per second, the p50/p95/p99 latency, and the heap bytes allocated per message. The
+# latency is the duration of the publish call for publish-only cases and the time from the start
+# of the publish to the arrival of the message for round trips. Async cases publish the last
+# message of each task with sync=True, so they include the time to get everything acked.
+# Allocations are counted using gc.mem_alloc() on MicroPython, CPython has no allocation counter
+# so there only the net heap growth is reported, like test-alloc.py does.
+# The results can be written as JSON and compared against a stored baseline, the run then fails if
+# a case is slower, has a higher p99 latency, or allocates more than the baseline by more than the
+# tolerance.
+# Run this using cpython or the micropython unix port with key=value arguments, e.g.
+#     python3 test-perf.py sizes=16,1400 qos=1 json=out.json baseline=test-perf-baseline.json
+# sizes, qos, sync, modes, pubs: comma-separated values to sweep, see ARGS for the defaults,
+# n: messages per case, default: enough for BUDGET bytes of payload, reps: runs per case,
+# json: file to write the results to,
+# baseline: file to compare the results against, save: file to store the results in as baseline,
+# tol: tolerance for the comparison as a fraction of the baseline,
+# broker: host:port of the broker, latency, bandwidth: knobs of the broker stand-in.
+# Under CPython the broker is the stand-in in mqbroker.py running in a child process, unless broker
+# or $MQTT_BROKER is set. MicroPython needs a broker, e.g. `python3 mqbroker.py` on the same host.
+
+import sys, gc, json
+from mqtt_async import MQTTClient, config
+
+try:
+    from time import ticks_us, ticks_diff
+    import uasyncio as asyncio
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    import asyncio
+
+try:
+    from os import getenv
+except ImportError:
+    getenv = lambda name: None
+
+ARGS = {
+    "sizes": "16,256,1400,8192,65536",
+    "qos": "0,1",
+    "sync": "1,0",
+    "modes": "pub,pubsub",
+    "pubs": "1,4",
+    "reps": "3",
+    "tol": "0.5",
+}
+PCT = (0.5, 0.95, 0.99)  # latency percentiles reported
+BUDGET = 1 << 19  # payload bytes per case, determines the number of messages
+ALLOC_BUDGET = 1 << 18  # payload bytes of the allocation pass, which runs with the GC disabled
+TIMEOUT = 30  # seconds to wait for the messages of a round trip case
+SLACK_MS = 1  # absolute slack added to the tolerance for the p99 latency
+SLACK_B = 64  # absolute slack added to the tolerance for allocations per message
+PREFIX = "perf/"
+
+if sys.implementation.name == "micropython":
+
+    def alloc_start():
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+
+    def alloc_end(a0):
+        a = gc.mem_alloc() - a0
+        gc.enable()
+        return a
+
+
+else:
+    import tracemalloc
+
+    def alloc_start():
+        gc.collect()
+        tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+
+    def alloc_end(a0):
+        a = tracemalloc.get_traced_memory()[0] - a0
+        tracemalloc.stop()
+        return a
+
+
+# Bench runs the cases using a single client that is subscribed to the round trip topics, each
+# publishing task p uses its own topic ending in p so incoming messages can be matched up with the
+# time they were sent as messages on a topic are delivered in order.
+class Bench:
+    def __init__(self):
+        self.sent = []  # sent[p][k]: ticks_us at the start of publishing message k by task p
+        self.got = []  # got[p]: number of messages of task p received
+        self.lat = []  # latency samples in us
+        self.nlat = 0
+        self.want = 0  # number of messages to receive
+        self.done = None  # Event set once all messages have been received
+
+    def subs_cb(self, topic, msg, retained, qos, dup):
+        p = topic[-1] - 48
+        k = self.got[p]
+        if k >= len(self.sent[p]):
+            return  # straggler of an earlier case
+        self.lat[self.nlat] = ticks_diff(ticks_us(), self.sent[p][k])
+        self.nlat += 1
+        self.got[p] = k + 1
+        if self.nlat == self.want:
+            self.done.set()
+
+    # prepare allocates everything run needs so it doesn't count towards the allocations.
+    def prepare(self, n, pubs, mode):
+        per = max(1, n // pubs)
+        self.sent = [[0] * per for _ in range(pubs)]
+        self.got = [0] * pubs
+        self.lat = [0] * (per * pubs)
+        self.nlat = 0
+        self.want = per * pubs if mode == "pubsub" else -1
+        self.done = asyncio.Event()
+        return per * pubs
+
+    async def publisher(self, mqc, p, topic, payload, qos, sync, pub_only):
+        sent = self.sent[p]
+        last = len(sent) - 1
+        for k in range(len(sent)):
+            t0 = ticks_us()
+            sent[k] = t0
+            await mqc.publish(topic, payload, qos=qos, sync=sync or k == last)
+            if pub_only:
+                self.lat[self.nlat] = ticks_diff(ticks_us(), t0)
+                self.nlat += 1
+
+    # run publishes the messages prepared for and returns the elapsed time in us.
+    async def run(self, mqc, size, qos, sync, mode, pubs):
+        payload = bytes(size)
+        kind = "sub/" if mode == "pubsub" else "pub/"
+        topics = [PREFIX + kind + str(p) for p in range(pubs)]
+        pub_only = mode == "pub"
+        t0 = ticks_us()
+        await asyncio.gather(
+            *[self.publisher(mqc, p, topics[p], payload, qos, sync, pub_only) for p in range(pubs)]
+        )
+        if not pub_only:
+            await asyncio.wait_for(self.done.wait(), TIMEOUT)
+        return ticks_diff(ticks_us(), t0)
+
+    # case runs a case reps times and reports the best throughput and the best of each latency
+    # percentile, which is much more repeatable than the results of a single run.
+    async def case(self, mqc, size, qos, sync, mode, pubs, n, reps):
+        best = None
+        for _ in range(reps):
+            n = self.prepare(n, pubs, mode)
+            dt = await self.run(mqc, size, qos, sync, mode, pubs)
+            lat = sorted(self.lat[: self.nlat])
+            res = [dt] + [lat[min(len(lat) - 1, int(p * len(lat)))] / 1000 for p in PCT]
+            best = res if best is None else [min(a, b) for a, b in zip(best, res)]
+        na = self.prepare(max(pubs, min(n, ALLOC_BUDGET // size)), pubs, mode)
+        await self.run(mqc, size, qos, sync, mode, pubs)  # warm up
+        self.prepare(na, pubs, mode)
+        a0 = alloc_start()
+        await self.run(mqc, size, qos, sync, mode, pubs)
+        alloc = alloc_end(a0)
+        return {
+            "case": "{}-q{}-{}-{}B-x{}".format(mode, qos, "sync" if sync else "async", size, pubs),
+            "size": size,
+            "qos": qos,
+            "sync": sync,
+            "mode": mode,
+            "pubs": pubs,
+            "n": n,
+            "msgs_s": round(n * 1000000 / best[0]),
+            "kB_s": round(n * size * 1000 / best[0]),
+            "p50_ms": best[1],
+            "p95_ms": best[2],
+            "p99_ms": best[3],
+            "alloc_B": round(alloc / na),
+        }
+
+
+def int_list(s):
+    return [int(v) for v in s.split(",")]
+
+
+def get_broker(args):
+    addr = args.get("broker") or getenv("MQTT_BROKER")
+    if addr:
+        host, _, port = addr.partition(":")
+        return (host, int(port or 1883))
+    if sys.implementation.name != "cpython":
+        return ("127.0.0.1", 1883)
+    from mqbroker import spawn_broker
+
+    knobs = {k: float(args[k]) for k in ("latency", "bandwidth") if k in args}
+    return spawn_broker(**knobs)[1]
+
+
+# compare returns the regressions of the results with respect to the baseline.
+def compare(results, base, tol):
+    bad = []
+    for r in results:
+        b = base.get(r["case"])
+        if b is None:
+            continue
+        if r["msgs_s"] < b["msgs_s"] * (1 - tol):
+            bad.append((r["case"], "msgs_s", b["msgs_s"], r["msgs_s"]))
+        if r["p99_ms"] > b["p99_ms"] * (1 + tol) + SLACK_MS:
+            bad.append((r["case"], "p99_ms", b["p99_ms"], r["p99_ms"]))
+        if r["alloc_B"] > b["alloc_B"] * (1 + tol) + SLACK_B:
+            bad.append((r["case"], "alloc_B", b["alloc_B"], r["alloc_B"]))
+    return bad
+
+
+def load(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def dump(obj, fname):
+    try:
+        s = json.dumps(obj, indent=1, sort_keys=True)
+    except TypeError:
+        s = json.dumps(obj)  # MicroPython
+    with open(fname, "w") as f:
+        f.write(s + "\n")
+
+
+async def main(args):
+    bench = Bench()
+    conf = config.copy()
+    conf["server"], conf["port"] = get_broker(args)
+    conf["client_id"] = "perf-{}".format(ticks_us() % 1000000)
+    conf["subs_cb"] = bench.subs_cb
+    if sys.platform == "linux":
+        conf["ssid"] = "linux"  # the unix interface stubs just need one
+    mqc = MQTTClient(conf)
+    await mqc.connect()
+    await mqc.subscribe(PREFIX + "sub/+", 1)
+    impl = sys.implementation.name
+    print("{} using the broker at {}:{}".format(impl, conf["server"], conf["port"]))
+    print(
+        "{:28s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s} {:>7s}".format(
+            "case", "msgs/s", "kB/s", "p50 ms", "p95 ms", "p99 ms", "B/msg"
+        )
+    )
+    results = []
+    reps = int(args["reps"])
+    for mode in args["modes"].split(","):
+        for qos in int_list(args["qos"]):
+            for sync in int_list(args["sync"]):
+                for pubs in int_list(args["pubs"]):
+                    for size in int_list(args["sizes"]):
+                        n = int(args["n"]) if "n" in args else min(1000, max(20, BUDGET // size))
+                        r = await bench.case(mqc, size, qos, bool(sync), mode, pubs, n, reps)
+                        results.append(r)
+                        print(
+                            "{:28s} {:8d} {:8d} {:8.3f} {:8.3f} {:8.3f} {:7d}".format(
+                                r["case"], r["msgs_s"], r["kB_s"],
+                                r["p50_ms"], r["p95_ms"], r["p99_ms"], r["alloc_B"],
+                            )
+                        )
+    await mqc.disconnect()
+    if "json" in args:
+        dump({"impl": impl, "results": results}, args["json"])
+    if "save" in args:
+        base = load(args["save"])
+        cases = base.get(impl, {})
+        for r in results:
+            cases[r["case"]] = {k: r[k] for k in ("msgs_s", "p99_ms", "alloc_B")}
+        base[impl] = cases
+        dump(base, args["save"])
+    if "baseline" in args:
+        bad = compare(results, load(args["baseline"]).get(impl, {}), float(args["tol"]))
+        for case, metric, was, now in bad:
+            print("REGRESSION {}: {} {} -> {}".format(case, metric, was, now))
+        if bad:
+            return False
+        print("no regressions against {}".format(args["baseline"]))
+    return True
+
+
+args = dict(ARGS)
+for a in sys.argv[1:]:
+    k, _, v = a.partition("=")
+    args[k] = v
+if not asyncio.run(main(args)):
+    sys.exit(1)
@@ -0,0 +1,157 @@
+# Recovery benchmark for MQTTClient in mqtt_async.py
+# Copyright © 2020 by Thorsten von Eicken.
+# Connects a client through the fault-injecting proxy in mqproxy.py to the broker stand-in in
+# mqbroker.py, publishes a message every INTERVAL ms to a topic the client is subscribed to, and
+# then injects a fault. For each kind of fault it reports the time until the client detected the
+# dead connection (in _handle_msgs or _keep_alive, the cause is the operation that failed), the
+# time _keep_connected took from there to reconnect, the messages lost and duplicated across the
+# reconnect, and the number of reconnections. blackhole and latency faults are healed after `hold`
+# seconds, the latency fault adds LATENCY ms and should not cause a reconnection.
+# Run this using cpython with optional key=value arguments, e.g.
+#     python3 test-recovery.py faults=stall,blackhole qos=1 response_time=2 hold=3 json=out.json
+# faults: comma-separated faults to inject, default: all of mqproxy.FAULTS, qos: of the messages,
+# response_time: the MQTTClient config item, hold: seconds until the blackhole or latency is healed,
+# json: file to write the results to.
+
+import sys, json, time
+import cpy_fix
+from mqtt_async import MQTTClient, config
+from mqbroker import spawn_broker
+from mqproxy import FaultProxy, FAULTS
+import asyncio, logging
+
+logging.basicConfig(level=logging.ERROR)  # the reconnections are expected
+
+INTERVAL = 20  # ms between published messages
+WARMUP = 1  # seconds of publishing before the fault
+SETTLE = 1  # seconds of publishing after the reconnection
+TIMEOUT = 60  # seconds to wait for a reconnection
+LATENCY = 500  # ms added by the latency fault
+ARGS = {"faults": ",".join(FAULTS), "qos": "1", "response_time": "2", "hold": "3"}
+
+
+def now_ms():
+    return time.monotonic() * 1000
+
+
+# Scenario runs a client through one fault and collects the events.
+class Scenario:
+    def __init__(self, fault, qos):
+        self.fault = fault
+        self.qos = qos
+        self.published = 0
+        self.received = []  # sequence numbers in order of arrival
+        self.events = []  # (ms, connected)
+        self.updown = asyncio.Event()
+
+    def subs_cb(self, topic, msg, retained, qos, dup):
+        self.received.append(int(msg))
+
+    async def wifi_coro(self, connected):
+        self.events.append((now_ms(), connected))
+        self.updown.set()
+
+    async def publisher(self, mqc, topic):
+        while True:
+            await mqc.publish(topic, str(self.published), qos=self.qos, sync=False)
+            self.published += 1
+            await asyncio.sleep_ms(INTERVAL)
+
+    # recovered returns the time of the first disconnection after t0 and of the reconnection after
+    # that, either may be None.
+    def recovered(self, t0):
+        down = up = None
+        for t, connected in self.events:
+            if t < t0:
+                continue
+            if down is None and not connected:
+                down = t
+            elif down is not None and connected:
+                up = t
+                break
+        return down, up
+
+    async def run(self, broker, args):
+        proxy = FaultProxy(broker)
+        conf = config.copy()
+        conf["server"], conf["port"] = await proxy.start()
+        conf["client_id"] = "recovery-{}".format(self.fault)
+        conf["ssid"] = "linux"  # the CPython interface stub just needs one
+        conf["clean"] = False
+        conf["response_time"] = float(args["response_time"])
+        conf["subs_cb"] = self.subs_cb
+        conf["wifi_coro"] = self.wifi_coro
+        mqc = MQTTClient(conf)
+        await mqc.connect()
+        topic = "recovery/" + self.fault
+        await mqc.subscribe(topic, 1)
+        pub = asyncio.ensure_future(self.publisher(mqc, topic))
+        await asyncio.sleep(WARMUP)
+        hold = float(args["hold"])
+        t0 = now_ms()
+        if self.fault == "latency":
+            proxy.fault("latency", LATENCY)
+            healer = asyncio.ensure_future(proxy.script([(hold, "heal")]))
+        else:
+            proxy.fault(self.fault)
+            steps = [(hold, "heal")] if self.fault == "blackhole" else []
+            healer = asyncio.ensure_future(proxy.script(steps))
+        # wait for the reconnection, or for the latency to be over
+        deadline = t0 + (hold * 1000 + 1000 if self.fault == "latency" else TIMEOUT * 1000)
+        while self.recovered(t0)[1] is None and now_ms() < deadline:
+            self.updown.clear()
+            try:
+                await asyncio.wait_for(self.updown.wait(), (deadline - now_ms()) / 1000)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.sleep(SETTLE)
+        pub.cancel()
+        # give the last messages a chance to arrive
+        for _ in range(50):
+            if set(range(self.published)) <= set(self.received):
+                break
+            await asyncio.sleep_ms(100)
+        down, up = self.recovered(t0)
+        st = mqc.stats()
+        await mqc.disconnect()
+        await healer
+        await proxy.stop()
+        got = set(self.received)
+        return {
+            "fault": self.fault,
+            "qos": self.qos,
+            "detect_ms": None if down is None else round(down - t0),
+            "reconnect_ms": None if up is None else round(up - down),
+            "cause": ",".join(st["reconnects"]) or "-",
+            "reconnects": sum(1 for _, c in self.events if not c),
+            "published": self.published,
+            "lost": len(set(range(self.published)) - got),
+            "duplicated": len(self.received) - len(got),
+        }
+
+
+async def main(args):
+    _, broker = spawn_broker()
+    fmt = "{:11s} {:>10s} {:>12s} {:>16s} {:>6s} {:>5s} {:>5s} {:>5s}"
+    print("response_time={}s, QoS {}".format(args["response_time"], args["qos"]))
+    print(fmt.format("fault", "detect ms", "reconnect ms", "cause", "downs", "pubs", "lost", "dups"))
+    results = []
+    for fault in args["faults"].split(","):
+        r = await Scenario(fault, int(args["qos"])).run(broker, args)
+        results.append(r)
+        print(
+            fmt.format(
+                fault, str(r["detect_ms"]), str(r["reconnect_ms"]), r["cause"],
+                str(r["reconnects"]), str(r["published"]), str(r["lost"]), str(r["duplicated"]),
+            )
+        )
+    if "json" in args:
+        with open(args["json"], "w") as f:
+            json.dump({"args": args, "results": results}, f, indent=1)
+
+
+args = dict(ARGS)
+for a in sys.argv[1:]:
+    k, _, v = a.partition("=")
+    args[k] = v
+asyncio.run(main(args))
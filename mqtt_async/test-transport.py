@@ -0,0 +1,153 @@
+# Transport throughput benchmark for MQTTProto in mqtt_async.py under CPython
+# Copyright © 2020 by Thorsten von Eicken.
+# Compares the two CPython transports in cpy_fix.py, the StreamReadWriter on top of asyncio's
+# StreamReader/StreamWriter ("stream") and the ProtocolStream based on asyncio.Protocol
+# ("protocol"), using a broker stand-in running in another process over a local TCP connection. It
+# reports messages per second and the CPU time of the event loop thread per message for receiving
+# QoS 0 and QoS 1 (PUBACKed) messages, for publishing QoS 0 messages, and for messages that are
+# echoed back one at a time.
+# Run this using cpython: python3 test-transport.py
+
+import multiprocessing, socket, sys, threading, time
+import cpy_fix
+from mqtt_async import MQTTProto, MQTTMessage
+import asyncio
+
+NUM = 50000  # messages per run
+SIZE = 40  # payload bytes per message
+
+
+def nop_cb(*args):
+    pass
+
+
+# wire returns the wire format of a message as produced by MQTTProto.
+async def wire(msg):
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    out = bytearray()
+
+    class Sock:
+        def write(self, b):
+            out.extend(b)
+
+        async def drain(self):
+            pass
+
+    mqc._sock = Sock()
+    await mqc.publish(msg)
+    return bytes(out)
+
+
+# Server is a broker stand-in running in a separate process, so it doesn't compete for the GIL:
+# it answers the CONNECT with a CONNACK followed by `data`, and reads and discards whatever the
+# client sends until the client closes the connection, or with echo, sends it right back.
+class Server(multiprocessing.Process):
+    def __init__(self, data=b"", echo=False):
+        super().__init__(daemon=True)
+        self.data = data
+        self.echo = echo
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.addr = self.sock.getsockname()
+
+    def start(self):
+        super().start()
+        self.sock.close()  # the child process has it
+
+    def run(self):
+        conn, _ = self.sock.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hdr = conn.recv(2, socket.MSG_WAITALL)
+        conn.recv(hdr[1], socket.MSG_WAITALL)  # rest of the CONNECT
+        if self.echo:
+            conn.sendall(b"\x20\x02\0\0")
+            while True:
+                b = conn.recv(65536)
+                if not b:
+                    break
+                conn.sendall(b)
+            conn.close()
+            return
+        sender = threading.Thread(target=conn.sendall, args=(b"\x20\x02\0\0" + self.data,))
+        sender.start()
+        while conn.recv(65536):
+            pass
+        sender.join()
+        conn.close()
+
+
+async def bench_rx(qos):
+    pkt = await wire(MQTTMessage("bench/rx", bytes(SIZE), qos=qos, pid=qos and 1))
+    srv = Server(pkt * NUM)
+    srv.start()
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    await mqc.connect(srv.addr, "bench", True)
+    t0, c0 = time.perf_counter(), time.thread_time()
+    n = 0
+    while n < NUM:
+        n += await mqc.read_msgs()
+    await mqc.flush()
+    dt, dc = time.perf_counter() - t0, time.thread_time() - c0
+    await mqc.disconnect()
+    srv.join()
+    return NUM / dt, dc * 1e6 / NUM
+
+
+# bench_echo publishes a message and waits for it to come back, one at a time, so each message
+# costs a full wake-up of the reader as happens on a gateway relaying many slow devices.
+async def bench_echo():
+    srv = Server(echo=True)
+    srv.start()
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    await mqc.connect(srv.addr, "bench", True)
+    msg = MQTTMessage("bench/echo", bytes(SIZE))
+    n = NUM // 10
+    t0, c0 = time.perf_counter(), time.thread_time()
+    for _ in range(n):
+        await mqc.publish(msg)
+        await mqc.read_msg()
+    dt, dc = time.perf_counter() - t0, time.thread_time() - c0
+    await mqc.disconnect()
+    srv.join()
+    return n / dt, dc * 1e6 / n
+
+
+async def bench_tx():
+    srv = Server()
+    srv.start()
+    mqc = MQTTProto(nop_cb, nop_cb, nop_cb, nop_cb)
+    await mqc.connect(srv.addr, "bench", True)
+    msg = MQTTMessage("bench/tx", bytes(SIZE))
+    t0, c0 = time.perf_counter(), time.thread_time()
+    for _ in range(NUM):
+        await mqc.publish(msg, flush=False)
+    await mqc.flush()
+    dt, dc = time.perf_counter() - t0, time.thread_time() - c0
+    await mqc.disconnect()
+    srv.join()
+    return NUM / dt, dc * 1e6 / NUM
+
+
+async def main():
+    print("{} {}-byte messages, msgs/s and event loop CPU us/msg".format(NUM, SIZE))
+    print("{:16s} {:>20s} {:>20s}".format("", "stream", "protocol"))
+    for name, bench in (
+        ("receive QoS 0", lambda: bench_rx(0)),
+        ("receive QoS 1", lambda: bench_rx(1)),
+        ("publish QoS 0", bench_tx),
+        ("echo round-trip", bench_echo),
+    ):
+        res = []
+        for transport in ("stream", "protocol"):
+            cpy_fix.TRANSPORT = transport
+            res.append(await bench())
+        print(
+            "{:16s} {:9.0f} {:7.2f}us {:9.0f} {:7.2f}us".format(name, *res[0], *res[1])
+        )
+
+
+if sys.implementation.name != "cpython":
+    print("test-transport.py compares the CPython transports, it needs CPython")
+else:
+    asyncio.run(main())
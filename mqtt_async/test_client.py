@@ -4,11 +4,14 @@
 # on the client functionality, such as retransmissions.
 # To produce code coverage with annotated html report: pytest --cov=mqtt_async --cov-report=html
 
-import pytest, random, sys
+import pytest, random, sys, inspect, time
 pytestmark = pytest.mark.timeout(10)
 
 import mqtt_async
-from mqtt_async import MQTTClient, MQTTMessage, config
+from mqtt_async import MQTTClient, MQTTMessage, MQTTStream, PubBuf, config
+from mqtt_async import PUB_CRITICAL, PUB_NORMAL, PUB_DROPPABLE, Outbox, ACK_LATER
+from mqbroker import MQTTBroker
+from mqproxy import FaultProxy
 
 broker = ('192.168.0.14', 1883)
 cli_id = 'mqtt_as_tester'
@@ -34,19 +37,26 @@ FAIL_SUB1   = 3 # fail subscription as if broker had refused (error code in suba
 FAIL_SUB2   = 4 # fail subscription as if broker had used the wrong qos
 
 conn_fail  = 0  # number of consecutive connect() that should fail
+conn_err   = "simulated connection failure" # error message of failing connect() calls
+pub_log    = [] # (pid, dup) of all publish() calls, to verify retransmissions
+sub_log    = [] # topic lists of all subscribe_many() calls
+ack_log    = [] # pids of all PUBACKs sent for incoming messages
 conn_calls = 0  # number of times connect() got called, to verify reconnection timing
 
 t0 = ticks_ms()
 
 class FakeProto:
 
-    def __init__(self, pub_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None):
+    def __init__(self, pub_cb, puback_cb, suback_cb, pingresp_cb, sock_cb=None, chunk_sel=None,
+            stats=None):
         # Store init params
         self._pub_cb = pub_cb
+        self._chunk_sel = chunk_sel
         self._puback_cb = puback_cb
         self._suback_cb = suback_cb
         self._pingresp_cb = pingresp_cb
         self._sock_cb = sock_cb
+        self.stats = stats
         # Init private instance vars
         self._connected = False
         self._q = []      # queue of pending incoming messages (as function closures)
@@ -54,16 +64,25 @@ class FakeProto:
         self.last_ack = 0 # last ACK received from broker
         self.rtt = RTT    # milliseconds round-trip time for a broker response
         self.fail = None  # current failure mode
+        self.swallow_pings = 0 # number of PINGRESPs to swallow
+        self.tls_session = None
+        self.tls_resumed = None
+        self.receive_max = 65535
+        self.version = None
+        self.session_present = False
+        self.open_ms = RTT
         log.debug("Using FakeProto")
 
     async def connect(self, addr, client_id, clean, user=None, pwd=None, ssl=None,
-            keepalive=0, lw=None):
+            keepalive=0, lw=None, tls_session=None, version=4, session_expiry=0, sock=None):
         global conn_calls, conn_fail
         conn_calls += 1
+        self.version = version
+        self.session_present = not clean
         if conn_fail:
-            await asyncio.sleep(4*RTT/1000) # simulate connection delay
+            await asyncio.sleep(2*RTT/1000) # simulate connection delay, within response_time
             conn_fail -= 1
-            raise OSError(-1, "simulated connection failure")
+            raise OSError(-1, conn_err)
         await asyncio.sleep(2*RTT/1000) # simulate connection
         self._connected = True
         self._t0 = ticks_ms()
@@ -88,7 +107,9 @@ class FakeProto:
     async def ping(self):
         if self.fail == FAIL_CLOSED:
             raise OSError(1, "simulated closed")
-        if self.fail != FAIL_DROP:
+        if self.swallow_pings:
+            self.swallow_pings -= 1
+        elif self.fail != FAIL_DROP:
             asyncio.get_event_loop().create_task(self._handle_ping_resp(ticks_ms()+self.rtt))
             await asyncio.sleep_ms(0)
 
@@ -112,11 +133,34 @@ class FakeProto:
         def f():
             if self._connected:
                 log.debug("pub len:{} pid:{} msg:{}".format(len(self._q), msg.pid, msg.message))
-                self._pub_cb(msg)
+                self.rx_pid = msg.pid if msg.qos else None
+                r = self._pub_cb(msg.topic, msg.message, bool(msg.retain), msg.qos, 0)
+                if inspect.isawaitable(r):
+                    return self._await_ack(r, self.rx_pid)
+                if self.rx_pid is not None and r is not ACK_LATER:
+                    ack_log.append(self.rx_pid)
         self._q.append(f)
 
-    async def publish(self, msg, dup=0):
+    async def _await_ack(self, r, pid):
+        if await r is not ACK_LATER and pid is not None:
+            ack_log.append(pid)
+
+    def puback(self, pid):
+        ack_log.append(pid)
+
+    async def flush(self):
+        pass
+
+    async def publish(self, msg, dup=0, flush=True):
         log.debug("New pub pid:{}".format(msg.pid))
+        pub_log.append((msg.pid, dup))
+        if isinstance(msg.message, MQTTStream):
+            # read the stream like MQTTProto would so the message can be looped back
+            msg.message.rewind()
+            msg = MQTTMessage(msg.topic, msg.message.src.read(msg.message.length), msg.retain,
+                    msg.qos, msg.pid)
+        elif isinstance(msg.message, PubBuf):
+            msg = MQTTMessage(msg.topic, bytes(msg.message.payload()), msg.retain, msg.qos, msg.pid)
         if self.fail == FAIL_CLOSED:
             raise OSError(1, "simulated closed")
         # space pubs out a tad else the replies can come out of order (oops!)
@@ -136,41 +180,57 @@ class FakeProto:
             loop.create_task(self._handle_pub(now+self.rtt+1-dt, msg))
             await asyncio.sleep_ms(0) # ensure the above _handle_pubs start their wait now
 
-    # _handle_suback simulates receiving a suback
+    # _handle_suback simulates receiving a suback (qos is None for an unsuback)
     async def _handle_suback(self, when, pid, qos):
         await self._sleep_until(when)
-        if   self.fail == FAIL_SUB1: qos = 0x80
-        elif self.fail == FAIL_SUB2: qos = qos ^ 1
+        if qos is not None:
+            if   self.fail == FAIL_SUB1: qos = [0x80 for q in qos]
+            elif self.fail == FAIL_SUB2: qos = [q ^ 1 for q in qos]
+            if len(qos) == 1: qos = qos[0]
         def f():
             self.last_ack = ticks_ms()
             self._suback_cb(pid, qos)
         self._q.append(f)
         #log.debug("suback now", len(self._q))
 
-    async def subscribe(self, topic, qos, pid):
+    async def subscribe_many(self, topics, pid):
         if self.fail == FAIL_CLOSED:
             raise OSError(1, "simulated closed")
+        sub_log.append([t for t, q in topics])
         if self.fail != FAIL_DROP:
+            qos = [q for t, q in topics]
             asyncio.get_event_loop().create_task(self._handle_suback(ticks_ms()+self.rtt, pid, qos))
 
+    async def unsubscribe(self, topics, pid):
+        if self.fail == FAIL_CLOSED:
+            raise OSError(1, "simulated closed")
+        if self.fail != FAIL_DROP:
+            asyncio.get_event_loop().create_task(self._handle_suback(ticks_ms()+self.rtt, pid, None))
+
     async def read_msg(self):
         while self._connected:
             if len(self._q) > 0:
                 log.debug("check_msg pop len:{}".format(len(self._q)))
-                self._q.pop(0)()
+                r = self._q.pop(0)()
+                if inspect.isawaitable(r):
+                    await r
                 return
             await asyncio.sleep_ms(10)
         raise OSError(-1, "Connection closed")
 
+    async def read_msgs(self):
+        await self.read_msg()
+        return 1
+
     def isconnected(self): return self._connected
 
 # callbacks
 
 msg_q = []
-def subs_cb(msg):
+def subs_cb(topic, msg, retained, qos, dup):
     global msg_q
-    log.debug("*** got pub pid:{} msg:{}".format(msg.pid, msg.message))
-    msg_q.append(msg)
+    log.debug("*** got pub topic:{} msg:{}".format(topic, msg))
+    msg_q.append(MQTTMessage(topic, msg, retained, qos))
 
 wifi_status = None
 async def wifi_coro(status):
@@ -191,9 +251,13 @@ def reset_cb():
 
 cli_num = random.randrange(100000000) # add number to client id so each test
 def fresh_config():
-    global cli_num, conn_calls, conn_fail
+    global cli_num, conn_calls, conn_fail, conn_err, pub_log, sub_log, ack_log
     conn_calls = 0
     conn_fail = 0
+    conn_err = "simulated connection failure"
+    pub_log = []
+    sub_log = []
+    ack_log = []
     conf = config.copy()
     conf["server"] = broker[0]
     conf["port"] = broker[1]
@@ -247,12 +311,97 @@ def test_instantiate():
     mqc._MQTTProto = FakeProto
     assert mqc is not None
 
-def test_dns_lookup():
+@pytest.mark.asyncio
+async def test_dns_lookup():
     conf = fresh_config()
     mqc = MQTTClient(conf)
     mqc._MQTTProto = FakeProto
-    mqc._dns_lookup()
+    await mqc._dns_lookup()
     assert mqc._addr == broker
+    assert mqc.dns_stats()["lookups"] == 0 # IP address
+    assert mqc.dns_stats()["hits"] == 1
+
+@pytest.mark.asyncio
+async def test_dns_cache(monkeypatch):
+    answer = ['10.0.0.1']
+    async def fake_getaddrinfo(host, port):
+        await asyncio.sleep_ms(5)
+        if answer[0] is None:
+            raise OSError(-2, "Name or service not known")
+        return [(2, 1, 6, '', (answer[0], port))]
+    monkeypatch.setattr(mqtt_async, "getaddrinfo", fake_getaddrinfo)
+    dns = mqtt_async.DNSCache("broker.example.com", 1883, 0.05)
+    assert await dns.resolve() == ('10.0.0.1', 1883)
+    assert await dns.resolve() == ('10.0.0.1', 1883)
+    assert dns.lookups == 1 and dns.hits == 1
+    assert dns.last_ms >= 4
+    # expired: stale address is returned immediately and a refresh happens in the background
+    answer[0] = '10.0.0.2'
+    await asyncio.sleep_ms(60)
+    assert await dns.resolve() == ('10.0.0.1', 1883)
+    assert dns.stale == 1
+    await asyncio.sleep_ms(20)
+    assert await dns.resolve() == ('10.0.0.2', 1883)
+    assert dns.lookups == 2 and dns.hits == 2
+    # DNS down: keep using the last good address
+    answer[0] = None
+    dns.refresh()
+    await asyncio.sleep_ms(20)
+    assert await dns.resolve() == ('10.0.0.2', 1883)
+    assert dns.failures == 1
+    # no address ever
+    dns = mqtt_async.DNSCache("broker.example.com", 1883, 0.05)
+    with pytest.raises(OSError):
+        await dns.resolve()
+    assert dns.stats()["failures"] == 1
+
+def test_topic_trie():
+    t = mqtt_async._TopicTrie()
+    def m(filt, topic):
+        t.__init__()
+        t.add(filt, 1)
+        return t.match(topic) == [1]
+    assert m(b'a/b/c', b'a/b/c')
+    assert not m(b'a/b/c', b'a/b')
+    assert not m(b'a/b', b'a/b/c')
+    assert m(b'a/+/c', b'a/b/c')
+    assert m(b'a/+/c', b'a//c')
+    assert not m(b'a/+/c', b'a/b/d')
+    assert m(b'a/#', b'a/b/c')
+    assert m(b'a/#', b'a')
+    assert m(b'#', b'a/b')
+    assert m(b'+/+', b'/b')
+    assert not m(b'#', b'$SYS/foo')
+    assert not m(b'+/foo', b'$SYS/foo')
+    assert m(b'$SYS/#', b'$SYS/foo')
+    assert m(b'$SYS/+', b'$SYS/foo')
+    # multiple filters
+    t = mqtt_async._TopicTrie()
+    t.add(b'a/b/c', 1)
+    t.add(b'a/+/c', 2)
+    t.add(b'a/#', 3)
+    t.add(b'#', 4)
+    t.add(b'a/b/c', 5)
+    t.add(b'a/b/c', 5) # already registered
+    t.add(b'x/y', chunk_cb=6)
+    t.add(b'x/#', 7, chunk_cb=8)
+    assert sorted(t.match(b'a/b/c')) == [1, 2, 3, 4, 5]
+    assert sorted(t.match(b'a/x/c')) == [2, 3, 4]
+    assert sorted(t.match(b'a')) == [3, 4]
+    assert sorted(t.match(b'b')) == [4]
+    assert t.chunk_cb(b'a/b/c') is None
+    assert t.chunk_cb(b'x/y') == 6
+    assert t.chunk_cb(b'x/z') == 8
+    assert sorted(t.match(b'x/y')) == [4, 7]
+    # removal prunes the tree
+    t.remove(b'x/y')
+    assert t.chunk_cb(b'x/y') == 8
+    t.remove(b'x/#')
+    assert t.chunk_cb(b'x/y') is None
+    assert b'x' not in t._root[0]
+    t.remove(b'a/b/c')
+    assert sorted(t.match(b'a/b/c')) == [2, 3, 4]
+    t.remove(b'nope/nope')
 
 def test_set_last_will():
     conf = mqtt_async.config
@@ -295,6 +444,11 @@ def test_init_errors():
     with pytest.raises(ValueError, match=r'keepalive.*time'):
         mqc = MQTTClient(conf)
     #
+    conf = fresh_config()
+    conf["max_inflight"] = 0
+    with pytest.raises(ValueError, match='invalid max_inflight'):
+        mqc = MQTTClient(conf)
+    #
     conf = config.copy()
     with pytest.raises(ValueError, match='no server'):
         mqc = MQTTClient(conf)
@@ -346,18 +500,70 @@ async def test_pub_sub_qos1():
     assert msg_q[0].message == b'Hello1'
     await finish_test(mqc)
 
+# test per-subscription handlers, sync and async
+@pytest.mark.asyncio
+async def test_sub_handlers():
+    mqc, conf = await connect_subscribe(prefix+"other", 0)
+    #
+    got = []
+    def h1(topic, msg, retained, qos, dup):
+        got.append((1, topic, msg))
+    async def h2(topic, msg, retained, qos, dup):
+        await asyncio.sleep_ms(1)
+        got.append((2, topic, msg))
+    await mqc.subscribe(prefix+"h/+", 0, cb=h1)
+    await mqc.subscribe(prefix+"h/#", 0, cb=h2)
+    await mqc.publish(prefix+"h/x", "Hello")
+    await mqc.publish(prefix+"other", "World")
+    await asyncio.sleep_ms(5*RTT)
+    t = (prefix+"h/x").encode()
+    assert got == [(1, t, b'Hello'), (2, t, b'Hello')]
+    assert len(msg_q) == 1 # only the unmatched one went to subs_cb
+    assert msg_q[0].message == b'World'
+    await finish_test(mqc)
+
+# test subscribing to multiple topics in one go, and unsubscribing
+@pytest.mark.asyncio
+async def test_sub_many():
+    mqc, conf = await connect_subscribe(prefix+"sm0", 0)
+    #
+    got = []
+    def h(topic, msg, retained, qos, dup):
+        got.append(msg)
+    await mqc.subscribe(prefix+"sm/a", 1, cb=h)
+    topics = [(prefix+"sm1", 0), (prefix+"sm2", 1), (prefix+"sm3", 1)]
+    assert await mqc.subscribe_many(topics) == [0, 1, 1]
+    assert sub_log[-1] == [t for t, q in topics] # sent in one packet
+    mqc._proto.fail = FAIL_SUB1
+    assert await mqc.subscribe_many(topics[:2]) == [0x80, 0x80]
+    mqc._proto.fail = None
+    #
+    await mqc.publish(prefix+"sm/a", "Hello")
+    await asyncio.sleep_ms(3*RTT)
+    assert got == [b'Hello']
+    await mqc.unsubscribe_many([prefix+"sm/a", prefix+"sm1"])
+    await mqc.publish(prefix+"sm/a", "World") # FakeProto still loops it back
+    await asyncio.sleep_ms(3*RTT)
+    assert got == [b'Hello']
+    assert len(msg_q) == 1 and msg_q[0].message == b'World'
+    await finish_test(mqc)
+
 # test a subscription that the broker refuses
 @pytest.mark.asyncio
 async def test_refused_sub():
     mqc, conf = await connect_subscribe(prefix+"qos1", 1)
     #
+    def cb(*args):
+        pass
     mqc._proto.fail = FAIL_SUB1
     with pytest.raises(OSError):
-        await mqc.subscribe(prefix+"ref1", 0)
+        await mqc.subscribe(prefix+"ref1", 0, cb=cb)
+    assert len(mqc._subs.match((prefix+"ref1").encode())) == 0
     #
     mqc._proto.fail = FAIL_SUB2
     with pytest.raises(OSError):
-        await mqc.subscribe(prefix+"ref1", 0)
+        await mqc.subscribe(prefix+"ref1", 0, cb=cb)
+    assert len(mqc._subs.match((prefix+"ref1").encode())) == 0
     #
     await finish_test(mqc)
 
@@ -434,6 +640,484 @@ async def test_fail_reconnect():
     await asyncio.sleep_ms(20*RTT)
     await finish_test(mqc, conns=5)
 
+# test that a publish waiting for a connection goes out as soon as the reconnection completes
+# rather than when polling notices, which used to add up to _CONN_DELAY
+@pytest.mark.asyncio
+async def test_reconnect_pub_latency():
+    mqc, conf = await connect_subscribe(prefix+"lat", 0)
+    #
+    for i in range(3):
+        proto1 = mqc._proto
+        proto1.fail = FAIL_CLOSED
+        await mqc.publish(prefix+"lat", "Hello{}".format(i))
+        proto2 = mqc._proto
+        assert proto2 != proto1 # we have reconnected in the process
+        dt = ticks_diff(ticks_ms(), proto2._t0)
+        log.info("reconnect to publish latency: {:.1f}ms".format(dt))
+        assert dt < RTT/4
+        assert mqc._conn_up.is_set() and not mqc._conn_down.is_set()
+        await asyncio.sleep_ms(3*RTT) # let the message loop back
+    assert [m.message for m in msg_q] == [b'Hello0', b'Hello1', b'Hello2']
+    await finish_test(mqc, conns=5)
+
+# test the RTT, reconnect, and in-flight stats (FakeProto doesn't count packets)
+@pytest.mark.asyncio
+async def test_stats():
+    mqc, conf = await connect_subscribe(prefix+"stats", 1)
+    mqc._c["max_inflight"] = 4
+    #
+    for i in range(3):
+        await mqc.publish(prefix+"stats", "Hello", qos=1)
+    st = mqc.stats()
+    assert st["puback_rtt"]["n"] == 3
+    assert RTT*0.8 <= st["puback_rtt"]["min"] <= st["puback_rtt"]["avg"] <= st["puback_rtt"]["max"]
+    assert st["puback_rtt"]["max"] < 2*RTT
+    assert sum(st["puback_rtt"]["hist"]) == 3 and st["puback_rtt"]["hist"][2] == 3 # 20-50ms
+    assert st["inflight"] == []
+    # keep-alive pings get measured as well
+    await asyncio.sleep_ms(5*RTT)
+    assert mqc.stats()["ping_rtt"]["n"] > 0
+    # retransmitted messages produce no RTT sample
+    mqc._proto.fail = FAIL_DROP
+    await mqc.publish(prefix+"stats", "Hello", qos=1, sync=False)
+    await mqc.publish(prefix+"stats", "Hello", qos=1, sync=False)
+    st = mqc.stats()
+    assert st["inflight"] == [m.pid for m in mqc._inflight] and len(st["inflight"]) == 2
+    await mqc.publish(prefix+"stats", "Hello", qos=1)
+    st = mqc.stats()
+    assert st["puback_rtt"]["n"] == 3
+    assert st["reconnects"] == {"pub": 1}
+    assert st["dns"]["hits"] > 0 and st["tls"] == {"full": 0, "resumed": 0}
+    await finish_test(mqc, conns=3)
+
+# test the RTT estimation and the response timeout derived from it
+def test_rtt_timeout():
+    conf = fresh_config()
+    conf["response_time"] = 10
+    conf["min_response_time"] = 0.1
+    mqc = MQTTClient(conf)
+    assert mqc._ack_timeout() == 10 # no sample yet
+    mqc._rtt_sample(100)
+    assert mqc._rto_ms == 100 + 200 # srtt + 4*rtt/2
+    for i in range(20):
+        mqc._rtt_sample(100)
+    assert mqc._srtt >> 3 == 100
+    assert mqc._rto_ms == 150 # variance decayed, granularity remains
+    mqc._rtt_sample(1000) # a spike increases the timeout a lot
+    assert mqc._rto_ms > 1000
+    for i in range(4):
+        mqc._ack_timed_out()
+    assert mqc._rto_ms == 10000 # capped by response_time
+    assert mqc._ping_interval_ms() == 10000
+    for i in range(50):
+        mqc._rtt_sample(1)
+    assert mqc._rto_ms == 100 # bounded by min_response_time
+    assert mqc._ping_interval_ms() == 200
+    st = mqc.stats()
+    assert st["srtt_ms"] < 10 and st["timeout_ms"] == 100
+
+# test that a dead connection is detected based on the measured RTT rather than response_time
+@pytest.mark.asyncio
+async def test_rtt_detect():
+    conf = fresh_config()
+    conf["response_time"] = 2
+    conf["min_response_time"] = 0.05
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    reset_cb()
+    await mqc.connect()
+    await mqc.subscribe(prefix+"rtt", 1)
+    for i in range(5):
+        await mqc.publish(prefix+"rtt", "Hello", qos=1)
+    assert 2*RTT <= mqc._rto_ms < 5*RTT
+    #
+    proto1 = mqc._proto
+    proto1.fail = FAIL_DROP
+    t0 = ticks_ms()
+    await mqc.publish(prefix+"rtt", "Hello", qos=1)
+    dt = ticks_diff(ticks_ms(), t0)
+    assert mqc._proto != proto1 # we have reconnected in the process
+    assert dt < 1000 # would be >2000 using response_time
+    assert mqc.stats()["reconnects"] == {"pub": 1}
+    await finish_test(mqc, conns=3)
+
+# test that a dead idle connection is detected by a ping scheduled based on the measured RTT
+@pytest.mark.asyncio
+async def test_rtt_ping():
+    conf = fresh_config()
+    conf["response_time"] = 2
+    conf["min_response_time"] = 0.05
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    reset_cb()
+    await mqc.connect()
+    await mqc.subscribe(prefix+"rttping", 1)
+    for i in range(5):
+        await mqc.publish(prefix+"rttping", "Hello", qos=1)
+    assert mqc._ping_interval_ms() < 10*RTT
+    #
+    proto1 = mqc._proto
+    proto1.fail = FAIL_DROP
+    t0 = ticks_ms()
+    while mqc._proto is proto1 and ticks_diff(ticks_ms(), t0) < 3000:
+        await asyncio.sleep_ms(10)
+    assert mqc._proto is not proto1
+    assert ticks_diff(ticks_ms(), t0) < 1000 # would be >2000 pinging every response_time
+    assert mqc.stats()["reconnects"] == {"keepalive": 1}
+    await finish_test(mqc, conns=3)
+
+# test that a ping that goes unanswered doubles the response timeout, like other time-outs do
+@pytest.mark.asyncio
+async def test_ping_backoff():
+    conf = fresh_config()
+    conf["response_time"] = 2
+    conf["min_response_time"] = 0.05
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    reset_cb()
+    await mqc.connect()
+    await mqc.subscribe(prefix+"pingbo", 1)
+    for i in range(5):
+        await mqc.publish(prefix+"pingbo", "Hello", qos=1)
+    rto = mqc._rto_ms
+    #
+    proto1 = mqc._proto
+    proto1.swallow_pings = 1
+    t0 = ticks_ms()
+    while mqc._proto is proto1 and ticks_diff(ticks_ms(), t0) < 3000:
+        await asyncio.sleep_ms(1)
+    assert mqc._proto is not proto1
+    assert mqc._rto_ms == min(2*rto, 2000)
+    assert mqc.stats()["reconnects"] == {"keepalive": 1}
+    await finish_test(mqc, conns=3)
+
+# VirtualBackoff runs the backoff policy in virtual time: it records the delays it would sleep for
+# and lets the client retry right away
+class VirtualBackoff(mqtt_async.Backoff):
+    def __init__(self):
+        super().__init__(unit_ms=1000)
+        self.slept = []
+    def delay_ms(self, cause):
+        self.slept.append((cause, super().delay_ms(cause)))
+        return 0
+
+def test_backoff():
+    b = mqtt_async.Backoff(unit_ms=1000)
+    b._jitter = lambda d: d
+    assert [(b.failed("tcp"), b.delay_ms("tcp"))[1] for i in range(8)] == \
+            [1000, 2000, 4000, 8000, 16000, 32000, 60000, 60000]
+    assert b.streak == 8
+    assert b.failed("connack") == 9 and b.delay_ms("connack") == 5000 # per-cause progression
+    b.succeeded("wifi")
+    assert b.streak == 0 and b.delay_ms("tcp") == 1000
+    assert b.stats() == {"failures": {"tcp": 8, "connack": 1}, "recovered": {"wifi": 1}}
+    # full jitter: spread between 0 and the nominal delay
+    b = mqtt_async.Backoff(unit_ms=1000)
+    for i in range(4):
+        b.failed("tls")
+    d = [b.delay_ms("tls") for i in range(100)]
+    assert 0 <= min(d) < 4000 and 12000 < max(d) <= 16000
+    assert len(set(d)) > 50
+
+def test_fail_cause():
+    import ssl
+    fc = mqtt_async._fail_cause
+    assert fc(OSError(-1, mqtt_async.DNS_FAILED), None) == "dns"
+    assert fc(OSError(-1, "CONNECT refused: not auth"), None) == "connack"
+    assert fc(OSError(111, "Connection refused"), None) == "tcp"
+    assert fc(OSError(-1, "simulated connection failure"), True) == "tcp"
+    assert fc(ssl.SSLError(1, "handshake failure"), True) == "tls"
+    assert fc(OSError(-29312), True) == "tls" # mbedtls error
+    assert fc(OSError(-29312), None) == "tcp"
+
+# test that repeated TCP failures back off exponentially and escalate to a Wifi reset
+@pytest.mark.asyncio
+async def test_backoff_escalate():
+    global conn_fail
+    mqc, conf = await connect_subscribe(prefix+"sub1x", 0)
+    mqc._backoff = backoff = VirtualBackoff()
+    #
+    conn_fail = 4
+    mqc._proto.fail = FAIL_CLOSED
+    await asyncio.sleep_ms(25*RTT)
+    assert mqc._proto is not None and mqc._proto.fail is None
+    assert [c for c, d in backoff.slept] == ["tcp"] * 4
+    for i, (c, d) in enumerate(backoff.slept):
+        assert 0 <= d <= 1000 << i
+    assert mqc.reconnect_stats() == {"failures": {"tcp": 4}, "recovered": {"wifi": 1}}
+    await finish_test(mqc, conns=7)
+
+# test that a refused connection backs off without resetting Wifi
+@pytest.mark.asyncio
+async def test_backoff_connack():
+    global conn_fail, conn_err
+    mqc, conf = await connect_subscribe(prefix+"sub1x", 0)
+    mqc._backoff = backoff = VirtualBackoff()
+    #
+    conn_fail = 4
+    conn_err = "CONNECT refused: srv down"
+    mqc._proto.fail = FAIL_CLOSED
+    await asyncio.sleep_ms(25*RTT)
+    assert mqc._proto is not None and mqc._proto.fail is None
+    assert [c for c, d in backoff.slept] == ["connack"] * 4
+    assert backoff.slept[3][1] <= 40000
+    assert mqc.reconnect_stats() == {"failures": {"connack": 4}, "recovered": {"reconnect": 1}}
+    await finish_test(mqc, conns=7)
+
+# test picking the fastest healthy broker, sticking to the current one, and the hold-down
+def test_broker_select():
+    conf = fresh_config()
+    conf["servers"] = ["10.0.0.1", ("10.0.0.2", 1884), "10.0.0.3"]
+    conf["holddown"] = 0.05
+    mqc = MQTTClient(conf)
+    b1, b2, b3 = mqc._brokers
+    assert (b1.port, b2.port, b3.port) == (1883, 1884, 1883)
+    assert mqc._select_broker() is b1 # nothing measured: first listed
+    b1.sample(30); b2.sample(25); b3.sample(10)
+    assert mqc._select_broker() is b3
+    b3.sample(60); b3.sample(60)
+    assert b3.latency_ms == 31 # smoothed
+    assert mqc._select_broker() is b1 # b2 is within _LAT_SLACK_MS of b1 but listed later
+    b1.sample(100); b1.sample(100)
+    assert mqc._select_broker() is b2
+    # once connected stick with the broker until it goes down
+    mqc._state = 1
+    mqc._broker = b3
+    assert mqc._select_broker() is b3
+    assert not b3.failed(2)
+    assert mqc._select_broker() is b3
+    assert b3.failed(2)
+    assert mqc._select_broker() is b2
+    assert mqc._pick_broker(exclude=b2) is b1
+    # all down: try the one that has been down the longest
+    for b in (b2, b1):
+        b.failed(1)
+    assert mqc._select_broker() is b3
+    time.sleep(0.06)
+    assert mqc._select_broker() is b3 # hold-down over: current broker is healthy again
+    assert mqc._pick_broker() is b2 and b2.fails == 0
+    st = mqc.stats()
+    assert [b["down"] for b in st["brokers"]] == [False, False, False]
+
+# StandIn is a minimal MQTT 3.1.1 broker stand-in that acks everything and counts the TCP
+# connections it accepts, the CONNECTs it receives, and the topics subscribed to.
+class StandIn:
+    def __init__(self):
+        self.accepts = 0
+        self.connects = 0
+        self.subs = []
+        self.writers = []
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.addr = self.server.sockets[0].getsockname()[:2]
+    def stop(self):
+        self.server.close()
+        for w in self.writers:
+            w.close()
+    async def handle(self, reader, writer):
+        self.accepts += 1
+        self.writers.append(writer)
+        try:
+            while True:
+                op = (await reader.readexactly(1))[0]
+                sz = sh = 0
+                while True:
+                    b = (await reader.readexactly(1))[0]
+                    sz |= (b & 0x7f) << sh
+                    sh += 7
+                    if not b & 0x80: break
+                body = await reader.readexactly(sz)
+                if op == 0x10:
+                    self.connects += 1
+                    writer.write(b'\x20\x02\0\0') # no session present
+                elif op & 0xf6 == 0x32: # QoS 1 publish
+                    tl = body[0] << 8 | body[1]
+                    writer.write(b'\x40\x02' + body[2+tl:4+tl])
+                elif op == 0x82:
+                    i, codes = 2, b''
+                    while i < len(body):
+                        tl = body[i] << 8 | body[i+1]
+                        self.subs.append(bytes(body[i+2:i+2+tl]))
+                        codes += body[i+2+tl:i+3+tl]
+                        i += 3 + tl
+                    writer.write(bytes([0x90, 2+len(codes)]) + body[:2] + codes)
+                elif op == 0xc0:
+                    writer.write(b'\xd0\0')
+                elif op == 0xe0:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+# test failing over to the standby connection of a second broker, which has no session, so the
+# subscriptions need to be restored
+@pytest.mark.asyncio
+async def test_failover():
+    sa, sb = StandIn(), StandIn()
+    await sa.start()
+    await sb.start()
+    conf = fresh_config()
+    conf["servers"] = [sa.addr, sb.addr]
+    conf["clean"] = False
+    conf["failover"] = 1
+    conf["standby"] = 5
+    mqc = MQTTClient(conf)
+    mqc._backoff = VirtualBackoff()
+    reset_cb()
+    b1, b2 = mqc._brokers
+    #
+    await mqc.connect()
+    assert mqc._broker is b1 # latencies are within _LAT_SLACK_MS: first listed
+    assert b1.latency_ms is not None and b2.latency_ms is not None
+    await mqc.subscribe(prefix+"failover", 1)
+    await asyncio.sleep_ms(RTT)
+    assert mqc._standby is not None and mqc._standby[0] is b2
+    assert (sb.accepts, sb.connects) == (2, 0) # probe and standby
+    #
+    sa.stop()
+    for _ in range(50):
+        await asyncio.sleep_ms(RTT/2)
+        if mqc._proto is not None and sb.subs:
+            break
+    assert mqc._broker is b2
+    assert (sb.accepts, sb.connects) == (2, 1) # used the standby
+    assert sb.subs == [(prefix+"failover").encode()]
+    assert not mqc._resub
+    await mqc.publish(prefix+"failover", "hello", qos=1)
+    st = mqc.stats()
+    assert st["broker"] == 1 and st["brokers"][0]["down"]
+    assert st["recovered"] == {"failover": 1}
+    await finish_test(mqc)
+    sb.stop()
+
+# test a persistent session against the broker stand-in in mqbroker.py with added latency: the
+# connection is reset in the middle of a stream of QoS 1 messages and they all arrive nonetheless
+@pytest.mark.asyncio
+async def test_broker_reset():
+    brk = MQTTBroker(latency=RTT/4)
+    conf = fresh_config()
+    conf["server"], conf["port"] = await brk.start()
+    conf["clean"] = False
+    mqc = MQTTClient(conf)
+    mqc._backoff = VirtualBackoff()
+    reset_cb()
+    #
+    await mqc.connect()
+    topic = prefix+"reset"
+    await mqc.subscribe(topic, 1)
+    for i in range(20):
+        if i == 10:
+            brk.kick()
+        await mqc.publish(topic, str(i), qos=1, sync=False)
+    for _ in range(50):
+        await asyncio.sleep_ms(RTT)
+        if len(set(m.message for m in msg_q)) == 20:
+            break
+    assert set(m.message for m in msg_q) == set(str(i).encode() for i in range(20))
+    assert brk.stats["resets"] == 1 and brk.stats["connects"] == 2
+    assert mqc.stats()["recovered"] == {"reconnect": 1}
+    await finish_test(mqc)
+    await brk.stop()
+
+# test recovering through the fault-injecting proxy in mqproxy.py from a network outage: the dead
+# connection is detected, connection attempts time out while the network is down instead of hanging,
+# and once it's back the client reconnects without losing any QoS 1 message
+@pytest.mark.asyncio
+async def test_proxy_blackhole():
+    brk = MQTTBroker()
+    proxy = FaultProxy(await brk.start())
+    conf = fresh_config()
+    conf["server"], conf["port"] = await proxy.start()
+    conf["clean"] = False
+    mqc = MQTTClient(conf)
+    mqc._backoff = VirtualBackoff()
+    reset_cb()
+    #
+    await mqc.connect()
+    topic = prefix+"proxy"
+    await mqc.subscribe(topic, 1)
+    await mqc.publish(topic, "0", qos=1)
+    proxy.fault("blackhole")
+    pub = asyncio.ensure_future(mqc.publish(topic, "1", qos=1))
+    await asyncio.sleep_ms(15*RTT)
+    assert mqc._proto is None
+    assert proxy.stats["accepts"] >= 3 # connection attempts timed out
+    assert mqc.stats()["failures"]["tcp"] >= 2
+    proxy.heal()
+    await asyncio.wait_for(pub, 20*RTT/1000)
+    for _ in range(20):
+        await asyncio.sleep_ms(RTT)
+        if len(set(m.message for m in msg_q)) == 2:
+            break
+    assert set(m.message for m in msg_q) == {b"0", b"1"}
+    assert sum(mqc.stats()["recovered"].values()) == 1 # escalates to wifi after _ESCALATE attempts
+    await finish_test(mqc)
+    await proxy.stop()
+    await brk.stop()
+
+# test that a slow handler doesn't hold up messages for other topics when using inbound tasks,
+# that messages for the same topic are handled in order, and that PUBACKs are sent once handled
+@pytest.mark.asyncio
+async def test_inbound():
+    conf = fresh_config()
+    conf["clean"] = False
+    conf["inbound"] = 2
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    reset_cb()
+    await mqc.connect()
+    done = []
+    async def slow(topic, msg, retained, qos, dup):
+        await asyncio.sleep_ms(4*RTT)
+        done.append((msg, len(ack_log)))
+    def fast(topic, msg, retained, qos, dup):
+        done.append((msg, len(ack_log)))
+    await mqc.subscribe(prefix+"slow", 1, cb=slow)
+    await mqc.subscribe(prefix+"fast", 1, cb=fast)
+    #
+    await mqc.publish(prefix+"slow", "s1", qos=1, sync=False)
+    await mqc.publish(prefix+"slow", "s2", qos=1, sync=False)
+    await mqc.publish(prefix+"fast", "f1", qos=1, sync=False)
+    await asyncio.sleep_ms(12*RTT)
+    assert done == [(b"f1", 0), (b"s1", 1), (b"s2", 2)]
+    assert len(ack_log) == 3
+    st = mqc.stats()
+    assert st["handler_ms"]["n"] == 3 and st["handler_ms"]["max"] >= 4*RTT - 5
+    assert st["inbound_ms"]["max"] >= 7*RTT # s2 waited for s1
+    assert st["inbound"] == 0 and st["inbound_bytes"] == 0 and st["inbound_max"] >= 2
+    await finish_test(mqc, conns=1)
+
+# test that reading waits for room in a full inbound queue and that ack_early acks right away
+@pytest.mark.asyncio
+async def test_inbound_full():
+    conf = fresh_config()
+    conf["clean"] = False
+    conf["inbound"] = 1
+    conf["inbound_size"] = 30 # 18 bytes per message
+    conf["ack_early"] = True
+    conf["max_inflight"] = 4
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    reset_cb()
+    await mqc.connect()
+    done = []
+    async def slow(topic, msg, retained, qos, dup):
+        await asyncio.sleep_ms(2*RTT)
+        done.append(msg)
+    await mqc.subscribe(prefix+"slow", 1, cb=slow)
+    #
+    for i in range(4):
+        await mqc.publish(prefix+"slow", "s%d" % i, qos=1, sync=False)
+    await asyncio.sleep_ms(3*RTT)
+    assert len(ack_log) == 3 # 1 handled, 1 queued, 1 waiting for room and acked when queued
+    await asyncio.sleep_ms(8*RTT)
+    assert done == [b"s0", b"s1", b"s2", b"s3"]
+    assert len(ack_log) == 4
+    st = mqc.stats()
+    assert st["inbound_stalls"] >= 1 and st["inbound_max"] == 1
+    await finish_test(mqc, conns=1)
+
 # The following tests can also be run against a real broker. For this set FAKE=False and
 # run pytest with `-k async_`
 FAKE=True
@@ -458,6 +1142,280 @@ async def test_async_pub_simple():
     assert msg_q[2].message == b'Hello3'
     await finish_test(mqc)
 
+# test async pub with a larger in-flight window
+@pytest.mark.asyncio
+async def test_async_pub_window():
+    topic = prefix+"async3"
+    mqc, conf = await connect_subscribe(topic, 1, fake=FAKE)
+    mqc._c["max_inflight"] = 4
+    #
+    num = 12
+    for i in range(num):
+        await mqc.publish(topic, "Hello{}".format(i), qos=1, sync=False)
+        assert len(mqc._inflight) <= 4
+    assert len(mqc._inflight) > 1 # window actually got used
+    await mqc.publish(topic, "Hello{}".format(num), qos=1, sync=True)
+    assert len(mqc._inflight) == 0
+    await asyncio.sleep_ms(5*RTT)
+    assert [m.message for m in msg_q] == ["Hello{}".format(i).encode() for i in range(num+1)]
+    await finish_test(mqc)
+
+# test that the MQTT 5 Receive Maximum of the broker limits the in-flight window
+@pytest.mark.asyncio
+async def test_receive_max():
+    topic = prefix+"async5"
+    mqc, conf = await connect_subscribe(topic, 1, fake=FAKE)
+    mqc._c["max_inflight"] = 8
+    mqc._proto.receive_max = 3
+    #
+    num = 8
+    for i in range(num):
+        await mqc.publish(topic, "Hello{}".format(i), qos=1, sync=False)
+        assert len(mqc._inflight) <= 2
+    await mqc.publish(topic, "Hello{}".format(num), qos=1, sync=True)
+    assert len(mqc._inflight) == 0
+    await asyncio.sleep_ms(5*RTT)
+    assert [m.message for m in msg_q] == ["Hello{}".format(i).encode() for i in range(num+1)]
+    await finish_test(mqc)
+
+# test MQTT 5 mode: the clean session needs no reconnection and refused publishes are counted
+@pytest.mark.asyncio
+async def test_mqtt5():
+    conf = fresh_config()
+    conf["mqtt5"] = True
+    conf["clean"] = True
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    await mqc.connect()
+    assert conn_calls == 1 and mqc._proto.version == 5
+    #
+    mqc._proto.fail = FAIL_DROP
+    await mqc.publish(prefix+"deny", "x", qos=1, sync=False)
+    pid = mqc._inflight[0].pid
+    mqc._got_puback(pid, 0x87)
+    assert len(mqc._inflight) == 0 and pid not in mqc._unacked_pids
+    assert mqc.stats()["pub_refused"] == 1
+    mqc._proto.fail = None
+    await finish_test(mqc, conns=1)
+
+# test that publish buffers get recycled once sent (QoS 0) or acked (QoS 1)
+@pytest.mark.asyncio
+async def test_publish_buf():
+    topic = prefix+"pubbuf"
+    mqc, conf = await connect_subscribe(topic, 1)
+    #
+    pb = mqc.get_buf(100)
+    pb.data[:5] = b"Hello"
+    pb.len = 5
+    await mqc.publish_buf(topic, pb, qos=0)
+    assert mqc.get_buf(100) is pb # recycled
+    for i in range(2):
+        pb.data[:6] = b"Hello%d" % i
+        pb.len = 6
+        await mqc.publish_buf(topic, pb, qos=1, sync=False)
+        assert mqc._bufs == [] # held until acked
+        await mqc.publish(topic, "sync", qos=1) # wait for the ack
+        assert mqc._bufs == [pb]
+        assert mqc.get_buf(100) is pb
+    assert mqc.get_buf(2000) is not pb # too small
+    await asyncio.sleep_ms(2*RTT)
+    assert [m.message for m in msg_q] == [b"Hello", b"Hello0", b"sync", b"Hello1", b"sync"]
+    await finish_test(mqc)
+
+# test that publishes while disconnected are queued without blocking, dropped by priority when the
+# queue is full, and published in order after reconnecting
+@pytest.mark.asyncio
+async def test_pub_queue():
+    topic = prefix+"queue"
+    mqc, conf = await connect_subscribe(topic, 1)
+    mqc._c["queue_size"] = 5*(len(topic)+6) # room for 5 messages
+    mqc._c["max_inflight"] = 2
+    await mqc._reconnect(mqc._proto, "test")
+    #
+    t0 = ticks_ms()
+    prios = [PUB_CRITICAL, PUB_DROPPABLE, PUB_DROPPABLE] + [PUB_NORMAL]*4
+    for i in range(len(prios)):
+        await mqc.publish(topic, "Hello{}".format(i), qos=i&1, prio=prios[i])
+    assert ticks_diff(ticks_ms(), t0) < RTT/4 # publishers didn't block
+    st = mqc.stats()
+    assert st["queued"] == 5 and st["queued_bytes"] == 5*(len(topic)+6)
+    assert st["queue_dropped"] == 2
+    mqc._c["queue_size"] = 1000
+    await mqc._conn_up.wait()
+    # messages published while the queue is being drained go to the back of the queue
+    assert mqc._draining
+    await mqc.publish(topic, "Hello7", qos=1)
+    await asyncio.sleep_ms(10*RTT)
+    want = ["Hello{}".format(i).encode() for i in (0, 3, 4, 5, 6, 7)]
+    assert [m.message for m in msg_q] == want
+    assert mqc.stats()["queued"] == 0 and not mqc._draining
+    # connected: publish doesn't queue
+    await mqc.publish(topic, "Hello8", qos=1)
+    assert mqc.stats()["queued"] == 0
+    await finish_test(mqc, conns=3)
+
+# test that messages are dropped by priority and then age when the queue overflows
+def test_queue_trim():
+    conf = fresh_config()
+    conf["queue_size"] = 25 # room for 2 messages
+    mqc = MQTTClient(conf)
+    for i, prio in enumerate([PUB_CRITICAL, PUB_NORMAL, PUB_DROPPABLE, PUB_NORMAL, PUB_CRITICAL]):
+        mqc._enqueue(prio, "t", "{}23456789".format(i), False, 0) # 10 bytes each
+    assert [m[2][0] for m in mqc._queue] == ["0", "4"]
+    mqc._enqueue(PUB_CRITICAL, "t", "523456789", False, 0)
+    assert [m[2][0] for m in mqc._queue] == ["4", "5"]
+    assert mqc._qlen == 20 and mqc.stats()["queue_dropped"] == 4
+    # a PubBuf that gets dropped is recycled, only once
+    pb = mqc.get_buf(100)
+    pb.len = 10
+    mqc._enqueue(PUB_DROPPABLE, "t", pb, False, 0)
+    assert mqc._bufs == [pb]
+    mqc._put_buf(pb)
+    assert mqc._bufs == [pb]
+
+# test the Outbox file: acks, reloading, truncation, compaction, and torn records
+def test_outbox(tmp_path):
+    path = str(tmp_path / "outbox")
+    ob = Outbox(path, max_size=200)
+    assert ob.load() == []
+    assert ob.stats()["resets"] == 0 # nothing to do, nothing written
+    ids = [ob.add(MQTTMessage("t", "msg{}".format(i), qos=1)) for i in range(4)]
+    ob.ack(ids[0])
+    ob.ack(ids[2])
+    assert ob.stats()["size"] == 4*(12+5) + 2*5
+    # reload as after a reset: only the unacked messages remain, in order
+    ob = Outbox(path, max_size=200)
+    msgs = ob.load()
+    assert [(id, m.topic, m.message) for id, m in msgs] == [(ids[1], b"t", b"msg1"), (ids[3], b"t", b"msg3")]
+    assert ob.stats()["size"] == 2*(12+5) and ob.stats()["compactions"] == 1
+    for id, _ in msgs:
+        ob.ack(id)
+    # when everything is acked and the file is big enough it gets truncated
+    for i in range(5):
+        id = ob.add(MQTTMessage("t", "x"*20, qos=1))
+        ob.ack(id)
+    assert ob.stats()["resets"] == 2 and ob.stats()["size"] == 0
+    # new ids continue where the old ones left off
+    assert id == ids[3]+5
+    # when the file is full the live messages are compacted and the oldest dropped
+    for i in range(14):
+        ob.add(MQTTMessage("t", "m{:02d}".format(i), qos=1))
+    st = ob.stats()
+    assert st["compactions"] == 3 and st["dropped"] == 2 and st["size"] <= 200
+    assert st["pending"] == 12
+    # a torn record at the end is ignored
+    with open(path, "ab") as f:
+        f.write(b"\xa5\0\1")
+    ob = Outbox(path, max_size=200)
+    msgs = ob.load()
+    assert [m.message for _, m in msgs] == [b"m%02d" % i for i in range(2, 14)]
+    assert ob.stats()["compactions"] == 1
+    # a file holding only unacked messages is loaded as is
+    ob = Outbox(path, max_size=200)
+    assert len(ob.load()) == 12
+    assert ob.stats()["compactions"] == 0 and ob.stats()["size"] == 12*(12+1+3)
+
+# test that QoS 1 messages left unacked by a reset get retransmitted on the first connection
+@pytest.mark.asyncio
+async def test_outbox_replay(tmp_path):
+    topic = prefix+"outbox"
+    path = str(tmp_path / "outbox")
+    conf = fresh_config()
+    conf["outbox"] = Outbox(path)
+    conf["max_inflight"] = 4
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    await mqc.connect()
+    await mqc.publish(topic, "Hello0", qos=1)
+    mqc._proto.fail = FAIL_DROP
+    await mqc.publish(topic, "Hello1", qos=1, sync=False)
+    await mqc.publish(topic, "Hello2", qos=1, sync=False)
+    assert mqc.stats()["outbox"]["pending"] == 2
+    await finish_test(mqc) # the outbox file is all that's left, as after a reset
+    #
+    conf = fresh_config()
+    conf["outbox"] = Outbox(path)
+    mqc = MQTTClient(conf)
+    mqc._MQTTProto = FakeProto
+    assert [m.message for m in mqc._inflight] == [b"Hello1", b"Hello2"]
+    reset_cb()
+    await mqc.connect()
+    await asyncio.sleep_ms(4*RTT)
+    assert [dup for _, dup in pub_log] == [1, 1]
+    assert [m.message for m in msg_q] == [b"Hello1", b"Hello2"]
+    assert mqc.stats()["outbox"]["pending"] == 0 and mqc._inflight == []
+    await finish_test(mqc)
+
+# test that all unacked messages in the window get retransmitted in order with dup set
+@pytest.mark.asyncio
+async def test_async_pub_window_retransmit():
+    topic = prefix+"async4"
+    mqc, conf = await connect_subscribe(topic, 1)
+    mqc._c["max_inflight"] = 4
+    #
+    proto1 = mqc._proto
+    proto1.fail = FAIL_DROP
+    for i in range(3):
+        await mqc.publish(topic, "Hello{}".format(i), qos=1, sync=False)
+    assert len(mqc._inflight) == 3
+    pids = [m.pid for m in mqc._inflight]
+    await mqc.publish(topic, "Hello3", qos=1, sync=True)
+    assert mqc._proto != proto1 # we have reconnected in the process
+    assert len(mqc._inflight) == 0
+    pids.append(pids[-1]+1)
+    assert pub_log[-4:] == [(pid, 1) for pid in pids]
+    await asyncio.sleep_ms(5*RTT)
+    assert [m.message for m in msg_q] == ["Hello{}".format(i).encode() for i in range(4)]
+    await finish_test(mqc, conns=3)
+
+# test that a connection whose retransmission of unacked messages fails gets closed
+@pytest.mark.asyncio
+async def test_repub_fail():
+    topic = prefix+"repub"
+    mqc, conf = await connect_subscribe(topic, 1)
+    class RepubFail(FakeProto):
+        failed = []
+        async def publish(self, msg, dup=0, flush=True):
+            if dup and RepubFail.failed is not None:
+                RepubFail.failed.append(self)
+                raise OSError(-1, "simulated repub failure")
+            await super().publish(msg, dup, flush)
+    mqc._MQTTProto = RepubFail
+    mqc._proto.fail = FAIL_DROP
+    await mqc.publish(topic, "Hello", qos=1, sync=False)
+    mqc._proto.fail = FAIL_CLOSED
+    await asyncio.sleep_ms(10*RTT)
+    failed = RepubFail.failed
+    assert len(failed) > 0
+    assert not any(p._connected for p in failed)
+    RepubFail.failed = None
+    await asyncio.sleep_ms(10*RTT)
+    assert len(mqc._inflight) == 0
+    await finish_test(mqc, conns=conn_calls)
+
+# test publishing from a stream, including a retransmission
+@pytest.mark.asyncio
+async def test_pub_stream():
+    import io
+    topic = prefix+"stream1"
+    mqc, conf = await connect_subscribe(topic, 1)
+    #
+    data = bytes(range(256)) * 40
+    await mqc.publish_stream(topic, io.BytesIO(data), len(data), qos=0)
+    mqc._proto.fail = FAIL_DROP
+    await mqc.publish_stream(topic, io.BytesIO(data), len(data), qos=1)
+    assert pub_log[-1][1] == 1 # got retransmitted
+    await asyncio.sleep_ms(5*RTT)
+    assert len(msg_q) >= 2
+    assert msg_q[0].message == data
+    assert msg_q[1].message == data
+    #
+    async def chunks():
+        yield data
+    with pytest.raises(ValueError, match='seekable'):
+        await mqc.publish_stream(topic, chunks(), len(data), qos=1)
+    await finish_test(mqc, conns=3)
+
 # test async pub ordering
 # this test has a bug: the FakeProto doesn't resend pubs and so if it sent a puback the test client
 # won't resend to the broker and fake proto won't resend to the client -> lost message
@@ -10,11 +10,16 @@
 #    pass
 
 import sys, socket
-from mqtt_async import MQTTProto, MQTTMessage, set_last_will, config
+from mqtt_async import MQTTProto, MQTTMessage, MQTTStream, set_last_will, config, ACK_LATER, PROTO_ERROR
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
-broker = ('192.168.0.14', 1883)
+# under CPython the tests use a local broker stand-in, or the broker in $MQTT_BROKER
+if sys.implementation.name == 'cpython':
+    from mqbroker import shared_broker
+    broker = shared_broker()
+else:
+    broker = ('192.168.0.14', 1883)
 cli_id = 'mqtt_as_tester'
 prefix = 'esp32/tests/'
 
@@ -51,8 +56,10 @@ def got_pingresp():
     global pingresp
     pingresp = True
 puback_set = set()
-def got_puback(pid):
+puback_reasons = {}
+def got_puback(pid, reason=0):
     puback_set.add(pid)
+    puback_reasons[pid] = reason
 suback_map = {}
 def got_suback(pid, resp):
     suback_map[pid] = resp
@@ -67,9 +74,630 @@ async def wait_msg(mqc, op):
     while ticks_diff(ticks_ms(), t0) < 1000:
         if await mqc.read_msg() == op: return
 
+# FakeSock stands in for the asyncio stream in order to test the parsing in MQTTProto without a
+# broker. It returns the bytes in `data` in chunks of at most `chunk` bytes and collects the bytes
+# written in `out`.
+class FakeSock:
+    def __init__(self, data=b'', chunk=1000):
+        self.data = data
+        self.chunk = chunk
+        self.out = bytearray()
+        self.reads = 0
+    async def readinto(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        self.reads += 1
+        return n
+    def write(self, b):
+        self.out += b
+    async def drain(self):
+        pass
+    def close(self):
+        pass
+    async def wait_closed(self):
+        pass
+
+# pub_pkt returns the wire format of a publish packet as produced by MQTTProto
+async def pub_pkt(msg):
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock()
+    await mqc.publish(msg)
+    return bytes(mqc._sock.out)
+
+# Parse a mix of packets that arrive in small fragments
+async def test_read_fragmented():
+    global pub_q, puback_set, suback_map, pingresp
+    pub_q = []
+    longm = bytearray(1400)
+    for i in range(len(longm)):
+        longm[i] = i & 0xff
+    hugem = bytes(3000)
+    data = b'\xd0\0' + b'\x40\x02\0\x05' + b'\x90\x03\0\x06\x01'
+    data += await pub_pkt(MQTTMessage(prefix+'frag1', longm, qos=1, pid=7))
+    data += await pub_pkt(MQTTMessage(prefix+'frag2', hugem))
+    # payload fits the receive buffer but the packet doesn't
+    data += await pub_pkt(MQTTMessage(prefix+'frag4/'+'x'*200, longm))
+    data += await pub_pkt(MQTTMessage(prefix+'frag3', b''))
+    for chunk in (1, 7, 100, 2000):
+        pub_q = []
+        mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+        mqc._sock = FakeSock(data, chunk)
+        assert await mqc.read_msg() == 0xd
+        check_pingresp()
+        assert await mqc.read_msg() == 4
+        assert 5 in puback_set
+        assert await mqc.read_msg() == 9
+        assert suback_map[6] == 1
+        for i in range(4):
+            assert await mqc.read_msg() == 3
+        assert len(pub_q) == 4
+        assert pub_q[0].topic == (prefix+'frag1').encode()
+        assert pub_q[0].message == longm
+        assert pub_q[0].qos == 1
+        assert pub_q[1].topic == (prefix+'frag2').encode()
+        assert pub_q[1].message == hugem
+        assert pub_q[2].message == longm
+        assert isinstance(pub_q[2].message, bytes)
+        assert pub_q[3].message == b''
+        await mqc.flush()
+        assert mqc._sock.out == b'\x40\x02\0\x07' # puback
+        try:
+            await mqc.read_msg()
+            assert True == False, "Error: read past EOF returned"
+        except OSError as e:
+            assert e.args[0] == -1
+    pub_q = []
+
+# A varint longer than 4 bytes is a protocol error, whether it's the remaining length or the
+# length of the properties of an MQTT 5 packet
+async def test_bad_varint():
+    pub = await pub_pkt(MQTTMessage(prefix+'ok', b'x'))
+    for data, v5 in ((b'\x30\xff\xff\xff\xff\x01' + pub, False),
+            (b'\x90\x08\0\x05\xff\xff\xff\xff\x01\0' + pub, True)):
+        mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+        mqc._sock = FakeSock(data)
+        mqc._v5 = v5
+        try:
+            await mqc.read_msg()
+            assert True == False, "Error: bad varint accepted"
+        except OSError as e:
+            assert e.args[1] == PROTO_ERROR
+
+# Publish messages from streams, the result must be identical to publishing from memory
+async def test_publish_stream():
+    import io
+    data = bytearray(100000)
+    for i in range(len(data)):
+        data[i] = (i*7) & 0xff
+    for qos in (0, 1):
+        expect = await pub_pkt(MQTTMessage(prefix+'stream', data, qos=qos, pid=qos and 9))
+        # readinto source, the stream starts at the current position
+        src = io.BytesIO(b'junk' + data)
+        src.read(4)
+        mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+        mqc._sock = FakeSock()
+        msg = MQTTMessage(prefix+'stream', MQTTStream(src, len(data)), qos=qos, pid=qos and 9)
+        await mqc.publish(msg)
+        assert mqc._sock.out == expect
+        # retransmission rewinds the source
+        mqc._sock.out = bytearray()
+        await mqc.publish(msg)
+        assert mqc._sock.out == expect
+    # async iterator source
+    async def chunks():
+        for i in range(0, len(data), 3000):
+            yield data[i:i+3000]
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock()
+    await mqc.publish(MQTTMessage(prefix+'stream', MQTTStream(chunks(), len(data))))
+    assert mqc._sock.out == await pub_pkt(MQTTMessage(prefix+'stream', data))
+    # source that is too short
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock()
+    try:
+        await mqc.publish(MQTTMessage(prefix+'stream', MQTTStream(io.BytesIO(data), len(data)+1)))
+        assert True == False, "Error: short stream didn't raise"
+    except ValueError:
+        pass
+
+# Deliver a large payload in chunks to a streaming subscription
+async def test_read_chunks():
+    global pub_q
+    pub_q = []
+    data = bytearray(5000)
+    for i in range(len(data)):
+        data[i] = (i*3) & 0xff
+    chunks = []
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp,
+            chunk_sel=lambda t: chunk_cb if t.endswith(b'big') else None)
+    def chunk_cb(topic, total, offset, chunk, last):
+        assert len(chunk) <= 1536
+        assert len(mqc._sock.out) == 0 # no puback until the last chunk is processed
+        chunks.append((topic, total, offset, bytes(chunk), last))
+    pkts = await pub_pkt(MQTTMessage(prefix+'big', data, qos=1, pid=11))
+    pkts += await pub_pkt(MQTTMessage(prefix+'small', b'hello'))
+    pkts += await pub_pkt(MQTTMessage(prefix+'big', b''))
+    mqc._sock = FakeSock(pkts, 700)
+    assert await mqc.read_msg() == 3
+    assert len(chunks) > 3
+    off = 0
+    for c in chunks:
+        assert c[0] == (prefix+'big').encode()
+        assert c[1] == len(data)
+        assert c[2] == off
+        off += len(c[3])
+        assert c[4] == (off == len(data))
+    assert b''.join(c[3] for c in chunks) == data
+    await mqc.flush()
+    assert mqc._sock.out == b'\x40\x02\0\x0b' # puback
+    # non-matching topic goes to the normal callback
+    assert await mqc.read_msg() == 3
+    assert len(pub_q) == 1 and pub_q[0].message == b'hello'
+    pub_q = []
+    # empty payload gets one call
+    chunks = []
+    mqc._sock.out = bytearray()
+    assert await mqc.read_msg() == 3
+    assert chunks == [((prefix+'big').encode(), 0, 0, b'', True)]
+
+# Subscribe to multiple topics and unsubscribe using single packets
+async def test_sub_unsub_many():
+    global suback_map
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(b'\x90\x05\x01\x02\x00\x01\x80' + b'\xb0\x02\x01\x03', 3)
+    await mqc.subscribe_many([('a/b', 0), (b'c/#', 1), ('d', 1)], 0x102)
+    assert mqc._sock.out == b'\x82\x12\x01\x02\0\x03a/b\0\0\x03c/#\x01\0\x01d\x01'
+    assert await mqc.read_msg() == 9
+    assert suback_map[0x102] == [0, 1, 0x80]
+    mqc._sock.out = bytearray()
+    await mqc.unsubscribe(['a/b', b'c/#'], 0x103)
+    assert mqc._sock.out == b'\xa2\x0c\x01\x03\0\x03a/b\0\x03c/#'
+    suback_map[0x103] = 'x'
+    assert await mqc.read_msg() == 0xb
+    assert suback_map[0x103] is None
+
+# Publish from a PubBuf: same packets as from bytes, written without copying the payload
+async def test_publish_buf():
+    from mqtt_async import PubBuf
+    for qos, flush in ((0, True), (1, True), (1, False), (0, False)):
+        pb = PubBuf(2000, headroom=40)
+        pb.data[:1500] = bytes(range(250)) * 6
+        pb.len = 1500 if flush else 10
+        msg = MQTTMessage(prefix+'pb', pb, qos=qos, pid=qos and 33)
+        mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+        mqc._sock = FakeSock()
+        writes = []
+        def write(b):
+            writes.append(b)
+            mqc._sock.out += b
+        mqc._sock.write = write
+        await mqc.publish(msg, flush=flush)
+        await mqc.flush()
+        expect = await pub_pkt(MQTTMessage(prefix+'pb', bytes(pb.payload()), qos=qos, pid=qos and 33))
+        assert mqc._sock.out == expect
+        if flush:
+            assert len(writes) == 1 and writes[0].obj is pb.buf # zero-copy
+        # a retransmission sets dup in place
+        mqc._sock.out = bytearray()
+        await mqc.publish(msg, dup=1)
+        assert mqc._sock.out[0] == expect[0] | 8 and mqc._sock.out[1:] == expect[1:]
+    try:
+        await mqc.publish(MQTTMessage('x'*40, PubBuf(10, headroom=40)))
+        assert True == False, "Error: topic longer than headroom accepted"
+    except ValueError:
+        pass
+
+# read_msgs handles all the buffered packets in one call and waits for data only if there are none
+async def test_read_msgs():
+    global pub_q, puback_set
+    pub_q = []
+    puback_set = set()
+    pkts = b'\xd0\0' + b'\x40\x02\0\x05'
+    for pid in range(1, 4):
+        pkts += await pub_pkt(MQTTMessage(prefix+'batch', b'hello%d' % pid, qos=1, pid=pid))
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(pkts, chunk=len(pkts)-3)
+    assert await mqc.read_msgs() == 4 # the last publish is incomplete
+    assert mqc._sock.reads == 1
+    assert await mqc.read_msgs() == 1
+    assert mqc._sock.reads == 2
+    assert [m.message for m in pub_q] == [b'hello1', b'hello2', b'hello3']
+    assert 5 in puback_set
+    check_pingresp()
+    await mqc.flush()
+    assert mqc._sock.out == b''.join(b'\x40\x02\0' + bytes([pid]) for pid in range(1, 4))
+    pub_q = []
+
+# test holding back the PUBACK using ACK_LATER and sending it later using puback
+async def test_ack_later():
+    pids = []
+    def later_cb(topic, msg, retained, qos, dup):
+        pids.append(mqc.rx_pid)
+        return ACK_LATER
+    pkts = b''
+    for pid in range(1, 3):
+        pkts += await pub_pkt(MQTTMessage(prefix+'later', b'hello', qos=1, pid=pid))
+    mqc = MQTTProto(later_cb, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(pkts)
+    assert await mqc.read_msgs() == 2
+    await mqc.flush()
+    assert pids == [1, 2] and mqc._sock.out == b''
+    mqc.puback(2)
+    await mqc.flush()
+    assert mqc._sock.out == b'\x40\x02\0\x02'
+
+# Coalesce PUBACKs and small publishes into few writes
+async def test_write_coalesce():
+    global pub_q
+    # a burst of QoS 1 messages produces a single write with all the PUBACKs, which happens
+    # before read_msg waits for more data (here: hits EOF)
+    pkts = b''
+    for pid in range(1, 11):
+        pkts += await pub_pkt(MQTTMessage(prefix+'burst', b'hello', qos=1, pid=pid))
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(pkts)
+    for pid in range(1, 11):
+        assert await mqc.read_msg() == 3
+    assert mqc._sock.out == b''
+    try:
+        await mqc.read_msg()
+        assert True == False, "Error: read past EOF returned"
+    except OSError:
+        pass
+    assert mqc._sock.out == b''.join(b'\x40\x02\0' + bytes([pid]) for pid in range(1, 11))
+    assert mqc.writes == 1
+    pub_q = []
+    # unflushed publishes go out together after a short delay
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock()
+    expect = b''
+    for i in range(3):
+        msg = MQTTMessage(prefix+'co', b'x'*i)
+        await mqc.publish(msg, flush=False)
+        expect += await pub_pkt(msg)
+    assert mqc._sock.out == b''
+    await sleep_ms(20)
+    assert mqc._sock.out == expect
+    assert mqc.writes == 1
+    # a packet that needs to go out right away takes buffered ones with it, in order
+    mqc._sock.out = bytearray()
+    await mqc.publish(MQTTMessage(prefix+'co', b'a'), flush=False)
+    await mqc.ping()
+    assert mqc._sock.out == await pub_pkt(MQTTMessage(prefix+'co', b'a')) + b'\xc0\0'
+    assert mqc.writes == 2
+    # filling the buffer causes a write, large messages are written straight through
+    mqc._sock.out = bytearray()
+    for i in range(20):
+        await mqc.publish(MQTTMessage(prefix+'co', bytes(100)), flush=False)
+    assert 0 < len(mqc._sock.out) <= 1440
+    await mqc.publish(MQTTMessage(prefix+'co', bytes(2000)), flush=False)
+    assert len(mqc._sock.out) == 20 * len(await pub_pkt(MQTTMessage(prefix+'co', bytes(100)))) \
+            + len(await pub_pkt(MQTTMessage(prefix+'co', bytes(2000))))
+
+# Count packets and bytes by packet type
+async def test_stats():
+    global pub_q
+    pkts = b'\xd0\0' + b'\x40\x02\0\x05' + b'\x90\x03\0\x06\x01'
+    pkts += await pub_pkt(MQTTMessage(prefix+'st', bytes(200), qos=1, pid=7))
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(pkts)
+    for i in range(4):
+        await mqc.read_msg()
+    await mqc.ping()
+    await mqc.publish(MQTTMessage(prefix+'st', bytes(2000)))
+    st = mqc.stats.get()
+    assert st["pkts_in"] == {"pingresp": 1, "puback": 1, "suback": 1, "publish": 1}
+    assert st["bytes_in"] == {"pingresp": 2, "puback": 4, "suback": 5,
+            "publish": len(pkts) - 11}
+    assert st["pkts_out"] == {"puback": 1, "pingreq": 1, "publish": 1}
+    assert st["bytes_out"] == {"puback": 4, "pingreq": 2,
+            "publish": len(await pub_pkt(MQTTMessage(prefix+'st', bytes(2000))))}
+    assert sum(st["bytes_out"].values()) == len(mqc._sock.out)
+    pub_q = []
+    # waiting for the lock gets accounted for
+    await sleep_ms(10) # let the deferred flush of the PUBACK run
+    async with mqc._lock:
+        t = asyncio.get_event_loop().create_task(mqc.publish(MQTTMessage(prefix+'st', b'x')))
+        await sleep_ms(20)
+    await t
+    assert mqc.stats.lock_waits == 1 and mqc.stats.lock_ms >= 15
+
+# PUBACKs and pings don't wait for a large publish to drain: read_msg carries on and they are written
+# right after the publish packet, ahead of another publish waiting for the socket
+async def test_ctl_lane():
+    pkts = b''
+    for pid in (11, 12):
+        pkts += await pub_pkt(MQTTMessage(prefix+'ctl', b'hello', qos=1, pid=pid))
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock(pkts)
+    async def slow_drain():
+        await sleep_ms(50)
+    mqc._sock.drain = slow_drain
+    big1 = await pub_pkt(MQTTMessage(prefix+'big1', bytes(3000)))
+    big2 = await pub_pkt(MQTTMessage(prefix+'big2', bytes(3000)))
+    loop = asyncio.get_event_loop()
+    t1 = loop.create_task(mqc.publish(MQTTMessage(prefix+'big1', bytes(3000))))
+    await sleep_ms(5)
+    t2 = loop.create_task(mqc.publish(MQTTMessage(prefix+'big2', bytes(3000))))
+    await sleep_ms(5)
+    t0 = ticks_ms()
+    await mqc.read_msg()
+    await mqc.read_msg()
+    await mqc.ping()
+    assert ticks_diff(ticks_ms(), t0) < 20 # didn't wait for the publish
+    await t1
+    await t2
+    ctl = b'\x40\x02\0\x0b\x40\x02\0\x0c\xc0\0'
+    assert bytes(mqc._sock.out) == big1 + ctl + big2
+    st = mqc.stats.get()
+    assert st["pkts_out"] == {"publish": 2, "puback": 2, "pingreq": 1}
+    assert sum(st["bytes_out"].values()) == len(mqc._sock.out)
+
+# tls_server starts a local TLS server that acts as a minimal broker: it answers each CONNECT
+# with a CONNACK and otherwise just reads until the connection is closed.
+async def tls_server():
+    import ssl, os
+    d = os.path.dirname(os.path.abspath(__file__))
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(os.path.join(d, 'test-cert.pem'), os.path.join(d, 'test-key.pem'))
+    async def handle(reader, writer):
+        try:
+            while True:
+                hdr = await reader.readexactly(2)
+                await reader.readexactly(hdr[1]) # all our packets here are <128 bytes
+                if hdr[0] == 0x10:
+                    writer.write(b'\x20\x02\0\0')
+                elif hdr[0] == 0xc0:
+                    writer.write(b'\xd0\0')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0, ssl=ctx)
+    return server, server.sockets[0].getsockname()[:2]
+
+def tls_client_ctx():
+    import ssl, os
+    d = os.path.dirname(os.path.abspath(__file__))
+    return ssl.create_default_context(cafile=os.path.join(d, 'test-cert.pem'))
+
+# Reconnect resuming the TLS session, also test that it goes through MQTTClient
+async def test_tls_resume():
+    if sys.implementation.name != 'cpython':
+        return # needs a TLS server and session support
+    server, addr = await tls_server()
+    ctx = tls_client_ctx()
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    await mqc.connect(addr, cli_id, True, ssl=ctx)
+    assert mqc.tls_resumed == False
+    assert mqc.tls_session is not None
+    await mqc.disconnect()
+    mqc2 = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    await mqc2.connect(addr, cli_id, True, ssl=ctx, tls_session=mqc.tls_session)
+    assert mqc2.tls_resumed == True
+    await mqc2.disconnect()
+    # MQTTClient with clean=True connects twice, the second time resuming
+    from mqtt_async import MQTTClient
+    conf = config.copy()
+    conf.update(server=addr[0], port=addr[1], ssl_params=ctx, clean=True, ssid='x')
+    cli = MQTTClient(conf)
+    await cli.connect()
+    assert cli.tls_stats() == {"full": 1, "resumed": 1}
+    await cli.disconnect()
+    server.close()
+    await server.wait_closed()
+
+# mqtt5_server starts a minimal MQTT 5 broker stand-in that announces a Receive Maximum of 2 and
+# allows 2 topic aliases. It refuses publishes and subscriptions to topics containing 'deny' and
+# echoes publishes to subscribed topics, adding a content-type property. The topics as they were
+# received (empty if an alias was used) are appended to `topics`.
+async def mqtt5_server(topics):
+    def u16(b, i): return b[i] << 8 | b[i+1]
+    def s16(v): return bytes([len(v) >> 8, len(v) & 0xff]) + v
+    async def read_varint(reader):
+        n = sh = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7f) << sh
+            sh += 7
+            if not b & 0x80: return n
+    def packet(op, body):
+        assert len(body) < 128
+        return bytes([op, len(body)]) + body
+    async def handle(reader, writer):
+        aliases = {}
+        subs = set()
+        try:
+            while True:
+                op = (await reader.readexactly(1))[0]
+                body = await reader.readexactly(await read_varint(reader))
+                if op == 0x10:
+                    assert body[6] == 5 # protocol level
+                    writer.write(packet(0x20, b'\0\0\x06\x21\0\x02\x22\0\x02'))
+                elif op & 0xf0 == 0x30:
+                    qos = (op >> 1) & 3
+                    tl = u16(body, 0)
+                    topic = bytes(body[2:2+tl])
+                    i = 2 + tl
+                    pid = u16(body, i) if qos else 0
+                    i += 2 if qos else 0
+                    plen = body[i]
+                    props = body[i+1:i+1+plen]
+                    msg = body[i+1+plen:]
+                    topics.append(topic)
+                    if plen and props[0] == 0x23:
+                        alias = u16(props, 1)
+                        if topic: aliases[alias] = topic
+                        else: topic = aliases[alias]
+                    if qos:
+                        rc = 0x87 if b'deny' in topic else 0
+                        writer.write(packet(0x40, body[i-2:i] + bytes([rc, 0])))
+                    if topic in subs:
+                        props = b'\x03' + s16(b'text/plain')
+                        writer.write(packet(0x30, s16(topic) + bytes([len(props)]) + props + msg))
+                elif op == 0x82:
+                    i = 3 + body[2]
+                    codes = b''
+                    while i < len(body):
+                        tl = u16(body, i)
+                        topic = bytes(body[i+2:i+2+tl])
+                        if b'deny' in topic:
+                            codes += b'\x87'
+                        else:
+                            subs.add(topic)
+                            codes += bytes([body[i+2+tl]])
+                        i += 3 + tl
+                    writer.write(packet(0x90, body[:2] + b'\0' + codes))
+                elif op == 0xa2:
+                    writer.write(packet(0xb0, body[:2] + b'\0\0'))
+                elif op == 0xc0:
+                    writer.write(b'\xd0\0')
+                elif op == 0xe0:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[:2]
+
+# MQTT 5 mode: CONNACK properties, topic aliases, reason codes, and properties on incoming messages
+async def test_mqtt5():
+    if sys.implementation.name != 'cpython':
+        return # needs asyncio.start_server
+    global pub_q
+    pub_q = []
+    topics = []
+    server, addr = await mqtt5_server(topics)
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    await mqc.connect(addr, cli_id, True, version=5, session_expiry=60)
+    assert mqc.receive_max == 2 and mqc.topic_alias_max == 2
+    # subscribe: one topic is granted, one refused
+    await mqc.subscribe_many([(prefix+'v5a', 1), (prefix+'deny', 0)], 20)
+    await wait_msg(mqc, 9)
+    assert suback_map[20] == [1, 0x87]
+    # publish three times to the same topic: the alias replaces the topic after the first time
+    for pid in (21, 22, 23):
+        await mqc.publish(MQTTMessage(prefix+'v5a', 'hello%d' % pid, qos=1, pid=pid))
+        await wait_msg(mqc, 4)
+        await wait_msg(mqc, 3)
+    assert topics == [(prefix+'v5a').encode(), b'', b'']
+    assert [m.message for m in pub_q] == [b'hello21', b'hello22', b'hello23']
+    assert pub_q[0].topic == (prefix+'v5a').encode()
+    assert [puback_reasons[pid] for pid in (21, 22, 23)] == [0, 0, 0]
+    # two more topics: the second gets an alias, the third exceeds topic_alias_max
+    await mqc.publish(MQTTMessage(prefix+'deny', 'no', qos=1, pid=24))
+    await wait_msg(mqc, 4)
+    assert puback_reasons[24] == 0x87
+    await mqc.publish(MQTTMessage(prefix+'v5c', 'x'))
+    await mqc.publish(MQTTMessage(prefix+'v5c', 'x'))
+    assert mqc._aliases == {(prefix+'v5a').encode(): 1, (prefix+'deny').encode(): 2}
+    # unsubscribe and ping
+    await mqc.unsubscribe([prefix+'v5a'], 25)
+    await wait_msg(mqc, 0xb)
+    await mqc.ping()
+    await wait_msg(mqc, 0xd)
+    check_pingresp()
+    assert topics[-2:] == [(prefix+'v5c').encode()] * 2
+    await mqc.disconnect()
+    server.close()
+    await server.wait_closed()
+
+# A publish that is rejected before being sent doesn't leave a topic alias behind, else the next
+# publish to the topic would use an alias the broker never learned
+async def test_alias_rejected():
+    from mqtt_async import PubBuf
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = FakeSock()
+    mqc._v5 = True
+    mqc.topic_alias_max = 2
+    mqc.max_packet_size = 100
+    for msg in (MQTTMessage('big', bytes(200)), MQTTMessage('x'*40, PubBuf(10, headroom=40))):
+        try:
+            await mqc.publish(msg)
+            assert True == False, "Error: publish not rejected"
+        except ValueError:
+            pass
+    assert mqc._aliases == {} and mqc._sock.out == b''
+    await mqc.publish(MQTTMessage(b'big', b'small'))
+    assert mqc._sock.out == b'\x30\x0e\x00\x03big\x03\x23\x00\x01small'
+    assert mqc._aliases == {b'big': 1}
+
+# burst_server starts a broker stand-in that answers the CONNECT with a CONNACK immediately
+# followed by pkts, reads n PUBACKs into acks, and closes the connection.
+async def burst_server(pkts, n, acks):
+    async def handle(reader, writer):
+        await reader.readexactly((await reader.readexactly(2))[1])
+        writer.write(b'\x20\x02\0\0' + pkts)
+        await writer.drain()
+        while len(acks) < 4*n:
+            b = await reader.read(4096)
+            if not b:
+                break
+            acks.extend(b)
+        writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[:2]
+
+# Receive a burst of messages larger than ProtocolStream._HIGH using both CPython transports
+async def test_transport():
+    if sys.implementation.name != 'cpython':
+        return # needs asyncio.start_server
+    import cpy_fix
+    global pub_q
+    n = 2000
+    pkts = b''
+    for pid in range(1, n+1):
+        pkts += await pub_pkt(MQTTMessage(prefix+'tp', b'x'*40, qos=1, pid=pid))
+    assert len(pkts) > 65536
+    for transport in ("stream", "protocol"):
+        cpy_fix.TRANSPORT = transport
+        pub_q = []
+        acks = bytearray()
+        server, addr = await burst_server(pkts, n, acks)
+        mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+        await mqc.connect(addr, cli_id, True)
+        await sleep_ms(50) # let the burst pile up
+        got = 0
+        try:
+            while True:
+                got += await mqc.read_msgs()
+        except OSError:
+            pass
+        assert got == n and len(pub_q) == n
+        assert bytes(acks) == b''.join(b'\x40\x02' + pid.to_bytes(2, 'big') for pid in range(1, n+1))
+        await mqc.disconnect()
+        server.close()
+        await server.wait_closed()
+    assert cpy_fix.TRANSPORT == "protocol"
+
+# A PubBuf is recycled once a QoS 0 publish returns, but asyncio transports may hang on to what
+# they were given until the socket accepts it, so the CPython streams must not pass on a memoryview
+async def test_transport_owns():
+    if sys.implementation.name != 'cpython':
+        return
+    import cpy_fix
+    from mqtt_async import PubBuf
+    class Transport:
+        def __init__(self): self.held = []
+        def write(self, b): self.held.append(b)
+        def is_closing(self): return False
+    ps = cpy_fix.ProtocolStream()
+    ps.connection_made(Transport())
+    mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
+    mqc._sock = ps
+    pb = PubBuf(1500)
+    pb.data[:1500] = b'A'*1500
+    pb.len = 1500
+    await mqc.publish(MQTTMessage(prefix+'own', pb))
+    pb.data[:1500] = b'B'*1500 # recycled and refilled
+    assert bytes(ps._transport.held[-1]).endswith(b'A'*1500)
+
 # Quick simple connection
 async def test_simple():
     global pub_q, puback_set, suback_map
+    pub_q = []
     mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
     # connect
     await mqc.connect(broker, cli_id, True)
@@ -132,6 +760,7 @@ async def test_simple():
 
 async def test_coro_callback():
     global pub_q, puback_set, suback_map
+    pub_q = []
     mqc = MQTTProto(got_pub_coro, got_puback, got_suback, got_pingresp)
     # connect
     await mqc.connect(broker, cli_id, True)
@@ -153,7 +782,7 @@ async def test_coro_callback():
 
 async def test_close_write():
     #return # ==========================================================================
-    sr, sw = await asyncio.open_connection('192.168.0.14', 1883)
+    sr, sw = await asyncio.open_connection(*broker)
     print("connected")
     sw.close()
     await sw.wait_closed()
@@ -280,10 +909,9 @@ async def test_auth_succ():
     #
     await mqc.disconnect()
 
-async def test_ssl_raw_blocking():
-    #addr = ('192.168.0.14', 8883)
-    #addr = socket.getaddrinfo('iot.eclipse.org', 8883)[0][-1]
-    addr = socket.getaddrinfo('test.mosquitto.org', 8883)[0][-1]
+# ssl_raw_blocking connects a blocking TLS socket to addr and sends a CONNECT, ctx is an
+# SSLContext or None for ssl.wrap_socket's defaults
+def ssl_raw_blocking(addr, ctx):
     s = socket.socket()
     s.setblocking(True)
     try:
@@ -295,7 +923,7 @@ async def test_ssl_raw_blocking():
     #yield asyncio.core._io_queue.queue_write(s)
     try:
         import ssl
-        s = ssl.wrap_socket(s)
+        s = ctx.wrap_socket(s, server_hostname=addr[0]) if ctx else ssl.wrap_socket(s)
         print("wrapped!")
     except Exception as e:
         print("Wrap_socket raised:", e)
@@ -313,11 +941,22 @@ async def test_ssl_raw_blocking():
         print("read raised:", e)
         raise
     s.close()
+    assert got == b'\x20\x02\0\0'
+
+async def test_ssl_raw_blocking():
+    if sys.implementation.name != 'cpython':
+        #addr = ('192.168.0.14', 8883)
+        #addr = socket.getaddrinfo('iot.eclipse.org', 8883)[0][-1]
+        ssl_raw_blocking(socket.getaddrinfo('test.mosquitto.org', 8883)[0][-1], None)
+        return
+    # under CPython use the local TLS stand-in, the blocking calls run in a thread so it can answer
+    server, addr = await tls_server()
+    await asyncio.get_event_loop().run_in_executor(None, ssl_raw_blocking, addr, tls_client_ctx())
+    server.close()
+    await server.wait_closed()
 
 async def test_ssl_raw_nonblocking():
-    #addr = ('192.168.0.14', 8883)
-    #addr = socket.getaddrinfo('iot.eclipse.org', 8883)[0][-1]
-    addr = socket.getaddrinfo('test.mosquitto.org', 1883)[0][-1]
+    addr = socket.getaddrinfo(*broker)[0][-1]
     s = socket.socket()
     s.setblocking(False)
     try:
@@ -357,9 +996,7 @@ async def test_ssl_raw_nonblocking():
 async def test_mqtt_default():
     global pub_q, puback_set, suback_map
     mqc = MQTTProto(got_pub, got_puback, got_suback, got_pingresp)
-    #addr = ('192.168.0.14', 8883)
-    #addr = socket.getaddrinfo('iot.eclipse.org', 8883)[0][-1]
-    addr = socket.getaddrinfo('test.mosquitto.org', 1883)[0][-1]
+    addr = broker
     # connect with default ssl settings
     await mqc.connect(addr, cli_id, True)
             #ssl={'server_hostname':'micropython.org'})